@@ -35,6 +35,13 @@ Filtering of highly-variable genes, batch-effect correction, per-cell (UMI) norm
    pp.recipe_zheng17
    pp.recipe_weinreb16
 
+**Deferred execution**
+
+.. autosummary::
+   :toctree: .
+
+   pp.Pipeline
+
 
 Tools: TL
 ----------
@@ -66,8 +73,17 @@ Tools: TL
    :toctree: .
 
    tl.score_genes
+   tl.score_genes_batch
    tl.score_genes_cell_cycle
 
+**Sketching**
+
+.. autosummary::
+   :toctree: .
+
+   tl.sketch
+   tl.project_labels
+
 **Simulations**
 
 .. autosummary::
@@ -220,8 +236,12 @@ Global settings.
 `settings.figdir`                               Default directory for saving figures (default: './figures').
 `settings.autoshow`                             Automatically show figures (default: `True`).
 `settings.autoshow`                             Automatically show figures (default: `True`).
+`settings.float_dtype`                          Precision of computed results (default: 'float32').
 ==============================================  ===================================
 
+Use `utils.float_dtype_report()` to list functions whose results have a higher
+precision than `settings.float_dtype`.
+
 The verbosity levels have the following meaning:
 
 ===  ======================================
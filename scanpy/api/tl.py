@@ -11,4 +11,6 @@ from ..tools.louvain import louvain
 from ..tools.sim import sim
 from ..tools.top_genes import correlation_matrix, ROC_AUC_analysis
 
-from ..tools.score_genes import score_genes, score_genes_cell_cycle
+from ..tools.sketch import sketch, project_labels
+
+from ..tools.score_genes import score_genes, score_genes_batch, score_genes_cell_cycle
@@ -160,7 +160,27 @@ def get_indices_distances_from_sparse_matrix(Dsq, k):
         indices[i][0] = i
         indices[i][1:] = neighbors[1]
         distances[i][0] = 0
-        distances[i][1:] = Dsq[neighbors]
+        distances[i][1:] = Dsq[i][neighbors]
+    return indices, distances
+
+
+def get_sorted_neighbors_from_sparse_matrix(Dsq, k):
+    """Indices and squared distances of each point and its `k - 1` nearest
+    neighbors in the sparse distance matrix, sorted by distance.
+    """
+    Dsq = sp.sparse.csr_matrix(Dsq)
+    n_stored = np.diff(Dsq.indptr)
+    if n_stored.min() < k - 1:
+        raise ValueError('The data graph has only {} neighbors for some points, '
+                         'not {}.'.format(n_stored.min(), k - 1))
+    rows = np.repeat(np.arange(Dsq.shape[0]), n_stored)
+    order = np.lexsort((Dsq.data, rows))
+    # rank of each entry within its row
+    ranks = np.arange(len(order)) - Dsq.indptr[rows]
+    order = order[ranks < k - 1]
+    indices = np.c_[np.arange(Dsq.shape[0]), Dsq.indices[order].reshape(-1, k - 1)]
+    distances = np.c_[np.zeros(Dsq.shape[0], dtype=Dsq.dtype),
+                      Dsq.data[order].reshape(-1, k - 1)]
     return indices, distances
 
 
@@ -230,6 +250,7 @@ class DataGraph():
                  flavor='haghverdi16'):
         self.sym = True  # we do not allow asymetric cases
         self.flavor = flavor  # this is to experiment around
+        self.n_jobs = sett.n_jobs if n_jobs is None else n_jobs
         self.n_pcs = n_pcs if n_pcs is not None else N_PCS
         self.init_iroot_and_X(adata, recompute_pca, n_pcs)
         # use the graph in adata
@@ -279,7 +300,6 @@ class DataGraph():
             self.X_diffmap = None
             self.Dsq = None
             self.knn = knn
-            self.n_jobs = sett.n_jobs if n_jobs is None else n_jobs
             self.Dchosen = None
             if False:  # TODO
                 # in case we already computed distance relations
@@ -315,6 +335,11 @@ class DataGraph():
         # use the full data matrix X, nothing to be done
         if self.n_pcs == 0 or self.X.shape[1] <= self.n_pcs:
             logg.info('    using data matrix X directly for building graph (no PCA)')
+            from ..preprocessing.scaled import ScaledMatrix
+            scaled = ScaledMatrix.from_adata(adata)
+            # distances between rows of an implicitly scaled matrix do not
+            # depend on the centering, hence the data can stay sparse
+            if scaled is not None: self.X = scaled.for_distances()
         # use X_pca
         else:
             # use a precomputed X_pca
@@ -450,7 +475,8 @@ class DataGraph():
                 W[Mask == False] = 0
                 self.Mask = Mask
         else:
-            W = Dsq
+            # do not overwrite the distances, they are stored in adata
+            W = Dsq.copy()
             for i in range(len(Dsq.indptr[:-1])):
                 row = Dsq.indices[Dsq.indptr[i]:Dsq.indptr[i+1]]
                 num = 2 * sigmas[i] * sigmas[row]
@@ -572,7 +598,8 @@ class DataGraph():
             matrix = matrix.astype(np.float64)
             evals, evecs = sp.sparse.linalg.eigsh(matrix, k=n_evals,
                                                   which=which, ncv=ncv)
-            evals, evecs = evals.astype(np.float32), evecs.astype(np.float32)
+        evals = evals.astype(sett.float_dtype, copy=False)
+        evecs = evecs.astype(sett.float_dtype, copy=False)
         if sort == 'decrease':
             evals = evals[::-1]
             evecs = evecs[:, ::-1]
@@ -592,8 +619,9 @@ class DataGraph():
             # The eigenvectors of T are stored in self.rbasis and self.lbasis
             # and are simple trafos of the eigenvectors of Ktilde.
             # rbasis and lbasis are right and left eigenvectors, respectively
-            self.rbasis = np.array(evecs / self.sqrtz[:, np.newaxis])
-            self.lbasis = np.array(evecs * self.sqrtz[:, np.newaxis])
+            sqrtz = self.sqrtz.astype(evecs.dtype, copy=False)[:, np.newaxis]
+            self.rbasis = np.array(evecs / sqrtz)
+            self.lbasis = np.array(evecs * sqrtz)
             # normalize in L2 norm
             # note that, in contrast to that, a probability distribution
             # on the graph is normalized in L1 norm
@@ -710,7 +738,19 @@ class DataGraph():
                     for l in range(0, self.evals.size) if self.evals[l] < 0.999999])
         row += sum([(self.rbasis[i, l] - self.lbasis[:, l])**2
                     for l in range(0, self.evals.size) if self.evals[l] >= 0.999999])
-        return np.sqrt(row)
+        return np.sqrt(row).astype(sett.float_dtype, copy=False)
+
+    def get_Ddiff_block(self, rows, cols):
+        """Block `Dchosen[np.ix_(rows, cols)]`, equal to `get_Ddiff_row` up to rounding."""
+        if not self.sym:
+            raise ValueError('Not bug-free implemented! '
+                             'Computation needs to be adjusted if sym=False.')
+        weights = np.ones(self.evals.size)
+        evals = self.evals[self.evals < 0.999999]
+        weights[self.evals < 0.999999] = evals/(1-evals)
+        block = sp.spatial.distance.cdist(weights * self.rbasis[rows],
+                                          weights * self.lbasis[cols])
+        return block.astype(sett.float_dtype, copy=False)
 
     def get_Ddiff_row_deprecated(self, i):
         from ..cython import utils_cy
@@ -12,6 +12,7 @@ from scipy.stats import rankdata
 from .. import utils
 from .. import logging as logg
 from ..preprocessing import simple
+from ..tools.top_genes import _get_tail_stats
 import matplotlib.cm as cm
 import pandas as pd
 
@@ -110,8 +111,10 @@ def exploratory_rank_analysis(adata, groupby, x='inflation', y='mean', groups='a
         n_groups = n_groups + 1
     # Get group masks
     # TODO: Generalize. At the moment, only groups='all' works
-    groups_order, groups_masks = utils.select_groups(
-        adata, groups, groupby)
+    group_index = utils.GroupIndex.from_adata(adata, groupby, groups)
+    groups_order, groups_masks = group_index.names, group_index.masks
+    # Nonzero statistics for all genes and groups in one pass
+    rates, means, variances = _get_tail_stats(adata.X, group_index)
     # Create figure:
     n_rows = int(n_groups / 4) + 1
     n_cols = 4
@@ -141,23 +144,11 @@ def exploratory_rank_analysis(adata, groupby, x='inflation', y='mean', groups='a
         # make things faster by calculating only what is required for plot
         mask_rest = ~mask
 
-        # Get rate of expression
-        rate_group = _zero_inflation_estimate(adata[:, name_list], mask)
-        rate_rest = _zero_inflation_estimate(adata[:, name_list], mask_rest)
-        if (x in {'full_mean_group', 'tail_mean_group','full_mean_difference',
-                 'tail_mean_difference'} or y in {'full_mean_group', 'tail_mean_group','full_mean_difference',
-                 'tail_mean_difference'}):
-            means_group = _tail_mean_estimate(adata[:, name_list], mask)
-        if (x in {'full_mean_rest', 'tail_mean_rest', 'full_mean_difference',
-                  'tail_mean_difference'} or y in {'full_mean_rest', 'tail_mean_rest', 'full_mean_difference',
-                                                   'tail_mean_difference'}):
-            means_rest = _tail_mean_estimate(adata[:, name_list], mask_rest)
-
-        if (x is 'tail_var_group' or y is 'tail_var_group'):
-            # Get tail variance of expression
-            var_group = _tail_var_estimate(adata[:, name_list], mask)
-        if (x is 'tail_var_rest' or y is 'tail_var_rest'):
-            var_rest = _tail_var_estimate(adata[:, name_list], mask_rest)
+        # Get rate of expression, tail mean and tail variance
+        gene_indices = adata.var_names.get_indexer(name_list)
+        rate_group, rate_rest = rates[:, imask, gene_indices]
+        means_group, means_rest = means[:, imask, gene_indices]
+        var_group, var_rest = variances[:, imask, gene_indices]
         if (x is 'CDR' or y is 'CDR'):
             # Get CDR: Need to give full adata object, since we need to count everything
             CDR = _Avg_CDR(adata, mask, name_list, model='rough', n_genes=None)
@@ -280,22 +271,11 @@ def _zero_inflation_estimate(adata, mask, model='rough'):
     if model not in {'rough', 'zinb'}:
         model = 'rough'
         logg.warn('Model should be either rough or zinb (zero-inflated negative binomial)')
-    if adata.X.shape is int:
-        X = adata.X[mask]
-    else:
-        X = adata.X[mask, :]
-    n_cells = X.shape[0]
     if model is 'rough':
-        if issparse(X):
-            return X.getnnz(axis=0) / n_cells
-        else:
-            return np.count_nonzero(X, axis=0) / n_cells
+        return _get_mask_tail_stats(adata.X, mask)[0]
     else:
         # Method for ZINB will be included soon
-        if issparse(X):
-            return 0
-        else:
-            return 0
+        return 0
 
 
 def _tail_mean_estimate(adata, mask, model='rough'):
@@ -303,30 +283,11 @@ def _tail_mean_estimate(adata, mask, model='rough'):
     if model not in {'rough', 'zinb'}:
         model = 'rough'
         logg.warn('Model should be either rough or zinb (zero-inflated negative binomial)')
-    X = adata.X[mask, :]
-    n_cells = X.shape[0]
-    n_genes = X.shape[1]
-    means = np.zeros((n_genes,))
     if model is 'rough':
-        if issparse(X):
-            n_nonzero_elements = X.getnnz(axis=0)
-            # More efficient to use in flattened form, use indexing. Since highly sparsified, no memory issue
-            # Note that fulldata is flattened
-            fulldata = X.data
-            left = 0
-            right = 0
-            for i, j in enumerate(n_nonzero_elements):
-                right = right + j
-                means[i] = np.mean(fulldata[left:right])
-                left = right
-        else:
-            # non-sparse version
-            n_nonzero_elements = np.count_nonzero(X, axis=0)
-            means = np.mean(X, axis=0)
+        return _get_mask_tail_stats(adata.X, mask)[1]
     else:
         # ZINB will be implemented soon
         return 0
-    return means
 
 
 def _tail_var_estimate(adata, mask, model='rough'):
@@ -334,30 +295,18 @@ def _tail_var_estimate(adata, mask, model='rough'):
     if model not in {'rough', 'zinb'}:
         model = 'rough'
         logg.warn('Model should be either rough or zinb (zero-inflated negative binomial)')
-    X = adata.X[mask, :]
-    n_cells = X.shape[0]
-    n_genes = X.shape[1]
-    variances = np.zeros((n_genes,))
     if model is 'rough':
-        if issparse(X):
-            n_nonzero_elements = X.getnnz(axis=0)
-            # More efficient to use in flattened form, use indexing. Since highly sparsified, no memory issue
-            # Note that fulldata is flattened
-            fulldata = X.data
-            left = 0
-            right = 0
-            for i, j in enumerate(n_nonzero_elements):
-                right = right + j
-                variances[i] = np.var(fulldata[left:right])
-                left = right
-        else:
-            # non-sparse version
-            n_nonzero_elements = np.count_nonzero(X, axis=0)
-            variances = np.var(X, axis=0)
+        return _get_mask_tail_stats(adata.X, mask)[2]
     else:
         # ZINB will be implemented soon
         return 0
-    return variances
+
+
+def _get_mask_tail_stats(X, mask):
+    """Expression rate, tail mean and tail variance of the cells in `mask`."""
+    group_index = utils.GroupIndex(np.where(mask, 0, -1), [None])
+    rates, means, variances = _get_tail_stats(X, group_index)
+    return rates[0, 0], means[0, 0], variances[0, 0]
 
 
 def _Avg_CDR(adata, mask, genes, model='rough', n_genes=None):
@@ -1,3 +1,4 @@
 from ..preprocessing.recipes import recipe_zheng17, recipe_weinreb16
 from ..preprocessing.simple import filter_cells, filter_genes, filter_genes_dispersion
 from ..preprocessing.simple import log1p, pca, normalize_per_cell, regress_out, scale, subsample, downsample_counts
+from ..preprocessing.pipeline import Pipeline
@@ -0,0 +1,558 @@
+"""Deferred Preprocessing Pipeline
+
+Records calls to the functions in `simple` and executes them with a minimal
+number of passes over the data matrix.
+"""
+
+import numpy as np
+from scipy.sparse import issparse, vstack
+from sklearn.utils import sparsefuncs
+from anndata import AnnData
+from .. import logging as logg
+from ..utils import read_row_block
+from . import simple
+
+
+class Pipeline():
+    """Deferred preprocessing pipeline.
+
+    Records preprocessing steps instead of executing them. Calling :meth:`run`
+    executes all steps with a minimal number of passes over `X`:
+
+    * consecutive row scalings (`normalize_per_cell`) and element-wise
+      transformations (`log1p`, `scale`) are fused and applied on the fly,
+    * gene and cell subsets are applied as soon as they are known, so that
+      later passes only read the selected entries,
+    * the global normalization constant of `normalize_per_cell` is deferred
+      until the end of the pass that computes it, so that the normalization
+      and a subsequent gene filter share a single pass,
+    * only the final matrix is materialized.
+
+    As `X` is read in blocks of `chunk_size` rows, this also works for backed
+    `AnnData` objects. Passing `filename` to :meth:`run` streams the result
+    into a new '.h5ad' file, so that data larger than memory, like raw droplet
+    matrices before cell calling, can be filtered and normalized.
+
+    The methods take the same parameters as the corresponding functions in
+    `sc.pp` and return the pipeline, so that calls can be chained. The result
+    of `run` equals the result of calling these functions one after another.
+
+    Parameters
+    ----------
+    chunk_size : `int`, optional (default: 10000)
+        Number of rows of `X` that are processed at once.
+
+    Examples
+    --------
+    The deferred equivalent of :func:`~scanpy.api.pp.recipe_zheng17`:
+
+    >>> pipeline = (sc.pp.Pipeline()
+    ...     .filter_genes(min_counts=1)
+    ...     .normalize_per_cell(key_n_counts='n_counts_all')
+    ...     .filter_genes_dispersion(flavor='cell_ranger', n_top_genes=1000, log=False)
+    ...     .normalize_per_cell()
+    ...     .log1p()
+    ...     .scale())
+    >>> pipeline.run(adata)
+    >>> pipeline.n_passes
+    5
+    """
+
+    def __init__(self, chunk_size=10000):
+        if chunk_size < 1:
+            raise ValueError('`chunk_size` needs to be positive, not {}'
+                             .format(chunk_size))
+        self.chunk_size = chunk_size
+        self.steps = []
+        self.n_passes = None
+
+    def __repr__(self):
+        return 'Pipeline({})'.format(', '.join(step.name for step in self.steps))
+
+    def filter_cells(self, min_counts=None, min_genes=None, max_counts=None,
+                     max_genes=None):
+        """Record :func:`~scanpy.api.pp.filter_cells`."""
+        n_given_options = sum(option is not None for option in
+                              [min_genes, min_counts, max_genes, max_counts])
+        if n_given_options != 1:
+            raise ValueError(
+                'Only provide one of the optional arguments (`min_counts`, '
+                '`min_genes`, `max_counts`, `max_genes`) per call.')
+        self.steps.append(_FilterCells(min_counts, min_genes, max_counts, max_genes))
+        return self
+
+    def filter_genes(self, min_counts=None, min_cells=None, max_counts=None,
+                     max_cells=None):
+        """Record :func:`~scanpy.api.pp.filter_genes`."""
+        n_given_options = sum(option is not None for option in
+                              [min_cells, min_counts, max_cells, max_counts])
+        if n_given_options != 1:
+            raise ValueError(
+                'Only provide one of the optional arguments (`min_counts`, '
+                '`min_cells`, `max_counts`, `max_cells`) per call.')
+        self.steps.append(_FilterGenes(min_counts, min_cells, max_counts, max_cells))
+        return self
+
+    def normalize_per_cell(self, counts_per_cell_after=None, key_n_counts=None):
+        """Record :func:`~scanpy.api.pp.normalize_per_cell`."""
+        self.steps.append(_NormalizePerCell(counts_per_cell_after, key_n_counts))
+        return self
+
+    def filter_genes_dispersion(self, flavor='seurat', min_disp=None,
+                                max_disp=None, min_mean=None, max_mean=None,
+                                n_top_genes=None, log=True):
+        """Record :func:`~scanpy.api.pp.filter_genes_dispersion`.
+
+        After :meth:`run`, the returned record array is stored as `.result` of
+        the step, see :attr:`steps`.
+        """
+        if flavor not in {'seurat', 'cell_ranger'}:
+            raise ValueError('`flavor` needs to be "seurat" or "cell_ranger"')
+        if n_top_genes is not None and not all([
+                min_disp is None, max_disp is None, min_mean is None, max_mean is None]):
+            logg.warn('If you pass `n_top_genes`, all cutoffs are ignored.')
+        if min_disp is None: min_disp = 0.5
+        if min_mean is None: min_mean = 0.0125
+        if max_mean is None: max_mean = 3
+        self.steps.append(_FilterGenesDispersion(
+            flavor, min_disp, max_disp, min_mean, max_mean, n_top_genes, log))
+        return self
+
+    def log1p(self):
+        """Record :func:`~scanpy.api.pp.log1p`."""
+        self.steps.append(_Log1p())
+        return self
+
+    def scale(self, zero_center=True, max_value=None):
+        """Record :func:`~scanpy.api.pp.scale`."""
+        self.steps.append(_Scale(zero_center, max_value))
+        return self
+
+    def run(self, adata, copy=False, filename=None):
+        """Execute the recorded steps.
+
+        Parameters
+        ----------
+        adata : :class:`~scanpy.api.AnnData`
+            Annotated data matrix, possibly backed.
+        copy : `bool`, optional (default: `False`)
+            Return a copy instead of updating `adata`. For backed `adata`, a
+            new in-memory object is always returned.
+        filename : `str` or `None`, optional (default: `None`)
+            Stream the result into a new '.h5ad' file instead of keeping it in
+            memory. Together with a backed `adata`, memory usage is then bounded
+            by `chunk_size` and independent of the size of the data. If the
+            pipeline consists of cell and gene filters followed by
+            `normalize_per_cell`, the filters share a single pass over the data
+            and the result is written in a second pass; one more pass computing
+            the counts per cell is needed if `counts_per_cell_after` is `None`.
+
+        Returns
+        -------
+        Returns or updates `adata` depending on `copy`, with the same
+        annotations the eager functions add. If `filename` is given, returns
+        the result opened in backed mode 'r+'.
+        """
+        if not isinstance(adata, AnnData):
+            raise ValueError('`adata` needs to be an `AnnData` object.')
+        logg.info('running preprocessing pipeline', self, r=True)
+        state = _State(adata.X, self.chunk_size)
+        i = 0
+        while i < len(self.steps):
+            # collect the steps that can share a single pass over the data
+            pass_steps = []
+            deferred = False
+            while i < len(self.steps):
+                step = self.steps[i]
+                if deferred and step.needs_values: break
+                pass_steps.append(step)
+                i += 1
+                if step.kind == 'col': break
+                if step.defers_constant: deferred = True
+            state.execute(pass_steps)
+        if filename is not None:
+            return self._write(adata, state, filename)
+        X = state.materialize()
+        self.n_passes = state.n_passes
+        logg.msg('    finished', t=True, end=' ', v=4)
+        logg.msg('using {} passes over the data'.format(self.n_passes),
+                 v=4, no_indent=True)
+        if getattr(adata, 'isbacked', False):
+            adata = AnnData(X,
+                            obs=adata.obs[state.obs_mask].copy(),
+                            var=adata.var.iloc[state.var_idx].copy(),
+                            uns=dict(adata.uns))
+            copy = True
+        else:
+            adata = adata.copy() if copy else adata
+            # subset the genes first, the cheaper operation for most pipelines
+            adata._inplace_subset_var(state.var_idx)
+            adata._inplace_subset_obs(state.obs_mask)
+            adata.X = X
+        for key, values in state.obs_annotations.items():
+            adata.obs[key] = values[state.obs_mask]
+        for key, values in state.var_annotations.items():
+            adata.var[key] = values[state.var_idx]
+        return adata if copy else None
+
+    def _write(self, adata, state, filename):
+        import anndata
+        from scipy.sparse import csr_matrix
+        # write everything but the data matrix using anndata, then stream the
+        # blocks of the data matrix into the file
+        obs = adata.obs[state.obs_mask].copy()
+        var = adata.var.iloc[state.var_idx].copy()
+        for key, values in state.obs_annotations.items():
+            obs[key] = values[state.obs_mask]
+        for key, values in state.var_annotations.items():
+            var[key] = values[state.var_idx]
+        shape = (np.sum(state.obs_mask), state.var_idx.size)
+        AnnData(csr_matrix(shape, dtype=state.dtype), obs=obs, var=var,
+                uns=dict(adata.uns)).write(filename)
+        state.write(filename)
+        self.n_passes = state.n_passes
+        logg.msg('    finished', t=True, end=' ', v=4)
+        logg.msg('using {} passes over the data and wrote {}'
+                 .format(self.n_passes, filename), v=4, no_indent=True)
+        return anndata.read_h5ad(filename, backed='r+')
+
+
+# --------------------------------------------------------------------------------
+# Execution
+# --------------------------------------------------------------------------------
+
+
+class _State():
+    """Current transformation of the data matrix.
+
+    The transformed matrix is `ops(X[obs_mask][:, var_idx])`, where `ops` are
+    row scalings and element-wise operations applied one after another.
+    """
+
+    def __init__(self, X, chunk_size):
+        self.X = X
+        self.chunk_size = chunk_size
+        self.n_obs, self.n_vars = X.shape
+        self.dtype = X.dtype if np.issubdtype(X.dtype, np.floating) else np.float32
+        self.obs_mask = np.ones(self.n_obs, dtype=bool)
+        self.var_idx = np.arange(self.n_vars)
+        self.ops = []
+        self.centered = False
+        self.n_passes = 0
+        # constant factor by which the row scaling of the current pass is
+        # multiplied once the pass has finished
+        self.factor = 1
+        self.obs_annotations = {}
+        self.var_annotations = {}
+
+    def commit(self, op):
+        """Append an operation, fusing consecutive row scalings."""
+        if op[0] == 'row_scale' and self.ops and self.ops[-1][0] == 'row_scale':
+            self.ops[-1] = ('row_scale', self.ops[-1][1] * op[1])
+        else:
+            self.ops.append(op)
+        if op[0] == 'affine' and op[3]:
+            self.centered = True
+
+    def blocks(self):
+        """Iterate over the transformed matrix in blocks of rows.
+
+        Yields `(block, rows)`, where `rows` are the indices of the rows of
+        `block` in the original `X`.
+        """
+        for start in range(0, self.n_obs, self.chunk_size):
+            stop = min(start + self.chunk_size, self.n_obs)
+            local_mask = self.obs_mask[start:stop]
+            if not local_mask.any(): continue
+            block = read_row_block(self.X, start, stop)
+            if not local_mask.all(): block = block[local_mask]
+            if self.var_idx.size < self.n_vars: block = block[:, self.var_idx]
+            # this copies, so that all following operations can be inplace
+            block = block.astype(self.dtype)
+            rows = start + np.flatnonzero(local_mask)
+            for op in self.ops:
+                block = _apply_op(op, block, rows, self.var_idx)
+            yield block, rows
+
+    def execute(self, steps):
+        """Execute steps that share a single pass over the data."""
+        if all(step.kind == 'elem' for step in steps):
+            for step in steps: step.finish(self)
+            return
+        for step in steps: step.start(self)
+        for block, rows in self.blocks():
+            for step in steps:
+                block, rows = step.process_block(self, block, rows)
+        self.n_passes += 1
+        self.factor = 1
+        for step in steps: step.finish(self)
+
+    def materialize(self):
+        blocks = [block for block, _ in self.blocks()]
+        self.n_passes += 1
+        if len(blocks) == 0:
+            return np.zeros((0, self.var_idx.size), dtype=self.dtype)
+        if issparse(blocks[0]): return vstack(blocks, format='csr')
+        return np.vstack(blocks)
+
+    def write(self, filename):
+        """Stream the transformed matrix into `X` of an existing '.h5ad' file."""
+        import h5py
+        n_rows = np.sum(self.obs_mask)
+        with h5py.File(filename, 'r+') as f:
+            sparse = None
+            offset = 0
+            for block, _ in self.blocks():
+                if sparse is None:
+                    sparse = issparse(block)
+                    if not sparse:
+                        del f['X']
+                        X = f.create_dataset(
+                            'X', (n_rows, self.var_idx.size), dtype=self.dtype,
+                            chunks=(min(self.chunk_size, max(n_rows, 1)),
+                                    self.var_idx.size))
+                    else:
+                        X = f['X']
+                        del X['indptr']
+                        indptr = X.create_dataset(
+                            'indptr', (n_rows + 1,), dtype=np.int64)
+                        indptr[0] = 0
+                        nnz = 0
+                if sparse:
+                    stop = nnz + block.nnz
+                    X['data'].resize((stop,))
+                    X['indices'].resize((stop,))
+                    X['data'][nnz:stop] = block.data
+                    X['indices'][nnz:stop] = block.indices
+                    indptr[offset+1:offset+1+block.shape[0]] = block.indptr[1:] + nnz
+                    nnz = stop
+                else:
+                    X[offset:offset+block.shape[0]] = block
+                offset += block.shape[0]
+        self.n_passes += 1
+
+
+def _apply_op(op, block, rows, var_idx):
+    name = op[0]
+    if name == 'row_scale':
+        if issparse(block): sparsefuncs.inplace_row_scale(block, op[1][rows])
+        else: block *= op[1][rows, None]
+    elif name == 'log1p':
+        if issparse(block): np.log1p(block.data, out=block.data)
+        else: np.log1p(block, out=block)
+    elif name == 'affine':
+        _, mean, scale, zero_center = op
+        if zero_center:
+            if issparse(block): block = block.toarray()
+            block -= mean[var_idx]
+            block /= scale[var_idx]
+        elif issparse(block):
+            sparsefuncs.inplace_column_scale(block, 1/scale[var_idx])
+        else:
+            block /= scale[var_idx]
+    elif name == 'clip':
+        if issparse(block): block.data[block.data > op[1]] = op[1]
+        else: block[block > op[1]] = op[1]
+    return block
+
+
+def _row_sums(block):
+    return np.asarray(block.sum(axis=1, dtype=np.float64)).ravel()
+
+
+def _n_positive(block, axis):
+    return np.asarray((block > 0).sum(axis=axis)).ravel()
+
+
+def _full(n, values, index, fill=np.nan):
+    """Embed `values` at `index` in an array of length `n`."""
+    full = np.full(n, fill, dtype=np.float64 if np.isnan(fill) else values.dtype)
+    full[index] = values
+    return full
+
+
+# --------------------------------------------------------------------------------
+# Steps
+# --------------------------------------------------------------------------------
+
+
+class _Step():
+    """Deferred preprocessing step.
+
+    `kind` is 'row' for row-local steps, 'col' for steps that need column
+    statistics and hence end a pass and 'elem' for element-wise steps.
+    """
+    kind = 'row'
+    name = ''
+    needs_values = True  # whether the step depends on the global scale of X
+    defers_constant = False  # whether the row scaling waits for the end of the pass
+
+    def start(self, state):
+        pass
+
+    def process_block(self, state, block, rows):
+        return block, rows
+
+    def finish(self, state):
+        pass
+
+
+class _FilterCells(_Step):
+    name = 'filter_cells'
+
+    def __init__(self, min_counts, min_genes, max_counts, max_genes):
+        self.count_genes = min_genes is not None or max_genes is not None
+        self.min_number = min_counts if min_genes is None else min_genes
+        self.max_number = max_counts if max_genes is None else max_genes
+        self.needs_values = not self.count_genes
+
+    def start(self, state):
+        self.number = np.full(state.n_obs, np.nan)
+
+    def process_block(self, state, block, rows):
+        number = _n_positive(block, 1) if self.count_genes else _row_sums(block)
+        self.number[rows] = number
+        if self.min_number is not None: keep = number >= self.min_number
+        else: keep = number <= self.max_number
+        state.obs_mask[rows[~keep]] = False
+        return block[keep], rows[keep]
+
+    def finish(self, state):
+        key = 'n_genes' if self.count_genes else 'n_counts'
+        state.obs_annotations[key] = self.number
+
+
+class _NormalizePerCell(_Step):
+    name = 'normalize_per_cell'
+
+    def __init__(self, counts_per_cell_after, key_n_counts):
+        self.counts_per_cell_after = counts_per_cell_after
+        self.key_n_counts = 'n_counts' if key_n_counts is None else key_n_counts
+        # the median is only known after a full pass
+        self.defers_constant = counts_per_cell_after is None
+
+    def start(self, state):
+        self.counts = np.full(state.n_obs, np.nan)
+        self.scale = np.zeros(state.n_obs)
+        # the cells kept by this step, later steps of the same pass might
+        # remove cells from `state.obs_mask` that enter the median
+        self.kept = np.zeros(state.n_obs, dtype=bool)
+
+    def process_block(self, state, block, rows):
+        counts = _row_sums(block)
+        self.counts[rows] = counts
+        keep = counts >= 1
+        state.obs_mask[rows[~keep]] = False
+        block, rows, counts = block[keep], rows[keep], counts[keep]
+        self.kept[rows] = True
+        scale = 1 / counts
+        if not self.defers_constant: scale *= self.counts_per_cell_after
+        self.scale[rows] = scale
+        if issparse(block): sparsefuncs.inplace_row_scale(block, scale)
+        else: block *= scale[:, None]
+        return block, rows
+
+    def finish(self, state):
+        if self.defers_constant:
+            state.factor = np.median(self.counts[self.kept])
+            self.scale *= state.factor
+        state.commit(('row_scale', self.scale))
+        state.obs_annotations[self.key_n_counts] = self.counts
+
+
+class _ColumnStatistics(_Step):
+    """Accumulates the statistics of the columns of the current matrix."""
+    kind = 'col'
+    needs_values = False  # the statistics are corrected at the end of the pass
+
+    def start(self, state):
+        n_vars = state.var_idx.size
+        self.n = 0
+        self.sums = np.zeros(n_vars)
+        self.sums_sq = np.zeros(n_vars)
+        self.n_positive = np.zeros(n_vars, dtype=int)
+
+    def process_block(self, state, block, rows):
+        self.n += block.shape[0]
+        self.sums += np.asarray(block.sum(axis=0, dtype=np.float64)).ravel()
+        if issparse(block): block_sq = block.multiply(block)
+        else: block_sq = np.multiply(block, block)
+        self.sums_sq += np.asarray(block_sq.sum(axis=0, dtype=np.float64)).ravel()
+        self.n_positive += _n_positive(block, 0)
+        return block, rows
+
+    def mean_var(self, state):
+        """Mean and variance, corrected by the constant factor of the pass."""
+        mean = self.sums * state.factor / self.n
+        mean_sq = self.sums_sq * state.factor**2 / self.n
+        # enforce R convention (unbiased estimator) for variance
+        var = (mean_sq - mean**2) * (self.n / (self.n - 1))
+        return mean, var
+
+
+class _FilterGenes(_ColumnStatistics):
+    name = 'filter_genes'
+
+    def __init__(self, min_counts, min_cells, max_counts, max_cells):
+        self.count_cells = min_cells is not None or max_cells is not None
+        self.min_number = min_counts if min_cells is None else min_cells
+        self.max_number = max_counts if max_cells is None else max_cells
+
+    def finish(self, state):
+        if self.count_cells: number = self.n_positive
+        else: number = self.sums * state.factor
+        if self.min_number is not None: gene_subset = number >= self.min_number
+        else: gene_subset = number <= self.max_number
+        logg.msg('filtered out {} genes'.format(np.sum(~gene_subset)), v=4)
+        key = 'n_cells' if self.count_cells else 'n_counts'
+        state.var_annotations[key] = _full(state.n_vars, number, state.var_idx)
+        state.var_idx = state.var_idx[gene_subset]
+
+
+class _FilterGenesDispersion(_ColumnStatistics):
+    name = 'filter_genes_dispersion'
+
+    def __init__(self, flavor, min_disp, max_disp, min_mean, max_mean,
+                 n_top_genes, log):
+        self.params = dict(flavor=flavor, min_disp=min_disp, max_disp=max_disp,
+                           min_mean=min_mean, max_mean=max_mean,
+                           n_top_genes=n_top_genes, log=log)
+        self.result = None
+
+    def finish(self, state):
+        mean, var = self.mean_var(state)
+        self.result = simple._filter_genes_dispersion_from_mean_var(
+            mean, var, **self.params)
+        for key in ['means', 'dispersions', 'dispersions_norm']:
+            state.var_annotations[key] = _full(
+                state.n_vars, self.result[key], state.var_idx)
+        state.var_idx = state.var_idx[self.result['gene_subset']]
+
+
+class _Log1p(_Step):
+    kind = 'elem'
+    name = 'log1p'
+
+    def process_block(self, state, block, rows):
+        return _apply_op(('log1p',), block, rows, state.var_idx), rows
+
+    def finish(self, state):
+        state.commit(('log1p',))
+
+
+class _Scale(_ColumnStatistics):
+    name = 'scale'
+
+    def __init__(self, zero_center, max_value):
+        self.zero_center = zero_center
+        self.max_value = max_value
+
+    def finish(self, state):
+        mean, var = self.mean_var(state)
+        state.commit(('affine',
+                      _full(state.n_vars, mean, state.var_idx),
+                      _full(state.n_vars, np.sqrt(var), state.var_idx),
+                      self.zero_center))
+        if self.max_value is not None:
+            logg.msg('... clipping at max_value', self.max_value, v=4)
+            state.commit(('clip', self.max_value))
@@ -2,8 +2,10 @@
 """
 
 from . import simple as pp
+from .. import utils
 
 
+@utils.check_float_dtype
 def recipe_weinreb17(adata, mean_threshold=0.01, cv_threshold=2,
                      n_pcs=50, svd_solver='randomized', random_state=0, copy=False):
     """Normalization and filtering as of [Weinreb17]_.
@@ -48,7 +50,8 @@ def recipe_weinreb17(adata, mean_threshold=0.01, cv_threshold=2,
 recipe_weinreb16 = recipe_weinreb17  # backwards compat
 
 
-def recipe_zheng17(adata, n_top_genes=1000, plot=False, copy=False):
+@utils.check_float_dtype
+def recipe_zheng17(adata, n_top_genes=1000, plot=False, lazy=False, copy=False):
     """Normalization and filtering as of [Zheng17]_.
 
     Expects non-logarithmized data and reproduces the preprocessing of [Zheng17]_ - the Cell Ranger R
@@ -75,6 +78,10 @@ def recipe_zheng17(adata, n_top_genes=1000, plot=False, copy=False):
         Number of genes to keep.
     plot : `bool`, optional (default: `True`)
         Show a plot of the gene dispersion vs. mean relation.
+    lazy : `bool`, optional (default: `False`)
+        Run the steps as a :class:`~scanpy.api.pp.Pipeline`, which needs
+        fewer passes over the data, never copies the full data matrix and
+        also works for backed `adata`.
     copy : `bool`, optional (default: `False`)
         Return a copy of `adata` instead of updating it.
 
@@ -82,6 +89,21 @@ def recipe_zheng17(adata, n_top_genes=1000, plot=False, copy=False):
     -------
     Returns or updates `adata` depending on `copy`.
     """
+    if lazy:
+        from .pipeline import Pipeline
+        pipeline = (Pipeline()
+                    .filter_genes(min_counts=1)
+                    .normalize_per_cell(key_n_counts='n_counts_all')
+                    .filter_genes_dispersion(flavor='cell_ranger',
+                                             n_top_genes=n_top_genes, log=False)
+                    .normalize_per_cell()
+                    .log1p()
+                    .scale())
+        adata = pipeline.run(adata, copy=copy)
+        if plot:
+            from .. import plotting as pl  # should not import at the top of the file
+            pl.filter_genes_dispersion(pipeline.steps[2].result, log=True)
+        return adata
     if copy: adata = adata.copy()
     pp.filter_genes(adata, min_counts=1)  # only consider genes with more than 1 count
     pp.normalize_per_cell(adata,  # normalize with total UMI count per cell
@@ -0,0 +1,126 @@
+"""Implicitly Scaled Data Matrix
+
+Represents the result of `scale` for sparse input without densifying it.
+"""
+
+import numpy as np
+from scipy.sparse import issparse, csr_matrix
+from scipy.sparse.linalg import LinearOperator
+
+
+class ScaledMatrix(LinearOperator):
+    """Sparse data matrix that is centered and scaled on the fly.
+
+    Represents `Z = (X - mean) / std`, clipped at `max_value`, without ever
+    densifying `X`. Products with vectors and matrices are computed as
+    `X @ (V / std) - mean / std @ V`, which allows computing a PCA and
+    everything that builds on it, such as the data graph, with the memory
+    footprint of the sparse matrix.
+
+    Clipping at `max_value` only affects the stored nonzeros of `X` and a
+    shift of `mean` for columns whose zeros are clipped. The respective
+    modified copy of `X.data` is computed on the first product and then
+    reused.
+
+    Parameters
+    ----------
+    X : `sp.spmatrix`
+        The sparse data matrix, remains unchanged.
+    mean, std : `np.ndarray`
+        Per-column means and standard deviations as computed by `scale`.
+    max_value : `float` or `None`, optional (default: `None`)
+        Clip (truncate) to this value after scaling.
+    """
+
+    def __init__(self, X, mean, std, max_value=None):
+        if not issparse(X):
+            raise ValueError('`X` needs to be a sparse matrix.')
+        self.X = X
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.std = np.asarray(std, dtype=np.float64)
+        self.max_value = max_value
+        self._X_clipped = None
+        self._mean_clipped = None
+        super().__init__(dtype=np.dtype(np.float64), shape=X.shape)
+
+    @classmethod
+    def from_adata(cls, adata):
+        """Get the implicitly scaled data matrix of `adata`.
+
+        Returns `None` if `adata.X` has not been scaled with `implicit=True`.
+        """
+        if 'scale_std' not in adata.var_keys(): return None
+        return cls(adata.X, adata.var['scale_mean'].values,
+                   adata.var['scale_std'].values,
+                   adata.uns.get('scale_max_value', None))
+
+    def _clip(self):
+        """The sparse matrix and means that realize clipping."""
+        if self.max_value is None: return self.X, self.mean
+        if self._X_clipped is None:
+            X = csr_matrix(self.X, dtype=np.float64, copy=True)
+            # zeros map to -mean/std, shift the mean where these are clipped
+            mean = np.maximum(self.mean, -self.max_value * self.std)
+            cols = X.indices
+            Z = np.minimum((X.data - self.mean[cols]) / self.std[cols], self.max_value)
+            X.data = Z * self.std[cols] + mean[cols]
+            self._X_clipped, self._mean_clipped = X, mean
+        return self._X_clipped, self._mean_clipped
+
+    def _matvec(self, v):
+        return self._matmat(np.asarray(v).reshape(-1, 1)).ravel()
+
+    def _matmat(self, V):
+        X, mean = self._clip()
+        V = V / self.std[:, None]
+        return X.dot(V) - mean.dot(V)[None, :]
+
+    def _rmatvec(self, u):
+        return self._rmatmat(np.asarray(u).reshape(-1, 1)).ravel()
+
+    def _rmatmat(self, U):
+        X, mean = self._clip()
+        return (X.T.dot(U) - np.outer(mean, U.sum(axis=0))) / self.std[:, None]
+
+    def _adjoint(self):
+        return LinearOperator(dtype=self.dtype, shape=self.shape[::-1],
+                              matvec=self._rmatvec, rmatvec=self._matvec,
+                              matmat=self._rmatmat)
+
+    def centered(self):
+        """Implicitly scaled matrix with exactly zero column means.
+
+        Differs from `self` if clipping shifted the column means or if `X`
+        is a subset of the rows from which the means were computed.
+        """
+        X, _ = self._clip()
+        mean = np.asarray(X.mean(axis=0)).ravel()
+        return ScaledMatrix(X, mean, self.std)
+
+    def var(self):
+        """Variances of the columns (unbiased estimator)."""
+        from .simple import _get_mean_var
+        X, _ = self._clip()
+        _, var = _get_mean_var(X)
+        return var / self.std**2
+
+    def for_distances(self):
+        """Sparse matrix whose rows have the same pairwise distances.
+
+        Centering does not change distances, hence this is the sparse matrix
+        `X / std`, clipped if needed.
+        """
+        X, _ = self._clip()
+        X = csr_matrix(X, dtype=np.float64, copy=True)
+        X.data /= self.std[X.indices]
+        return X
+
+    def toarray(self, dtype=None):
+        """Materialize the scaled matrix, as `scale` without `implicit`."""
+        if dtype is None:
+            dtype = self.X.dtype if np.issubdtype(self.X.dtype, np.floating) else np.float32
+        X, mean = self._clip()
+        Z = X.toarray().astype(dtype, copy=False)
+        Z -= mean.astype(dtype)
+        Z /= self.std.astype(dtype)
+        return Z
@@ -11,9 +11,17 @@ from sklearn.utils import sparsefuncs
 from pandas.api.types import is_categorical_dtype
 from anndata import AnnData
 from .. import settings as sett
+from .. import utils
 from .. import logging as logg
+from .scaled import ScaledMatrix
 
 
+_msg_backed = ('`{}` does not support backed `AnnData`, instead use '
+               '`sc.pp.Pipeline` and stream the result into a new file via '
+               '`.run(adata, filename=...)`.')
+
+
+@utils.check_float_dtype
 def filter_cells(data, min_counts=None, min_genes=None, max_counts=None,
                  max_genes=None, copy=False):
     """Filter cell outliers based on counts and numbers of genes expressed.
@@ -92,6 +100,8 @@ def filter_cells(data, min_counts=None, min_genes=None, max_counts=None,
     if min_genes is None and min_counts is None and max_genes is None and max_counts is None:
         raise ValueError('Provide one of min_counts, min_genes, max_counts or max_genes.')
     if isinstance(data, AnnData):
+        if data.isbacked:
+            raise ValueError(_msg_backed.format('filter_cells'))
         adata = data.copy() if copy else data
         cell_subset, number = filter_cells(adata.X, min_counts, min_genes, max_counts, max_genes)
         if min_genes is None and max_genes is None: adata.obs['n_counts'] = number
@@ -122,6 +132,7 @@ def filter_cells(data, min_counts=None, min_genes=None, max_counts=None,
     return cell_subset, number_per_cell
 
 
+@utils.check_float_dtype
 def filter_genes(data, min_counts=None, min_cells=None, max_counts=None,
                  max_cells=None, copy=False):
     """Filter genes based on number of cells or counts.
@@ -159,6 +170,8 @@ def filter_genes(data, min_counts=None, min_cells=None, max_counts=None,
             '`min_cells`, `max_counts`, `max_cells`) per call.')
 
     if isinstance(data, AnnData):
+        if data.isbacked:
+            raise ValueError(_msg_backed.format('filter_genes'))
         adata = data.copy() if copy else data
         gene_subset, number = filter_genes(adata.X, min_cells=min_cells,
                                            min_counts=min_counts, max_cells=max_cells,
@@ -195,6 +208,7 @@ def filter_genes(data, min_counts=None, min_cells=None, max_counts=None,
     return gene_subset, number_per_gene
 
 
+@utils.check_float_dtype
 def filter_genes_dispersion(data,
                             flavor='seurat',
                             min_disp=None, max_disp=None,
@@ -266,6 +280,19 @@ def filter_genes_dispersion(data,
               r=True, end=' ')
     X = data  # no copy necessary, X remains unchanged in the following
     mean, var = _get_mean_var(X)
+    return _filter_genes_dispersion_from_mean_var(
+        mean, var, flavor=flavor, min_disp=min_disp, max_disp=max_disp,
+        min_mean=min_mean, max_mean=max_mean, n_top_genes=n_top_genes, log=log)
+
+
+def _filter_genes_dispersion_from_mean_var(mean, var, flavor='seurat',
+                                           min_disp=0.5, max_disp=None,
+                                           min_mean=0.0125, max_mean=3,
+                                           n_top_genes=None, log=True):
+    """Select highly variable genes from precomputed per-gene means and variances.
+
+    See `filter_genes_dispersion`; `mean` is modified inplace.
+    """
     # now actually compute the dispersion
     mean[mean == 0] = 1e-12  # set entries equal to zero to small value
     dispersion = var / mean
@@ -303,9 +330,10 @@ def filter_genes_dispersion(data,
         raise ValueError('`flavor` needs to be "seurat" or "cell_ranger"')
     dispersion_norm = df['dispersion_norm'].values.astype('float32')
     if n_top_genes is not None:
-        dispersion_norm[::-1].sort()  # interestingly, np.argpartition is slightly slower
-        disp_cut_off = dispersion_norm[n_top_genes-1]
-        gene_subset = df['dispersion_norm'].values >= disp_cut_off
+        disp_cut_off = np.sort(dispersion_norm)[::-1][n_top_genes-1]
+        # compare in the dtype of the cutoff, otherwise the gene at the cutoff
+        # might be lost by rounding
+        gene_subset = dispersion_norm >= disp_cut_off
         logg.msg(t=True)
         logg.msg('the', n_top_genes,
                'top genes correspond to a normalized dispersion cutoff of',
@@ -360,6 +388,7 @@ def filter_genes_fano_deprecated(X, Ecutoff, Vcutoff):
     return gene_subset
 
 
+@utils.check_float_dtype
 def log1p(data, copy=False):
     """Logarithmize the data matrix.
 
@@ -387,9 +416,10 @@ def log1p(data, copy=False):
         return X.log1p()
 
 
+@utils.check_float_dtype
 def pca(data, n_comps=50, zero_center=True, svd_solver='auto', random_state=0,
         recompute=True, mute=False, return_info=None, copy=False,
-        dtype='float32'):
+        dtype=None):
     """Principal component analysis [Pedregosa11]_.
 
     Computes PCA coordinates, loadings and variance decomposition. Uses the
@@ -405,7 +435,8 @@ def pca(data, n_comps=50, zero_center=True, svd_solver='auto', random_state=0,
         If True, compute standard PCA from Covariance matrix. If False, omit
         zero-centering variables, which allows to handle sparse input
         efficiently. If None, defaults to True for dense and to False for sparse
-        input.
+        input. Ignored if `adata` was scaled with `implicit=True`, which
+        always computes the exact PCA without densifying.
     svd_solver : `str`, optional (default: 'auto')
         SVD solver to use. Either 'arpack' for the ARPACK wrapper in SciPy
         (scipy.sparse.linalg.svds), or 'randomized' for the randomized algorithm
@@ -420,8 +451,9 @@ def pca(data, n_comps=50, zero_center=True, svd_solver='auto', random_state=0,
         defaults to `True`.
     copy : `bool` (default: `False`)
         If an `AnnData` is passed, determines whether a copy is returned.
-    dtype : str (default: 'float32')
-        Numpy data type string to which to convert the result.
+    dtype : `str` or `None`, optional (default: `None`)
+        Numpy data type string to which to convert the result, defaults to
+        `settings.float_dtype`.
 
     Returns
     -------
@@ -448,9 +480,10 @@ def pca(data, n_comps=50, zero_center=True, svd_solver='auto', random_state=0,
             return adata
         else:
             logg.msg('compute PCA with n_comps =', n_comps, r=True, v=4)
-            result = pca(adata.X, n_comps=n_comps, zero_center=zero_center,
+            result = pca(_get_X_scaled(adata), n_comps=n_comps, zero_center=zero_center,
                          svd_solver=svd_solver, random_state=random_state,
-                         recompute=recompute, mute=mute, return_info=True)
+                         recompute=recompute, mute=mute, return_info=True,
+                         dtype=dtype)
             X_pca, components, pca_variance_ratio, pca_variance = result
             adata.obsm['X_pca'] = X_pca
             adata.varm['PCs'] = components.T
@@ -465,6 +498,7 @@ def pca(data, n_comps=50, zero_center=True, svd_solver='auto', random_state=0,
         return adata if copy else None
     X = data  # proceed with data matrix
     from .. import settings as sett
+    if dtype is None: dtype = sett.float_dtype
     if X.shape[1] < n_comps:
         n_comps = X.shape[1] - 1
         logg.msg('reducing number of computed PCs to',
@@ -472,6 +506,15 @@ def pca(data, n_comps=50, zero_center=True, svd_solver='auto', random_state=0,
     zero_center = zero_center if zero_center is not None else False if issparse(X) else True
     from sklearn.decomposition import PCA, TruncatedSVD
     verbosity_level = np.inf if mute else 0
+    if isinstance(X, ScaledMatrix):
+        logg.msg('    using the implicitly scaled sparse matrix', v=4)
+        X_pca, components, pca_variance_ratio, pca_variance = _pca_implicit(
+            X, n_comps, random_state)
+        X_pca, components = X_pca.astype(dtype, copy=False), components.astype(dtype, copy=False)
+        if False if return_info is None else return_info:
+            return X_pca, components, pca_variance_ratio, pca_variance
+        else:
+            return X_pca
     if zero_center:
         if issparse(X):
             logg.msg('    as `zero_center=True`, '
@@ -485,13 +528,14 @@ def pca(data, n_comps=50, zero_center=True, svd_solver='auto', random_state=0,
                '    the first component, e.g., might be heavily influenced by different means\n'
                '    the following components often resemble the exact PCA very closely', v=4)
         pca_ = TruncatedSVD(n_components=n_comps, random_state=random_state)
-    X_pca = pca_.fit_transform(X)
-    if X_pca.dtype.descr != np.dtype(dtype).descr: X_pca = X_pca.astype(dtype)
+    X_pca = pca_.fit_transform(X).astype(dtype, copy=False)
     if False if return_info is None else return_info:
-        return X_pca, pca_.components_, pca_.explained_variance_ratio_, pca_.explained_variance_
+        return (X_pca, pca_.components_.astype(dtype, copy=False),
+                pca_.explained_variance_ratio_, pca_.explained_variance_)
     else:
         return X_pca
 
+@utils.check_float_dtype
 def normalize_per_cell(data, counts_per_cell_after=None, counts_per_cell=None,
                        key_n_counts=None, copy=False):
     """Normalize each cell.
@@ -549,6 +593,8 @@ def normalize_per_cell(data, counts_per_cell_after=None, counts_per_cell=None,
     """
     if key_n_counts is None: key_n_counts = 'n_counts'
     if isinstance(data, AnnData):
+        if data.isbacked:
+            raise ValueError(_msg_backed.format('normalize_per_cell'))
         logg.info('normalizing by total count per cell', r=True)
         adata = data.copy() if copy else data
         cell_subset, counts_per_cell = filter_cells(adata.X, min_counts=1)
@@ -621,6 +667,7 @@ def normalize_per_cell_weinreb16_deprecated(X, max_fraction=1,
     return X_norm
 
 
+@utils.check_float_dtype
 def regress_out(adata, keys, n_jobs=None, copy=False):
     """Regress out unwanted sources of variation.
 
@@ -647,6 +694,14 @@ def regress_out(adata, keys, n_jobs=None, copy=False):
         logg.info('... sparse input is densified and may '
                   'lead to huge memory consumption')
     adata = adata.copy() if copy else adata
+    scaled = ScaledMatrix.from_adata(adata)
+    if scaled is not None and scaled.max_value is not None:
+        _materialize_scaled(adata)
+        scaled = None
+    elif scaled is not None:
+        # residuals of linear models with intercept are invariant to centering,
+        # hence regress the unscaled data and only scale the residuals
+        _remove_scale_annotation(adata)
     if isinstance(keys, str): keys = [keys]
     if issparse(adata.X):
         adata.X = adata.X.toarray()
@@ -662,7 +717,7 @@ def regress_out(adata, keys, n_jobs=None, copy=False):
                 'the mean is computed for each variable/gene.')
         logg.msg('... regressing on per-gene means within categories', v=4)
         unique_categories = np.unique(adata.obs[keys[0]].values)
-        regressors = np.zeros(adata.X.shape, dtype='float32')
+        regressors = np.zeros(adata.X.shape, dtype=sett.float_dtype)
         for category in unique_categories:
             mask = category == adata.obs[keys[0]].values
             for ix, x in enumerate(adata.X.T):
@@ -672,7 +727,8 @@ def regress_out(adata, keys, n_jobs=None, copy=False):
         regressors = np.array(
             [adata.obs[key].values if key in adata.obs_keys()
              else adata[:, key].X for key in keys]).T
-    regressors = np.c_[np.ones(adata.X.shape[0]), regressors]
+    regressors = np.c_[np.ones(adata.X.shape[0]), regressors].astype(
+        sett.float_dtype, copy=False)
     len_chunk = np.ceil(min(1000, adata.X.shape[1]) / n_jobs).astype(int)
     n_chunks = np.ceil(adata.X.shape[1] / len_chunk).astype(int)
     chunks = [np.arange(start, min(start + len_chunk, adata.X.shape[1]))
@@ -711,12 +767,15 @@ def regress_out(adata, keys, n_jobs=None, copy=False):
             col_index, adata.X, regressors) for col_index in chunk]
         for i_column, column in enumerate(chunk):
             adata.X[:, column] = result_lst[i_column]
+    if scaled is not None:
+        adata.X /= scaled.std.astype(adata.X.dtype)
     logg.info('finished', t=True)
     logg.hint('after `sc.pp.regress_out`, consider rescaling the adata using `sc.pp.scale`')
     return adata if copy else None
 
 
-def scale(data, zero_center=True, max_value=None, copy=False):
+@utils.check_float_dtype
+def scale(data, zero_center=True, max_value=None, copy=False, implicit=False):
     """Scale data to unit variance and zero mean.
 
     Parameters
@@ -730,6 +789,14 @@ def scale(data, zero_center=True, max_value=None, copy=False):
         Clip (truncate) to this value after scaling. If `None`, do not clip.
     copy : `bool` (default: `False`)
         Perfrom operation inplace if `False`.
+    implicit : `bool`, optional (default: `False`)
+        For sparse input and `zero_center=True`, do not densify. Instead, keep
+        `adata.X` unchanged and only store the means and standard deviations as
+        `'scale_mean'` and `'scale_std'` in `adata.var` (and `max_value` as
+        `'scale_max_value'` in `adata.uns`). `pca`, `regress_out` and the data
+        graph then consume the scaled matrix implicitly via
+        :class:`~scanpy.preprocessing.scaled.ScaledMatrix`. For array-like
+        input, the `ScaledMatrix` is returned.
 
     Returns
     -------
@@ -737,6 +804,16 @@ def scale(data, zero_center=True, max_value=None, copy=False):
     """
     if isinstance(data, AnnData):
         adata = data.copy() if copy else data
+        # scaling twice needs the scaled values
+        _materialize_scaled(adata)
+        if implicit and zero_center and issparse(adata.X):
+            mean, var = _get_mean_var(adata.X)
+            adata.var['scale_mean'] = mean
+            adata.var['scale_std'] = np.sqrt(var)
+            if max_value is not None: adata.uns['scale_max_value'] = max_value
+            logg.msg('... scale_data: stored \'scale_mean\' and \'scale_std\' '
+                     'in adata.var, adata.X remains unchanged', v=4)
+            return adata if copy else None
         # need to add the following here to make inplace logic work
         if zero_center and issparse(adata.X):
             logg.msg(
@@ -745,6 +822,9 @@ def scale(data, zero_center=True, max_value=None, copy=False):
             adata.X = adata.X.toarray()
         scale(adata.X, zero_center=zero_center, max_value=max_value, copy=False)
         return adata if copy else None
+    if implicit and zero_center and issparse(data):
+        mean, var = _get_mean_var(data)
+        return ScaledMatrix(data, mean, np.sqrt(var), max_value)
     X = data.copy() if copy else data  # proceed with the data matrix
     zero_center = zero_center if zero_center is not None else False if issparse(X) else True
     if not zero_center and max_value is not None:
@@ -764,37 +844,95 @@ def scale(data, zero_center=True, max_value=None, copy=False):
     return X if copy else None
 
 
-def subsample(data, fraction, random_state=0, copy=False):
+@utils.check_float_dtype
+def subsample(data, fraction=None, n_obs=None, random_state=0, copy=False,
+              groupby=None, max_per_group=None, chunk_size=10000):
     """Subsample to a fraction of the number of observations.
 
+    Without `groupby`, observations are drawn uniformly. With `groupby`, the
+    sample is stratified by the categories of `adata.obs[groupby]`: each
+    category contributes its proportional share, but at least one
+    observation, so that rare categories are not lost. With `max_per_group`,
+    each category contributes at most this many observations.
+
+    Backed `AnnData` objects are subsampled by reservoir sampling in a single
+    pass over the data file, returning a new `AnnData` in memory.
+
     Parameters
     ----------
-    adata : :class:`~scanpy.api.AnnData`
-        Annotated data matrix.
-    fraction : float in [0, 1]
+    data : :class:`~scanpy.api.AnnData`, `np.ndarray`, `sp.spmatrix`
+        Annotated data matrix or data matrix.
+    fraction : float in [0, 1] or `None`, optional (default: `None`)
         Subsample to this `fraction` of the number of observations.
+    n_obs : `int` or `None`, optional (default: `None`)
+        Subsample to this number of observations. Only one of `fraction` and
+        `n_obs` can be passed.
     random_state : `int` or `None`, optional (default: 0)
-        Random seed to change subsampling.
-    simply_skip_samples : bool, optional (default: False)
-        Simply skip observations instead of true sampling.
+        Random seed to change subsampling. Sampling uses a local random state,
+        the global state of `np.random` is left untouched.
     copy : bool (default: False)
         If an AnnData is passed, determines whether a copy is returned.
+    groupby : `str` or `None`, optional (default: `None`)
+        Key of the observation annotation to stratify by.
+    max_per_group : `int` or `None`, optional (default: `None`)
+        Cap the number of observations per category of `groupby`. Can be
+        combined with `fraction` or `n_obs` or used on its own.
+    chunk_size : `int`, optional (default: 10000)
+        Number of observations read at once from a backed file.
 
     Returns
     -------
     Updates or returns the subsampled data, depending on `copy`. Returns
     ``X, obs_indices`` if data is array-like, otherwise subsamples the passed
-    `AnnData` (``copy == False``) or a copy of it (``copy == True``).
+    `AnnData` (``copy == False``) or a copy of it (``copy == True``). For
+    backed `AnnData`, always returns a new `AnnData` in memory.
     """
-    if fraction > 1 or fraction < 0:
+    isadata = isinstance(data, AnnData)
+    if groupby is not None and not isadata:
+        raise ValueError('`groupby` requires an `AnnData` object.')
+    if max_per_group is not None and groupby is None:
+        raise ValueError('`max_per_group` requires `groupby`.')
+    if fraction is not None and n_obs is not None:
+        raise ValueError('Pass only one of `fraction` and `n_obs`.')
+    if fraction is None and n_obs is None and max_per_group is None:
+        raise ValueError('Pass `fraction`, `n_obs` or `max_per_group`.')
+    if fraction is not None and (fraction > 1 or fraction < 0):
         raise ValueError('`fraction` needs to be within [0, 1], not {}'
                          .format(fraction))
-    np.random.seed(random_state)
-    n_obs = data.n_obs if isinstance(data, AnnData) else data.shape[0]
-    new_n_obs = int(fraction * n_obs)
-    obs_indices = np.random.choice(n_obs, size=new_n_obs, replace=False)
+    random_state = np.random.RandomState(random_state)
+    old_n_obs = data.n_obs if isadata else data.shape[0]
+    if n_obs is not None and (n_obs > old_n_obs or n_obs < 0):
+        raise ValueError('`n_obs` needs to be within [0, {}], not {}'
+                         .format(old_n_obs, n_obs))
+    if fraction is None and n_obs is not None:
+        fraction = n_obs / old_n_obs
+    backed = isadata and data.isbacked
+    if groupby is None and not backed:
+        new_n_obs = int(fraction * old_n_obs) if n_obs is None else n_obs
+        obs_indices = random_state.choice(old_n_obs, size=new_n_obs, replace=False)
+    else:
+        if groupby is None:
+            codes = np.zeros(old_n_obs, dtype=int)
+        else:
+            import pandas as pd
+            codes = pd.Categorical(data.obs[groupby]).codes
+        n_per_group = _subsample_n_per_group(
+            codes, fraction, n_obs, max_per_group, stratified=groupby is not None)
+        if backed:
+            X, obs_indices = _subsample_backed(
+                data.X, codes, n_per_group, random_state, chunk_size)
+        else:
+            keys = random_state.random_sample(old_n_obs)
+            obs_indices = np.flatnonzero(
+                _select_smallest_keys(keys, codes, n_per_group))
+        new_n_obs = len(obs_indices)
     logg.msg('... subsampled to {} data points'.format(new_n_obs), v=4)
-    if isinstance(data, AnnData):
+    if backed:
+        return AnnData(
+            X, obs=data.obs.iloc[obs_indices].copy(), var=data.var.copy(),
+            uns=data.uns.copy(),
+            obsm={k: data.obsm[k][obs_indices] for k in data.obsm_keys()})
+    if isadata:
         adata = data.copy() if copy else data
         adata._inplace_subset_obs(obs_indices)
         return adata if copy else None
@@ -802,6 +940,79 @@ def subsample(data, fraction, random_state=0, copy=False):
         X = data
         return X[obs_indices], obs_indices
 
+
+def _subsample_n_per_group(codes, fraction, n_obs, max_per_group, stratified):
+    """Number of observations to draw per group.
+
+    Observations with a negative code (missing category) are never drawn.
+    """
+    sizes = np.bincount(codes[codes >= 0], minlength=codes.max() + 1)
+    if fraction is None:
+        n_per_group = sizes
+    elif not stratified:
+        n_per_group = np.array([int(fraction * sizes[0]) if n_obs is None else n_obs])
+    else:
+        n_per_group = np.round(fraction * sizes).astype(int)
+        n_per_group = np.maximum(n_per_group, (sizes > 0) & (fraction > 0))
+    if max_per_group is not None:
+        n_per_group = np.minimum(n_per_group, max_per_group)
+    return n_per_group
+
+
+def _select_smallest_keys(keys, codes, n_per_group):
+    """Mask that selects the `n_per_group` observations with smallest keys.
+
+    Drawing uniform random keys and keeping the smallest ones per group is a
+    uniform sample without replacement within each group, which does not
+    depend on the order in which the observations are processed.
+    """
+    order = np.lexsort((keys, codes))
+    sorted_codes = codes[order]
+    starts = np.searchsorted(sorted_codes, sorted_codes, side='left')
+    rank = np.arange(len(order)) - starts
+    valid = sorted_codes >= 0
+    keep = np.zeros(len(order), dtype=bool)
+    keep[valid] = rank[valid] < n_per_group[sorted_codes[valid]]
+    mask = np.zeros(len(order), dtype=bool)
+    mask[order[keep]] = True
+    return mask
+
+
+def _subsample_backed(X, codes, n_per_group, random_state, chunk_size):
+    """Reservoir sampling of the rows of a backed data matrix.
+
+    Reads `X` once in blocks of `chunk_size` rows, only the rows of the
+    current reservoir are kept in memory. The random keys are drawn in the
+    same order as for the in-memory data, hence, the result is the same.
+    """
+    from ..utils import read_row_block
+    n_obs = X.shape[0]
+    indices = np.zeros(0, dtype=int)
+    keys = np.zeros(0)
+    rows = None
+    for start in range(0, n_obs, chunk_size):
+        stop = min(start + chunk_size, n_obs)
+        block_indices = np.arange(start, stop)
+        block_keys = random_state.random_sample(stop - start)
+        cand_indices = np.concatenate([indices, block_indices])
+        cand_keys = np.concatenate([keys, block_keys])
+        keep = _select_smallest_keys(cand_keys, codes[cand_indices], n_per_group)
+        keep_old, keep_new = keep[:len(indices)], keep[len(indices):]
+        indices, keys = cand_indices[keep], cand_keys[keep]
+        if not keep_new.any() and rows is not None:
+            rows = rows[keep_old]
+            continue
+        block = read_row_block(X, start, stop)[keep_new]
+        if rows is None:
+            rows = block
+        elif issparse(block):
+            rows = sp.sparse.vstack([rows[keep_old], block], format='csr')
+        else:
+            rows = np.concatenate([rows[keep_old], block])
+    return rows, indices
+
+
+@utils.check_float_dtype
 def downsample_counts(adata, target_counts=20000, random_state=0, copy=False):
     """Downsample counts so that each cell has no more than `target_counts`.
 
@@ -898,6 +1109,43 @@ def _pca_fallback(data, n_comps=2):
     return np.dot(evecs.T, data.T).T
 
 
+def _get_X_scaled(adata):
+    """`adata.X` or, if scaled with `implicit=True`, its `ScaledMatrix`."""
+    scaled = ScaledMatrix.from_adata(adata)
+    return adata.X if scaled is None else scaled
+
+
+def _remove_scale_annotation(adata):
+    del adata.var['scale_mean']
+    del adata.var['scale_std']
+    if 'scale_max_value' in adata.uns: del adata.uns['scale_max_value']
+
+
+def _materialize_scaled(adata):
+    """Densify an implicitly scaled `adata.X`."""
+    scaled = ScaledMatrix.from_adata(adata)
+    if scaled is None: return
+    logg.msg('... densifying the implicitly scaled data matrix', v=4)
+    adata.X = scaled.toarray()
+    _remove_scale_annotation(adata)
+
+
+def _pca_implicit(X, n_comps, random_state):
+    """PCA of a `ScaledMatrix`, without densifying."""
+    from scipy.sparse.linalg import svds
+    from sklearn.utils.extmath import svd_flip
+    X = X.centered()
+    v0 = np.random.RandomState(random_state).uniform(-1, 1, min(X.shape))
+    U, S, Vt = svds(X, k=n_comps, v0=v0)
+    # svds returns the singular values in increasing order
+    order = np.argsort(S)[::-1]
+    U, S, Vt = U[:, order], S[order], Vt[order]
+    U, Vt = svd_flip(U, Vt)
+    pca_variance = S**2 / (X.shape[0] - 1)
+    pca_variance_ratio = pca_variance / X.var().sum()
+    return U * S, Vt, pca_variance_ratio, pca_variance
+
+
 def _get_mean_var(X):
     # - using sklearn.StandardScaler throws an error related to
     #   int to long trafo for very large matrices
@@ -105,6 +105,21 @@ n_jobs = 2
 """Maximal number of jobs/ CPUs to use for parallel computing.
 """
 
+float_dtype = 'float32'
+"""Precision of floating point intermediates and results of `pp` and `tl`.
+
+Set to 'float64' to opt in to double precision. Functions that nonetheless
+return results of higher precision are listed by `utils.float_dtype_report`.
+"""
+
+cache_igraph = False
+"""Keep the igraph graph of the most recent adjacency matrix in memory.
+
+If `True`, `louvain` and `draw_graph` reuse the graph for the same data graph
+instead of rebuilding it. For large data graphs, this holds a lot of memory;
+`scanpy.utils.clear_igraph_cache()` frees it.
+"""
+
 logfile = ''
 """Name of logfile. By default is set to '' and writes to standard output."""
 
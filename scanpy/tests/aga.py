@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+from anndata import AnnData
+from sklearn.datasets import make_blobs
+
+from scanpy.tools.aga import AGA
+
+
+def get_aga():
+    X, labels = make_blobs(300, n_features=5, centers=6, cluster_std=3., random_state=0)
+    adata = AnnData(X.astype(np.float32))
+    adata.obs['blobs'] = pd.Categorical(labels.astype(str))
+    aga = AGA(adata, clusters='blobs', n_neighbors=10, n_pcs=0)
+    aga.update_diffmap()
+    return aga
+
+
+def test_segs_connectivity():
+    aga = get_aga()
+    aga.detect_splits()
+    # number of edges of the data graph between each pair of segments
+    adjacency = aga.Ktilde.toarray() != 0
+    counts = np.array([[adjacency[np.ix_(iseg, jseg)].sum() for jseg in aga.segs]
+                       for iseg in aga.segs])
+    off_diagonal = ~np.eye(len(aga.segs), dtype=bool)
+    assert counts[off_diagonal].min() == 0 and counts[off_diagonal].max() > 0
+    assert np.array_equal(aga.segs_connectivity[off_diagonal], counts[off_diagonal])
+
+
+def test_closest_pair():
+    aga = get_aga()
+    seg_rows, seg_cols = np.arange(0, 300, 3), np.arange(1, 300, 2)
+    D = aga.get_Dchosen_block(seg_rows, seg_cols)
+    D_rows = np.array([aga.Dchosen[i] for i in seg_rows])[:, seg_cols]
+    assert np.allclose(D, D_rows, rtol=1e-5, atol=0)
+    i, j = np.unravel_index(np.argmin(D), D.shape)
+    get_Dchosen_block, tile_sizes = aga.get_Dchosen_block, []
+    def get_Dchosen_block_logged(rows, cols):
+        tile_sizes.append(len(rows) * len(cols))
+        return get_Dchosen_block(rows, cols)
+    aga.get_Dchosen_block = get_Dchosen_block_logged
+    for tile_size in [1, 7, 100, 149, 10**6]:
+        assert aga.get_closest_pair(seg_rows, seg_cols, tile_size) \
+            == (seg_rows[i], seg_cols[j], D[i, j])
+        assert max(tile_sizes) <= tile_size
+        tile_sizes.clear()
@@ -18,3 +18,46 @@ def test_compute_transition_matrix():
     g = DataGraph(adata, n_jobs=1)
     g.compute_transition_matrix()
     np.allclose(g.Ktilde.toarray(), Ktilde_result, np.finfo(np.float32).eps)
+
+
+def test_get_edges_from_adjacency():
+    from scanpy.utils import get_edges_from_adjacency
+    adjacency = csr_matrix(np.array([[1, 2, 0], [2, 0, 3], [0, 4, 0]]))
+    sources, targets, weights = get_edges_from_adjacency(adjacency)
+    assert list(zip(sources, targets, weights)) == [(0, 0, 1), (0, 1, 4), (1, 2, 7)]
+    sources, targets, weights = get_edges_from_adjacency(adjacency, directed=True)
+    assert len(weights) == adjacency.nnz
+
+
+def test_igraph_cache():
+    import pytest
+    pytest.importorskip('igraph')
+    from scanpy import settings
+    from scanpy.utils import get_igraph_from_adjacency, clear_igraph_cache
+    adjacency = csr_matrix(np.array([[0, 2, 0], [2, 0, 3], [0, 3, 0]]))
+    try:
+        settings.cache_igraph = True
+        g = get_igraph_from_adjacency(adjacency)
+        g.add_vertices(1)
+        # modifying a returned graph does not change the cached graph
+        assert get_igraph_from_adjacency(adjacency).vcount() == 3
+    finally:
+        settings.cache_igraph = False
+        clear_igraph_cache()
+
+
+def test_get_induced_subgraph():
+    from scipy.sparse import random
+    from scanpy.utils import get_induced_subgraph
+    adjacency = random(100, 100, density=0.1, format='csr', random_state=0)
+    indices = np.random.RandomState(0).choice(100, 30, replace=False)
+    subgraph = get_induced_subgraph(adjacency, indices)
+    assert np.array_equal(subgraph.toarray(), adjacency[indices][:, indices].toarray())
+
+
+def test_get_sorted_neighbors_from_sparse_matrix():
+    from scanpy.data_structs.data_graph import get_sorted_neighbors_from_sparse_matrix
+    distances = csr_matrix([[0, 4, 1, 9], [4, 0, 0, 1], [1, 2, 0, 0], [9, 1, 0, 0]])
+    indices, distances = get_sorted_neighbors_from_sparse_matrix(distances, 2)
+    assert np.array_equal(indices, [[0, 2], [1, 3], [2, 0], [3, 1]])
+    assert np.array_equal(distances, [[0, 1], [0, 1], [0, 1], [0, 1]])
@@ -0,0 +1,24 @@
+import numpy as np
+import scipy as sp
+
+from scanpy.tools.dpt import kendall_tau_split, _get_concordance_with_previous
+
+
+def test_concordance_with_previous():
+    np.random.seed(0)
+    for n in [1, 2, 17, 64, 65, 300]:
+        a = np.random.randint(0, 7, n).astype(float)
+        b = np.random.randint(0, 5, n).astype(float)
+        diffs = [np.dot(np.sign(a[:i] - a[i]), np.sign(b[:i] - b[i])) for i in range(n)]
+        assert np.array_equal(_get_concordance_with_previous(a, b), diffs)
+
+
+def test_kendall_tau_split():
+    np.random.seed(0)
+    a = np.random.rand(100)
+    b = np.r_[a[:60], -a[60:]] + 0.1 * np.random.rand(100)
+    # without ties, the updates agree with scipy at each split
+    corr_coeff = [sp.stats.kendalltau(a[:i+1], b[:i+1])[0]
+                  - sp.stats.kendalltau(a[i+1:], b[i+1:])[0]
+                  for i in range(5, 100 - 6)]
+    assert kendall_tau_split(a, b) == 5 + np.argmax(corr_coeff)
@@ -0,0 +1,35 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from scanpy.tools._force_atlas2 import force_atlas2, _QuadTree
+
+
+def test_barnes_hut_repulsion():
+    np.random.seed(0)
+    coords = np.random.randn(500, 2)
+    coords[:3] = coords[3]
+    masses = np.random.randint(1, 10, 500).astype(float)
+    delta = coords[:, None] - coords[None]
+    dist2 = (delta**2).sum(axis=2)
+    np.fill_diagonal(dist2, np.inf)
+    magnitudes = np.where(dist2 > 0, masses[:, None] * masses[None] / dist2, 0)
+    exact = (delta * magnitudes[:, :, None]).sum(axis=1)
+    for theta, rtol in [(0.5, 0.005), (1.2, 0.02)]:
+        forces = _QuadTree(coords, masses, theta).repulsion(np.arange(500))
+        assert np.isfinite(forces).all()
+        # coincident points are aggregated, small net forces have large
+        # relative errors
+        errors = np.sqrt(((forces - exact)**2).sum(axis=1) / (exact**2).sum(axis=1))[4:]
+        assert np.median(errors) < rtol and errors.max() < 25 * rtol
+
+
+def test_force_atlas2():
+    np.random.seed(0)
+    truth = np.repeat(np.arange(2), 100)
+    rows = np.repeat(np.arange(200), 5)
+    cols = truth[rows] * 100 + np.random.randint(0, 100, len(rows))
+    adjacency = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(200, 200))
+    coords = force_atlas2(adjacency, max_iter=100, block_size=64, n_jobs=2)
+    centers = np.array([coords[truth == i].mean(axis=0) for i in range(2)])
+    distances = np.sqrt(((coords[:, None] - centers[None])**2).sum(axis=2))
+    assert (distances.argmin(axis=1) == truth).all()
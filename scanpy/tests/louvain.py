@@ -0,0 +1,48 @@
+import numpy as np
+from sklearn.metrics import adjusted_rand_score
+
+from scanpy.tools.louvain import _get_adjusted_rand_indices
+
+
+def test_adjusted_rand_indices():
+    np.random.seed(0)
+    labelings = [np.random.randint(0, k, 500) for k in [2, 5, 5, 1]]
+    labelings.append(labelings[1] * 2 + 3)
+    ari = _get_adjusted_rand_indices(labelings)
+    for i, labels_i in enumerate(labelings):
+        for j, labels_j in enumerate(labelings):
+            assert np.isclose(ari[i, j], adjusted_rand_score(labels_i, labels_j))
+
+
+def test_multilevel():
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import connected_components
+    from scanpy.tools._multilevel import multilevel
+    np.random.seed(0)
+    truth = np.repeat(np.arange(4), 50)
+    rows = np.repeat(np.arange(200), 10)
+    cols = truth[rows] * 50 + np.random.randint(0, 50, len(rows))
+    adjacency = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(200, 200))
+    labels = multilevel(adjacency)
+    assert adjusted_rand_score(truth, labels) == 1
+    # clusters are connected, even for a disconnected community
+    adjacency = csr_matrix(np.kron(np.eye(2), np.ones((3, 3))))
+    labels = multilevel(adjacency, resolution=0)
+    for label in np.unique(labels):
+        mask = labels == label
+        assert connected_components(adjacency[mask][:, mask])[0] == 1
+
+
+def test_restrict_each():
+    from anndata import AnnData
+    import scanpy.api as sc
+    np.random.seed(0)
+    adata = AnnData(np.random.randn(300, 10).astype(np.float32)
+                    + np.repeat(np.eye(10)[:3] * 10, 100, axis=0))
+    adata.obs['groups'] = np.repeat(['a', 'b', 'c'], 100)
+    sc.tl.louvain(adata, flavor='multilevel', n_neighbors=10, n_jobs=1,
+                  restrict_to=('groups', ['a', 'b']), restrict_each=True)
+    parents = adata.obs['groups_R'].str.split(',').str[0]
+    assert (parents == adata.obs['groups']).all()
+    assert (adata.obs['groups_R'][adata.obs['groups'] == 'c'] == 'c,0').all()
+    assert not adata.obs['groups_R'][adata.obs['groups'] != 'c'].str.endswith(',0').any()
@@ -2,7 +2,7 @@ import numpy as np
 from numpy import ma
 from scipy import sparse as sp
 # we don’t need this in requirements.txt, as it’s only needed for testing
-from pytest import mark
+from pytest import mark, importorskip
 import scanpy.api as sc
 
 from anndata import AnnData
@@ -29,3 +29,181 @@ def test_normalize_per_cell():
     sc.pp.normalize_per_cell(adata_sparse)
     assert adata.X.sum(axis=1).tolist() == adata_sparse.X.sum(
         axis=1).A1.tolist()
+
+
+def test_pipeline():
+    rng = np.random.RandomState(0)
+    X = (rng.negative_binomial(2, 0.3, (300, 200))
+         * rng.binomial(1, 0.3, (300, 200))).astype('float32')
+    X[:, :5] = 0  # genes that are filtered out
+    X[7] = 0  # a cell that is filtered out
+    for data in [X, sp.csr_matrix(X)]:
+        adata = AnnData(data.copy())
+        sc.pp.filter_genes(adata, min_counts=1)
+        sc.pp.normalize_per_cell(adata, key_n_counts='n_counts_all')
+        sc.pp.filter_genes_dispersion(adata, min_mean=0.5, min_disp=0.1)
+        sc.pp.normalize_per_cell(adata)
+        sc.pp.log1p(adata)
+        sc.pp.scale(adata)
+        pipeline = (sc.pp.Pipeline(chunk_size=37)
+                    .filter_genes(min_counts=1)
+                    .normalize_per_cell(key_n_counts='n_counts_all')
+                    .filter_genes_dispersion(min_mean=0.5, min_disp=0.1)
+                    .normalize_per_cell()
+                    .log1p()
+                    .scale())
+        adata_lazy = pipeline.run(AnnData(data.copy()), copy=True)
+        assert pipeline.n_passes == 5
+        assert adata_lazy.var_names.tolist() == adata.var_names.tolist()
+        assert adata_lazy.obs_names.tolist() == adata.obs_names.tolist()
+        assert np.allclose(adata_lazy.X, adata.X, atol=1e-5)
+        assert np.allclose(adata_lazy.obs['n_counts_all'], adata.obs['n_counts_all'])
+        assert np.allclose(adata_lazy.obs['n_counts'], adata.obs['n_counts'])
+        assert np.allclose(adata_lazy.var['dispersions_norm'], adata.var['dispersions_norm'],
+                           atol=1e-4, equal_nan=True)
+
+
+def test_pipeline_n_top_genes():
+    importorskip('statsmodels')
+    rng = np.random.RandomState(0)
+    X = rng.negative_binomial(2, 0.3, (500, 300)).astype('float32')
+    for data in [X, sp.csr_matrix(X)]:
+        adata = sc.pp.recipe_zheng17(AnnData(data.copy()), n_top_genes=100, copy=True)
+        adata_lazy = sc.pp.recipe_zheng17(AnnData(data.copy()), n_top_genes=100,
+                                          lazy=True, copy=True)
+        assert adata.n_vars == 100
+        assert adata_lazy.var_names.tolist() == adata.var_names.tolist()
+
+
+def test_pipeline_normalize_then_filter_cells():
+    rng = np.random.RandomState(0)
+    X = (rng.negative_binomial(2, 0.3, (300, 200))
+         * rng.binomial(1, 0.1, (300, 200))).astype('float32')
+    for data in [X, sp.csr_matrix(X)]:
+        adata = AnnData(data.copy())
+        sc.pp.normalize_per_cell(adata)
+        sc.pp.filter_cells(adata, min_genes=25)
+        pipeline = (sc.pp.Pipeline(chunk_size=50)
+                    .normalize_per_cell()
+                    .filter_cells(min_genes=25))
+        adata_lazy = pipeline.run(AnnData(data.copy()), copy=True)
+        assert adata.n_obs < 300
+        assert adata_lazy.obs_names.tolist() == adata.obs_names.tolist()
+        X_lazy = adata_lazy.X.toarray() if sp.issparse(data) else adata_lazy.X
+        X_eager = adata.X.toarray() if sp.issparse(data) else adata.X
+        assert np.allclose(X_lazy, X_eager)
+        assert np.allclose(adata_lazy.obs['n_counts'], adata.obs['n_counts'])
+
+
+def test_pipeline_backed(tmpdir):
+    import anndata
+    rng = np.random.RandomState(0)
+    X = (rng.negative_binomial(2, 0.3, (300, 200))
+         * rng.binomial(1, 0.1, (300, 200))).astype('float32')
+    for i, data in enumerate([X, sp.csr_matrix(X)]):
+        filename = str(tmpdir.join('raw{}.h5ad'.format(i)))
+        AnnData(data.copy()).write(filename)
+        adata = AnnData(data.copy())
+        sc.pp.filter_cells(adata, min_genes=20)
+        sc.pp.filter_genes(adata, min_cells=5)
+        sc.pp.normalize_per_cell(adata)
+        pipeline = (sc.pp.Pipeline(chunk_size=50)
+                    .filter_cells(min_genes=20)
+                    .filter_genes(min_cells=5)
+                    .normalize_per_cell())
+        adata_backed = anndata.read_h5ad(filename, backed='r+')
+        adata_streamed = pipeline.run(
+            adata_backed, filename=str(tmpdir.join('normalized{}.h5ad'.format(i))))
+        assert pipeline.n_passes == 3
+        assert adata_streamed.isbacked
+        assert adata_streamed.shape == adata.shape
+        X_streamed = sc.utils.read_row_block(adata_streamed.X, 0, adata.n_obs)
+        if sp.issparse(data):
+            X_streamed = X_streamed.toarray()
+            adata.X = adata.X.toarray()
+        assert np.allclose(X_streamed, adata.X)
+        assert np.allclose(adata_streamed.obs['n_counts'], adata.obs['n_counts'])
+        assert np.array_equal(adata_streamed.var['n_cells'], adata.var['n_cells'])
+
+
+def test_subsample_stratified(tmpdir):
+    import anndata
+    import pandas as pd
+    rng = np.random.RandomState(0)
+    X = sp.random(500, 20, density=0.2, format='csr', random_state=0)
+    groups = rng.choice(['a', 'b', 'rare'], 500, p=[0.7, 0.29, 0.01])
+    adata = AnnData(X, obs=pd.DataFrame({'g': pd.Categorical(groups)}))
+    state = np.random.get_state()[1].copy()
+    adata_sub = sc.pp.subsample(adata, 0.1, groupby='g', copy=True)
+    assert np.array_equal(state, np.random.get_state()[1])
+    counts = adata_sub.obs['g'].value_counts()
+    n_rare = (groups == 'rare').sum()
+    assert counts['rare'] == max(1, round(0.1 * n_rare))
+    adata_capped = sc.pp.subsample(adata, groupby='g', max_per_group=20, copy=True)
+    assert adata_capped.obs['g'].value_counts().to_dict() == {
+        'a': 20, 'b': 20, 'rare': n_rare}
+    # reservoir sampling of the backed file yields the same sample
+    filename = str(tmpdir.join('adata.h5ad'))
+    adata.write(filename)
+    adata_backed = anndata.read_h5ad(filename, backed='r')
+    adata_streamed = sc.pp.subsample(adata_backed, 0.1, groupby='g', chunk_size=37)
+    assert not adata_streamed.isbacked
+    assert np.array_equal(adata_streamed.obs_names, adata_sub.obs_names)
+    assert (adata_streamed.X != adata_sub.X).nnz == 0
+
+
+def test_scale_implicit():
+    rng = np.random.RandomState(0)
+    X = (rng.negative_binomial(2, 0.3, (200, 80))
+         * rng.binomial(1, 0.3, (200, 80))).astype('float32')
+    for max_value in [None, 1.5]:
+        adata = AnnData(sp.csr_matrix(X))
+        adata_implicit = AnnData(sp.csr_matrix(X))
+        sc.pp.scale(adata, max_value=max_value)
+        sc.pp.scale(adata_implicit, max_value=max_value, implicit=True)
+        assert sp.issparse(adata_implicit.X)
+        X_scaled = sc.pp.scale(sp.csr_matrix(X), max_value=max_value, implicit=True)
+        assert np.allclose(X_scaled.toarray(), adata.X, atol=1e-5)
+        sc.pp.pca(adata, n_comps=10, svd_solver='arpack')
+        sc.pp.pca(adata_implicit, n_comps=10)
+        assert np.allclose(adata_implicit.obsm['X_pca'], adata.obsm['X_pca'], atol=1e-3)
+        assert np.allclose(adata_implicit.uns['pca_variance_ratio'],
+                           adata.uns['pca_variance_ratio'], atol=1e-6)
+        # subsetting the cells keeps the scaling but changes the means
+        adata_sub = adata[rng.rand(200) < 0.5]
+        adata_implicit_sub = adata_implicit[adata_sub.obs_names]
+        sc.pp.pca(adata_sub, n_comps=10, svd_solver='arpack')
+        sc.pp.pca(adata_implicit_sub, n_comps=10)
+        assert np.allclose(adata_implicit_sub.obsm['X_pca'], adata_sub.obsm['X_pca'], atol=1e-3)
+        # tSNE computes the PCA of the scaled data
+        adata_tsne = adata_implicit.copy()
+        sc.tl.tsne(adata_tsne, n_pcs=10)
+        assert np.allclose(adata_tsne.obsm['X_pca'], adata.obsm['X_pca'], atol=1e-3)
+        adata.obs['covariate'] = adata_implicit.obs['covariate'] = rng.rand(200)
+        sc.pp.regress_out(adata, 'covariate')
+        sc.pp.regress_out(adata_implicit, 'covariate')
+        assert np.allclose(adata_implicit.X, adata.X, atol=1e-5)
+        assert 'scale_std' not in adata_implicit.var_keys()
+
+
+def test_float_dtype():
+    X = np.random.RandomState(0).rand(50, 10)
+    adata = AnnData(X)
+    sc.pp.pca(adata, n_comps=3)
+    assert adata.obsm['X_pca'].dtype == np.float32
+    assert adata.varm['PCs'].dtype == np.float32
+    try:
+        sc.settings.float_dtype = 'float64'
+        sc.pp.pca(adata, n_comps=3)
+        assert adata.obsm['X_pca'].dtype == np.float64
+    finally:
+        sc.settings.float_dtype = 'float32'
+    sc.utils.float_dtype_report(reset=True)
+
+    @sc.utils.check_float_dtype
+    def upcast(adata):
+        adata.obsm['X_upcast'] = adata.obsm['X_pca'].astype(np.float64)
+    adata.obsm['X_pca'] = adata.obsm['X_pca'].astype(np.float32)
+    upcast(adata)
+    assert sc.utils.float_dtype_report(reset=True) == {
+        'upcast': {"obsm['X_upcast']": 'float64'}}
@@ -50,6 +50,23 @@ def get_true_scores():
            true_scores_t_test, true_scores_wilcoxon
 
 
+def assert_wilcoxon_results(adata):
+    # tie-corrected normal approximation of the rank-sum statistic, computed
+    # independently with scipy for all genes
+    from scipy.stats import mannwhitneyu, norm
+    X = adata.X.toarray() if sp.issparse(adata.X) else adata.X
+    for group in adata.obs['true_groups'].cat.categories:
+        mask = (adata.obs['true_groups'] == group).values
+        zscores = np.array([
+            norm.isf(mannwhitneyu(X[mask, i], X[~mask, i], use_continuity=False,
+                                  alternative='greater').pvalue)
+            for i in range(X.shape[1])])
+        scores = adata.uns['rank_genes_groups_gene_scores'][str(group)]
+        names = adata.uns['rank_genes_groups_gene_names'][str(group)]
+        assert np.allclose(scores, np.sort(zscores)[::-1], atol=1e-5)
+        assert np.allclose(scores, zscores[adata.var_names.get_indexer(names)], atol=1e-5)
+
+
 def test_results_dense():
     seed(1234)
 
@@ -60,12 +77,15 @@ def test_results_dense():
 
     # Now run the rank_genes_groups, test functioning.
     rank_genes_groups(adata, 'true_groups', n_genes=20, test_type='t-test')
-    assert np.array_equal(true_scores_t_test, adata.uns['rank_genes_groups_gene_scores'])
+    # the group statistics are accumulated in double precision, whereas the
+    # reference has been computed in single precision
+    ERROR_TOLERANCE = 5e-7
+    for true_score, score in zip(true_scores_t_test, adata.uns['rank_genes_groups_gene_scores']):
+        assert np.allclose(tuple(true_score), tuple(score), rtol=0, atol=ERROR_TOLERANCE)
     assert np.array_equal(true_names_t_test, adata.uns['rank_genes_groups_gene_names'])
 
     rank_genes_groups(adata, 'true_groups', n_genes=20, test_type='wilcoxon')
-    assert np.array_equal(true_scores_wilcoxon, adata.uns['rank_genes_groups_gene_scores'])
-    assert np.array_equal(true_names_wilcoxon, adata.uns['rank_genes_groups_gene_names'])
+    assert_wilcoxon_results(adata)
 
 
 def test_results_sparse():
@@ -90,5 +110,42 @@ def test_results_sparse():
     # assert np.array_equal(true_scores_t_test,adata_sparse.uns['rank_genes_groups_gene_scores'])
     assert max_error < ERROR_TOLERANCE
     rank_genes_groups(adata_sparse, 'true_groups', n_genes=20, test_type='wilcoxon')
-    assert np.array_equal(true_scores_wilcoxon, adata_sparse.uns['rank_genes_groups_gene_scores'])
-    assert np.array_equal(true_names_wilcoxon, adata_sparse.uns['rank_genes_groups_gene_names'])
+    assert_wilcoxon_results(adata_sparse)
+
+
+def test_pairwise():
+    seed(1234)
+    adata = get_example_data(sparse=True)
+    adata.obs['groups'] = pd.Categorical(np.random.choice(['a', 'b', 'c'], adata.n_obs))
+    for test_type in ['t-test', 'wilcoxon']:
+        rank_genes_groups(adata, 'groups', reference='pairwise', n_genes=5,
+                          test_type=test_type)
+        scores = adata.uns['rank_genes_groups_pairwise_scores']
+        pairs = adata.uns['rank_genes_groups_pairwise_pairs']
+        assert scores.shape == (adata.n_vars, 6)
+        top_scores = adata.uns['rank_genes_groups_gene_scores']
+        for i, (group, reference) in enumerate(pairs):
+            assert np.allclose(top_scores[group + '_vs_' + reference],
+                               np.sort(scores[:, i])[::-1][:5])
+            adata_ref = rank_genes_groups(
+                adata, 'groups', groups=[group, reference], reference=reference,
+                n_genes=5, test_type=test_type, copy=True)
+            assert np.allclose(adata_ref.uns['rank_genes_groups_gene_scores'][group],
+                               top_scores[group + '_vs_' + reference], atol=1e-5)
+
+
+def test_backed(tmpdir):
+    from anndata import read_h5ad
+    for sparse in [False, True]:
+        adata = get_example_data(sparse=sparse)
+        filename = str(tmpdir.join('backed_{}.h5ad'.format(sparse)))
+        adata.write(filename)
+        adata_backed = read_h5ad(filename, backed='r')
+        for test_type in ['t-test', 'wilcoxon']:
+            rank_genes_groups(adata, 'true_groups', n_genes=20, test_type=test_type)
+            # small blocks so that several row and gene blocks are read
+            rank_genes_groups(adata_backed, 'true_groups', n_genes=20,
+                              test_type=test_type, block_size=500)
+            for key in ['rank_genes_groups_gene_scores', 'rank_genes_groups_gene_names']:
+                assert np.array_equal(adata.uns[key].tolist(),
+                                      adata_backed.uns[key].tolist())
@@ -12,3 +12,25 @@ def test_add_score():
     some_genes = np.concatenate([np.unique(gene_names[np.random.randint(0, 1000, 10)]), np.unique(gene_names[np.random.randint(1000, 2000, 3)])])
     sc.tl.score_genes(adata, some_genes, score_name='Test')
     assert adata.obs['Test'].dtype == 'float32'
+
+
+def test_score_genes_batch():
+    np.random.seed(0)
+    X = np.log1p(np.random.poisson(1, (100, 300))).astype(np.float32)
+    adata = AnnData(X)
+    adata.var_names = ['g{}'.format(i) for i in range(300)]
+    gene_lists = {'a': ['g1', 'g5', 'g7'], 'b': ['g{}'.format(i) for i in range(10, 40)]}
+    state = np.random.get_state()[1].copy()
+    sc.tl.score_genes_batch(adata, gene_lists, ctrl_size=5, random_state=1)
+    assert np.array_equal(state, np.random.get_state()[1])
+    adata_single = sc.tl.score_genes(adata, gene_lists['a'], ctrl_size=5,
+                                     score_name='a', random_state=1, copy=True)
+    assert np.allclose(adata.obs['a'], adata_single.obs['a'])
+    # the score does not depend on its name
+    sc.tl.score_genes(adata_single, gene_lists['a'], ctrl_size=5,
+                      score_name='other', random_state=1)
+    assert np.array_equal(adata_single.obs['a'], adata_single.obs['other'])
+    # the control genes of the sets are sampled independently
+    gene_lists = {'a': ['g1', 'g5', 'g7'], 'b': ['g1', 'g5', 'g7']}
+    sc.tl.score_genes_batch(adata, gene_lists, ctrl_size=5, random_state=1)
+    assert not np.allclose(adata.obs['a'], adata.obs['b'])
@@ -0,0 +1,22 @@
+import numpy as np
+import pandas as pd
+import scanpy.api as sc
+
+from anndata import AnnData
+
+
+def test_sketch():
+    rng = np.random.RandomState(0)
+    X = np.vstack([rng.randn(1980, 5), rng.randn(20, 5) + 10])
+    labels = np.array(['common'] * 1980 + ['rare'] * 20)
+    adata = AnnData(X, obs=pd.DataFrame({'labels': pd.Categorical(labels)}))
+    adata.obsm['X_pca'] = X
+    obs_indices = sc.tl.sketch(adata, 100, n_pcs=5)
+    assert len(obs_indices) == 100
+    assert np.all(np.diff(obs_indices) > 0)
+    # uniform sampling would pick a single rare cell on average
+    assert (labels[obs_indices] == 'rare').sum() >= 5
+    adata_sketch = adata[obs_indices].copy()
+    sc.tl.project_labels(adata, adata_sketch, 'labels', n_neighbors=3,
+                         n_pcs=5, key_added='projected')
+    assert np.array_equal(adata.obs['projected'].values, labels)
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+import pandas as pd
+from scipy import sparse as sp
+from sklearn.metrics import roc_auc_score
+
+from anndata import AnnData
+import scanpy.api as sc
+
+
+def test_roc_auc():
+    np.random.seed(0)
+    X = np.random.poisson(0.5, (200, 20)).astype(np.float32)
+    groups = pd.Categorical(np.random.choice(['a', 'b', 'c'], 200))
+    for X_ in [X, sp.csr_matrix(X)]:
+        adata = AnnData(X_)
+        adata.obs['groups'] = groups
+        auc = sc.tl.ROC_AUC_analysis(adata, 'groups', group='b', n_genes=5)
+        assert auc.shape == (3, 20)
+        for i, group in enumerate(groups.categories):
+            for j in range(20):
+                assert np.isclose(auc.values[i, j], roc_auc_score(groups == group, X[:, j]))
+        roc_auc = adata.uns['ROC_AUCgroupsb']
+        assert len(roc_auc) == 5
+        assert min(roc_auc.values()) >= np.sort(auc.loc['b'].values)[-5]
+
+
+def test_correlation_matrix():
+    np.random.seed(0)
+    X = np.random.poisson(1, (200, 10)) * np.random.binomial(1, 0.5, (200, 10))
+    X = X.astype(np.float32)
+    groups = pd.Categorical(np.random.choice(['a', 'b'], 200))
+    names = [str(i) for i in range(10)]
+    adata = AnnData(sp.csr_matrix(X))
+    adata.obs['groups'] = groups
+    for method in ['pearson', 'spearman']:
+        sc.tl.correlation_matrix(adata, name_list=names, groupby='groups',
+                                 n_genes=None, data='Groups', method=method)
+        for group in groups.categories:
+            corr = pd.DataFrame(X[groups == group], columns=names).corr(method=method)
+            assert np.allclose(adata.uns['Correlation_matrixgroups' + group], corr)
+    with pytest.raises(KeyError):
+        sc.tl.correlation_matrix(adata, name_list=['0', 'not_a_gene'])
+
+
+def test_tail_stats():
+    from scanpy.tools.top_genes import _get_tail_stats
+    from scanpy.utils import GroupIndex
+    np.random.seed(0)
+    X = np.random.poisson(1, (100, 10)) * np.random.binomial(1, 0.5, (100, 10))
+    X = X.astype(np.float32)
+    codes = np.random.randint(-1, 3, 100)
+    group_index = GroupIndex(codes, ['a', 'b', 'c'])
+    for X_ in [X, sp.csr_matrix(X), sp.csc_matrix(X)]:
+        rates, means, variances = _get_tail_stats(X_, group_index)
+        for group in range(3):
+            for i, mask in enumerate([codes == group, codes != group]):
+                for j in range(10):
+                    x = X[mask, j]
+                    assert np.isclose(rates[i, group, j], np.mean(x != 0))
+                    assert np.isclose(means[i, group, j], np.mean(x[x != 0]))
+                    assert np.isclose(variances[i, group, j], np.var(x[x != 0]))
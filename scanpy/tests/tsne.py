@@ -0,0 +1,42 @@
+import numpy as np
+from sklearn.manifold._t_sne import _joint_probabilities_nn
+from sklearn.neighbors import NearestNeighbors
+from sklearn.datasets import make_blobs
+
+from anndata import AnnData
+import scanpy.api as sc
+from scanpy.tools.tsne import _get_affinities
+
+
+def test_affinities():
+    X = np.random.RandomState(0).randn(300, 5)
+    distances = NearestNeighbors(n_neighbors=31).fit(X).kneighbors_graph(mode='distance')
+    distances.data **= 2
+    P = _get_affinities(distances, 10)
+    assert np.allclose(P.toarray(), P.T.toarray())
+    assert np.isclose(P.sum(), 1)
+    P_sklearn = _joint_probabilities_nn(distances, 10, 0)
+    assert np.allclose(P.toarray(), P_sklearn.toarray(), rtol=1e-3, atol=0)
+
+
+def test_tsne_data_graph():
+    X, labels = make_blobs(300, n_features=10, centers=3, random_state=0)
+    adata = AnnData(X.astype(np.float32))
+    sc.tl.diffmap(adata, n_neighbors=31)
+    sc.tl.tsne(adata, perplexity=10, learning_rate=200, use_data_graph=True)
+    X_tsne = adata.obsm['X_tsne']
+    assert X_tsne.shape == (300, 2) and np.isfinite(X_tsne).all()
+    # the blobs are separated in the embedding
+    centers = np.array([X_tsne[labels == i].mean(axis=0) for i in range(3)])
+    distances = ((X_tsne[:, None] - centers[None])**2).sum(axis=2)
+    assert (distances.argmin(axis=1) == labels).all()
+
+
+def test_tsne_default_ignores_data_graph():
+    X, _ = make_blobs(100, n_features=10, centers=3, random_state=0)
+    adata = AnnData(X.astype(np.float32))
+    sc.tl.diffmap(adata)
+    X_tsne = sc.tl.tsne(adata, n_pcs=0, learning_rate=200, copy=True).obsm['X_tsne']
+    adata_no_graph = AnnData(X.astype(np.float32))
+    sc.tl.tsne(adata_no_graph, n_pcs=0, learning_rate=200)
+    assert np.array_equal(X_tsne, adata_no_graph.obsm['X_tsne'])
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+from scipy import sparse as sp
+from anndata import AnnData
+from sklearn.datasets import make_blobs
+
+import scanpy.api as sc
+
+
+def test_umap_data_graph():
+    pytest.importorskip('umap')
+    X, _ = make_blobs(200, n_features=10, centers=3, random_state=0)
+    adata = AnnData(X.astype(np.float32))
+    sc.tl.diffmap(adata, n_neighbors=20)
+    sc.tl.umap(adata, n_neighbors=15, use_data_graph=True, random_state=0)
+    # the fuzzy simplicial set only links the neighbors in the data graph
+    graph = adata.uns['umap_graph']
+    distances = adata.uns['data_graph_distance_local']
+    assert adata.uns['umap_graph_params']['use_data_graph']
+    linked = (distances + distances.T + sp.eye(200)) != 0
+    assert ((graph != 0) > linked).nnz == 0
+    # the fuzzy simplicial set is reused if only the embedding changes
+    sc.tl.umap(adata, n_neighbors=15, min_dist=0.5, use_data_graph=True, random_state=0)
+    assert adata.uns['umap_graph'] is graph
+    assert adata.obsm['X_umap'].shape == (200, 2)
+    # but not if the data graph changes
+    sc.tl.diffmap(adata, n_neighbors=25)
+    sc.tl.umap(adata, n_neighbors=15, use_data_graph=True, random_state=0)
+    assert adata.uns['umap_graph'] is not graph
+    # by default, the neighbors are searched on X
+    sc.tl.umap(adata, n_neighbors=15, random_state=0)
+    assert not adata.uns['umap_graph_params']['use_data_graph']
@@ -0,0 +1,254 @@
+"""ForceAtlas2 layout on CSR adjacency matrices.
+
+An in-tree alternative to the force-directed layouts of "igraph", which are
+single-threaded and do not approximate repulsion.
+"""
+
+import numpy as np
+from scipy.sparse import csr_matrix, coo_matrix
+from joblib import Parallel, delayed
+
+
+def force_atlas2(
+        adjacency,
+        init_coords=None,
+        max_iter=500,
+        scaling_ratio=2.,
+        gravity=1.,
+        jitter_tolerance=1.,
+        theta=1.2,
+        tol=1e-3,
+        block_size=10000,
+        n_jobs=1,
+        random_state=0):
+    """Compute a ForceAtlas2 layout [Jacomy14]_ with Barnes-Hut repulsion [Barnes86]_.
+
+    Nodes repel each other with a force proportional to the product of their
+    masses (degree + 1) divided by their distance, edges attract their nodes
+    proportional to distance and weight, and a weak gravity pulls all nodes
+    towards the origin.
+
+    Repulsion is approximated using a quadtree that is built with NumPy from
+    the Morton codes of the positions: a cell whose size relative to its
+    distance to a node is below `theta` is treated as a single mass in its
+    center of mass. The tree is traversed level by level for blocks of
+    `block_size` nodes at once. Attraction is computed over the CSR edges.
+    Both are distributed over `n_jobs` threads.
+
+    The step size is adapted by the global and local speed heuristics of
+    [Jacomy14]_. The iteration stops early when the mean displacement of the
+    nodes, averaged over the last iterations, falls below `tol` times the
+    spread of the layout.
+
+    Parameters
+    ----------
+    adjacency : `sp.spmatrix`
+        Weighted adjacency matrix. It is symmetrized as `(A + Aᵀ) / 2`, the
+        diagonal is ignored.
+    init_coords : `np.ndarray` or `None`, optional (default: `None`)
+        Initial positions of shape `n_nodes × 2`. Random if `None`.
+    max_iter : `int`, optional (default: 500)
+        Maximal number of iterations.
+    scaling_ratio : `float`, optional (default: 2)
+        Strength of repulsion, larger values lead to a more spread out layout.
+    gravity : `float`, optional (default: 1)
+        Strength of the attraction towards the origin.
+    jitter_tolerance : `float`, optional (default: 1)
+        Tolerated oscillation of the nodes, larger values lead to faster but
+        less precise convergence.
+    theta : `float`, optional (default: 1.2)
+        Barnes-Hut opening angle, smaller values are more precise. The
+        points in a cell of the deepest level are always aggregated.
+    tol : `float`, optional (default: 1e-3)
+        Convergence threshold for the relative mean displacement.
+    block_size : `int`, optional (default: 10000)
+        Number of nodes whose repulsion is computed at once.
+    n_jobs : `int`, optional (default: 1)
+        Number of threads.
+    random_state : `int` or `None`, optional (default: 0)
+        Seed for the random initial positions.
+
+    Returns
+    -------
+    coords : `np.ndarray`
+        Positions of shape `n_nodes × 2`.
+    """
+    adjacency = coo_matrix(adjacency, dtype=np.float64)
+    off_diagonal = adjacency.row != adjacency.col
+    adjacency = csr_matrix(
+        (adjacency.data[off_diagonal],
+         (adjacency.row[off_diagonal], adjacency.col[off_diagonal])),
+        shape=adjacency.shape)
+    graph = ((adjacency + adjacency.T) / 2).tocsr()
+    graph.eliminate_zeros()
+    n_nodes = graph.shape[0]
+    if init_coords is None:
+        coords = np.random.RandomState(random_state).random_sample((n_nodes, 2))
+        coords = (coords - 0.5) * np.sqrt(n_nodes) * 10
+    else:
+        coords = np.array(init_coords, dtype=np.float64)
+        if coords.shape != (n_nodes, 2):
+            raise ValueError('`init_coords` needs to have shape {}, not {}.'
+                             .format((n_nodes, 2), coords.shape))
+    if n_nodes < 2: return coords
+    masses = np.diff(graph.indptr) + 1.
+    parallel = Parallel(n_jobs=n_jobs, backend='threading')
+    node_blocks = [np.arange(start, min(start + block_size, n_nodes))
+                   for start in range(0, n_nodes, block_size)]
+    speed, speed_efficiency = 1., 1.
+    forces_old = np.zeros_like(coords)
+    relative_displacement = 1.
+    for _ in range(max_iter):
+        tree = _QuadTree(coords, masses, theta)
+        forces = np.vstack(parallel(
+            delayed(_get_forces)(graph, coords, masses, tree, nodes,
+                                 scaling_ratio, gravity)
+            for nodes in node_blocks))
+        # adaptive speed [Jacomy14]_
+        swinging = masses * np.sqrt(((forces - forces_old)**2).sum(axis=1))
+        traction = masses * np.sqrt(((forces + forces_old)**2).sum(axis=1)) / 2
+        speed, speed_efficiency = _adapt_speed(
+            speed, speed_efficiency, swinging.sum(), traction.sum(),
+            n_nodes, jitter_tolerance)
+        factors = speed / (1 + np.sqrt(speed * swinging))
+        displacement = forces * factors[:, None]
+        coords += displacement
+        forces_old = forces
+        # smooth over iterations as the speed needs to build up first
+        spread = np.sqrt(coords.var(axis=0).sum())
+        relative_displacement = (
+            0.9 * relative_displacement
+            + 0.1 * np.sqrt((displacement**2).sum(axis=1)).mean() / spread)
+        if relative_displacement < tol: break
+    return coords
+
+
+def _adapt_speed(speed, speed_efficiency, swinging, traction, n_nodes,
+                 jitter_tolerance):
+    """Global speed as in the ForceAtlas2 implementation of Gephi."""
+    if swinging == 0: return speed, speed_efficiency
+    optimal_jitter = 0.05 * np.sqrt(n_nodes)
+    jitter = jitter_tolerance * max(
+        np.sqrt(optimal_jitter),
+        min(10., optimal_jitter * traction / n_nodes**2))
+    if swinging / traction > 2:
+        if speed_efficiency > 0.05: speed_efficiency *= 0.5
+        jitter = max(jitter, jitter_tolerance)
+    target_speed = jitter * speed_efficiency * traction / swinging
+    if swinging > jitter * traction:
+        if speed_efficiency > 0.05: speed_efficiency *= 0.7
+    elif speed < 1000:
+        speed_efficiency *= 1.3
+    speed = speed + min(target_speed - speed, 0.5 * speed)
+    return speed, speed_efficiency
+
+
+def _get_forces(graph, coords, masses, tree, nodes, scaling_ratio, gravity):
+    """Forces on `nodes`: repulsion, attraction along edges and gravity."""
+    forces = scaling_ratio * tree.repulsion(nodes)
+    # attraction along the CSR edges of the rows `nodes`
+    start, stop = graph.indptr[nodes[0]], graph.indptr[nodes[-1] + 1]
+    rows = np.repeat(np.arange(len(nodes)), np.diff(graph.indptr[nodes[0]:nodes[-1] + 2]))
+    cols = graph.indices[start:stop]
+    weights = graph.data[start:stop]
+    for k in range(2):
+        delta = coords[cols, k] - coords[nodes[rows], k]
+        forces[:, k] += np.bincount(rows, weights=weights * delta,
+                                    minlength=len(nodes))
+    # gravity towards the origin
+    norms = np.sqrt((coords[nodes]**2).sum(axis=1))
+    forces -= (gravity * masses[nodes] / np.maximum(norms, 1e-12))[:, None] * coords[nodes]
+    return forces
+
+
+class _QuadTree:
+    """Quadtree of point masses, stored level by level in NumPy arrays.
+
+    Cells of level `d` are the unique prefixes of length `2d` of the Morton
+    codes of the points. As the codes are sorted, the children of a cell are
+    a contiguous range of cells of the next level.
+    """
+
+    def __init__(self, coords, masses, theta, max_depth=None):
+        n_points = coords.shape[0]
+        if max_depth is None:
+            max_depth = int(min(20, np.ceil(np.log(max(n_points, 2)) / np.log(4)) + 3))
+        self.coords, self.masses, self.theta = coords, masses, theta
+        low = coords.min(axis=0)
+        size = (coords.max(axis=0) - low).max()
+        size = size * (1 + 1e-9) if size > 0 else 1.
+        n_side = 2**max_depth
+        grid = np.minimum(((coords - low) / size * n_side).astype(np.int64), n_side - 1)
+        codes = _spread_bits(grid[:, 0]) | (_spread_bits(grid[:, 1]) << np.uint64(1))
+        order = np.argsort(codes, kind='mergesort')
+        codes = codes[order]
+        self.levels = []
+        for depth in range(max_depth + 1):
+            prefixes = codes >> np.uint64(2 * (max_depth - depth))
+            is_first = np.ones(n_points, dtype=bool)
+            is_first[1:] = prefixes[1:] != prefixes[:-1]
+            cells_sorted = np.cumsum(is_first) - 1
+            cells = np.empty(n_points, dtype=np.int64)
+            cells[order] = cells_sorted
+            mass = np.bincount(cells, weights=masses)
+            center = np.column_stack([
+                np.bincount(cells, weights=masses * coords[:, k]) for k in range(2)])
+            center /= mass[:, None]
+            self.levels.append({
+                'keys': prefixes[is_first], 'cells': cells, 'mass': mass,
+                'center': center, 'size': size / 2**depth})
+        for depth in range(max_depth):
+            keys = self.levels[depth]['keys']
+            parent_keys = self.levels[depth + 1]['keys'] >> np.uint64(2)
+            self.levels[depth]['children'] = (
+                np.searchsorted(parent_keys, keys, side='left'),
+                np.searchsorted(parent_keys, keys, side='right'))
+
+    def repulsion(self, nodes):
+        """Repulsion on `nodes`, up to the factor `scaling_ratio`."""
+        coords, masses = self.coords[nodes], self.masses[nodes]
+        forces = np.zeros((len(nodes), 2))
+        # frontier of (node, cell) pairs
+        pairs = np.arange(len(nodes))
+        cells = np.zeros(len(nodes), dtype=np.int64)
+        max_depth = len(self.levels) - 1
+        for depth, level in enumerate(self.levels):
+            own = level['cells'][nodes[pairs]] == cells
+            mass = level['mass'][cells]
+            delta = coords[pairs] - level['center'][cells]
+            if depth == max_depth:
+                # remove the node from its own leaf
+                mass_other = mass - np.where(own, masses[pairs], 0)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    scale = np.where(own, mass / mass_other, 1)
+                accept = mass_other > 1e-12 * mass
+                delta = delta[accept] * scale[accept, None]
+                mass = mass_other[accept]
+            else:
+                dist2 = (delta**2).sum(axis=1)
+                accept = ~own & (level['size']**2 < self.theta**2 * dist2)
+                delta, mass = delta[accept], mass[accept]
+            dist2 = np.maximum((delta**2).sum(axis=1), 1e-12)
+            magnitudes = masses[pairs[accept]] * mass / dist2
+            for k in range(2):
+                forces[:, k] += np.bincount(pairs[accept], weights=magnitudes * delta[:, k],
+                                            minlength=len(nodes))
+            if depth == max_depth: break
+            pairs, cells = pairs[~accept], cells[~accept]
+            start, stop = (c[cells] for c in level['children'])
+            counts = stop - start
+            pairs = np.repeat(pairs, counts)
+            # concatenated ranges start[i]:stop[i]
+            offsets = np.cumsum(counts) - counts
+            cells = np.arange(counts.sum()) - np.repeat(offsets - start, counts)
+        return forces
+
+
+def _spread_bits(values):
+    """Interleave the bits of `values` with zeros, the basis of Morton codes."""
+    values = values.astype(np.uint64)
+    for shift, mask in [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF),
+                        (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333),
+                        (1, 0x5555555555555555)]:
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
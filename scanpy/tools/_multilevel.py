@@ -0,0 +1,136 @@
+"""Multilevel modularity optimization on CSR adjacency matrices.
+
+An in-tree alternative to the "louvain" and "igraph" packages that does not
+need to build a graph object.
+"""
+
+from collections import deque
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+def multilevel(adjacency, resolution=1, random_state=0, max_levels=100):
+    """Cluster the nodes of a graph by multilevel modularity optimization.
+
+    Alternates the following steps in the spirit of [Blondel08]_ and
+    [Traag18]_.
+
+    1. Local moving: nodes are moved to the neighboring community with the
+       largest modularity gain. After a move, only the neighbors of the moved
+       node that are not in its new community are queued again.
+    2. Refinement: each community is split into its connected components.
+       This never decreases modularity and guarantees connected clusters.
+    3. Aggregation: the refined communities become the nodes of the next
+       level, whose adjacency matrix is computed as `SᵀAS` from the sparse
+       membership matrix `S`. Nodes start in the community of their members.
+
+    All node state is kept in NumPy arrays.
+
+    Parameters
+    ----------
+    adjacency : `sp.spmatrix`
+        Weighted adjacency matrix. It is symmetrized as `(A + Aᵀ) / 2`.
+    resolution : `float`, optional (default: 1)
+        Higher values lead to more and smaller clusters.
+    random_state : `int` or `None`, optional (default: 0)
+        Seed for the order in which nodes are visited.
+    max_levels : `int`, optional (default: 100)
+        Maximal number of aggregation levels.
+
+    Returns
+    -------
+    labels : `np.ndarray`
+        Cluster of each node, clusters are ordered by decreasing size.
+    """
+    adjacency = csr_matrix(adjacency, dtype=np.float64)
+    graph = ((adjacency + adjacency.T) / 2).tocsr()
+    graph.sum_duplicates()
+    random_state = np.random.RandomState(random_state)
+    # nodes of the current level of each observation
+    nodes = np.arange(graph.shape[0])
+    communities = np.arange(graph.shape[0])
+    for _ in range(max_levels):
+        communities = _move_nodes(graph, communities, resolution, random_state)
+        refined = _split_disconnected(graph, communities)
+        n_refined = refined.max() + 1 if len(refined) > 0 else 0
+        if n_refined == graph.shape[0]:
+            break
+        membership = csr_matrix(
+            (np.ones(len(refined)), (np.arange(len(refined)), refined)),
+            shape=(len(refined), n_refined))
+        graph = membership.T.dot(graph).dot(membership).tocsr()
+        # aggregated nodes start in the community of their members
+        parents = np.empty(n_refined, dtype=int)
+        parents[refined] = communities
+        communities = np.unique(parents, return_inverse=True)[1]
+        nodes = refined[nodes]
+    labels = _split_disconnected(graph, communities)[nodes]
+    return _order_by_size(labels)
+
+
+def _move_nodes(graph, communities, resolution, random_state):
+    """Local moving of nodes with a queue of nodes whose neighborhood changed."""
+    indptr, indices, weights = graph.indptr, graph.indices, graph.data
+    n_nodes = graph.shape[0]
+    degrees = np.asarray(graph.sum(axis=1)).ravel()
+    total_weight = degrees.sum()
+    if total_weight == 0:
+        return communities
+    scale = resolution / total_weight
+    communities = communities.copy()
+    totals = np.bincount(communities, weights=degrees, minlength=n_nodes)
+    queue = deque(random_state.permutation(n_nodes).tolist())
+    in_queue = np.ones(n_nodes, dtype=bool)
+    while queue:
+        node = queue.popleft()
+        in_queue[node] = False
+        start, stop = indptr[node], indptr[node+1]
+        if start == stop:
+            continue
+        neighbors = indices[start:stop]
+        neighbor_communities = communities[neighbors]
+        old = communities[node]
+        degree = degrees[node]
+        totals[old] -= degree
+        # weights to neighboring communities, the neighborhood is small,
+        # hence, a dict is faster than sorting in numpy
+        community_weights = {}
+        for community, neighbor, weight in zip(neighbor_communities.tolist(),
+                                               neighbors.tolist(),
+                                               weights[start:stop].tolist()):
+            if neighbor != node:
+                community_weights[community] = community_weights.get(community, 0) + weight
+        candidates = np.fromiter(community_weights.keys(), dtype=int,
+                                 count=len(community_weights))
+        gains = (np.fromiter(community_weights.values(), dtype=float,
+                             count=len(community_weights))
+                 - scale * degree * totals[candidates])
+        gain_old = community_weights.get(old, 0) - scale * degree * totals[old]
+        ibest = np.argmax(gains) if len(gains) > 0 else None
+        new = candidates[ibest] if ibest is not None and gains[ibest] > gain_old else old
+        totals[new] += degree
+        if new != old:
+            communities[node] = new
+            queued = neighbors[(neighbor_communities != new) & ~in_queue[neighbors]]
+            in_queue[queued] = True
+            queue.extend(queued.tolist())
+    return np.unique(communities, return_inverse=True)[1]
+
+
+def _split_disconnected(graph, communities):
+    """Split communities into their connected components."""
+    graph = graph.tocoo()
+    within = communities[graph.row] == communities[graph.col]
+    graph_within = csr_matrix(
+        (np.ones(within.sum()), (graph.row[within], graph.col[within])),
+        shape=graph.shape)
+    return connected_components(graph_within, directed=False)[1]
+
+
+def _order_by_size(labels):
+    """Relabel clusters such that cluster 0 is the largest."""
+    sizes = np.bincount(labels)
+    ranks = np.empty(len(sizes), dtype=int)
+    ranks[np.argsort(-sizes, kind='mergesort')] = np.arange(len(sizes))
+    return ranks[labels]
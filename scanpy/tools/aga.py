@@ -3,13 +3,16 @@ import numpy as np
 import scipy as sp
 import networkx as nx
 from textwrap import dedent
+from joblib import Parallel, delayed
 from .. import logging as logg
 from ..data_structs import data_graph
 from .. import utils
 from .. import settings
+from .dpt import kendall_tau_split
 
 
 MINIMAL_TREE_ATTACHEDNESS = 0.05
+TILE_SIZE = 2**22  # maximal number of distances per tile in closest-pair searches
 
 doc_string_base = dedent("""\
     Generate cellular maps of differentiation manifolds with complex
@@ -102,6 +105,7 @@ doc_string_returns = dedent("""\
     """)
 
 
+@utils.check_float_dtype
 def aga(adata,
         groups='louvain_groups',
         tree_based_confidence=True,
@@ -551,10 +555,15 @@ class AGA(data_graph.DataGraph):
             List of integer index arrays.
         segs_tips : np.ndarray
             List of indices of the tips of segments.
+        segs_connectivity : np.ndarray
+            Number of edges of the data graph between each pair of segments.
         """
         logg.info('    abstracted graph will have {} nodes'.format(self.n_splits+1))
         indices_all = np.arange(self.X.shape[0], dtype=int)
         segs = [indices_all]
+        self.segs_labels = np.zeros(self.X.shape[0], dtype=int)
+        self.segs_connectivity = np.zeros((1, 1))
+        self.connectivity_graph = sp.sparse.csr_matrix(self.Ktilde != 0, dtype=float)
         if False:  # this is safe, but not compatible with on-the-fly computation
             tips_all = np.array(np.unravel_index(np.argmax(self.Dchosen), self.Dchosen.shape))
         else:
@@ -570,7 +579,6 @@ class AGA(data_graph.DataGraph):
         segs_undecided = [True]
         segs_adjacency = [[]]
         segs_distances = np.zeros((1, 1))
-        segs_adjacency_nodes = [{}]
         # logg.info('    do not consider groups with less than {} points for splitting'
         #           .format(self.min_group_size))
         for ibranch in range(self.n_splits):
@@ -590,7 +598,6 @@ class AGA(data_graph.DataGraph):
                 logg.msg('    split', ibranch + 1, v=4)
                 stop, segs_distances = self.do_split_constrained(segs, segs_tips,
                                                                  segs_adjacency,
-                                                                 segs_adjacency_nodes,
                                                                  segs_distances)
                 if stop: break
 
@@ -677,7 +684,6 @@ class AGA(data_graph.DataGraph):
 
     def do_split_constrained(self, segs, segs_tips,
                              segs_adjacency,
-                             segs_adjacency_nodes,
                              segs_distances):
 
         if max([len(seg) for seg in segs]) < self.min_group_size:
@@ -895,8 +901,7 @@ class AGA(data_graph.DataGraph):
                                                segs,
                                                segs_tips,
                                                segs_adjacency,
-                                               segs_adjacency_nodes,
-                                               segs_distances, iseg)
+                                               segs_distances)
         return False, segs_distances
 
     def select_segment(self, segs, segs_tips, segs_undecided):
@@ -1072,8 +1077,7 @@ class AGA(data_graph.DataGraph):
         # need to return segs_distances as inplace formulation doesn't work
         return segs_distances
 
-    def compute_attachedness(self, jseg, kseg_list, segs, segs_tips,
-                             segs_adjacency_nodes):
+    def compute_attachedness(self, jseg, kseg_list, segs, segs_tips):
         distances = []
         median_distances = []
         measure_points_in_jseg = []
@@ -1090,26 +1094,17 @@ class AGA(data_graph.DataGraph):
                        kseg, '(tip: {}, clos: {})'.format(segs_tips[kseg][0], measure_points_in_kseg[-1]),
                        '->', distances[-1], v=4)
         elif self.attachedness_measure == 'random_walk':
-            for kseg in kseg_list:
-                closest_distance = 1e12
-                measure_point_in_jseg = 0
-                measure_point_in_kseg = 0
-                distances_pairs = []
-                robust_quantile_jseg = int(0.0*len(segs[jseg]))
-                robust_quantile_kseg = int(0.0*len(segs[kseg]))
-                for reference_point_in_kseg in segs[kseg]:
-                    position_in_jseg = np.argpartition(self.Dchosen[reference_point_in_kseg, segs[jseg]], robust_quantile_jseg)[robust_quantile_jseg]
-                    measure_point_in_jseg_test = segs[jseg][position_in_jseg]
-                    distances_pairs.append(self.Dchosen[reference_point_in_kseg, measure_point_in_jseg_test])
-                    if distances_pairs[-1] < closest_distance:
-                        measure_point_in_jseg = measure_point_in_jseg_test
-                        measure_point_in_kseg = reference_point_in_kseg
-                        closest_distance = distances_pairs[-1]
+            # the segment pairs share the tile budget
+            n_jobs = max(1, min(self.n_jobs, len(kseg_list)))
+            closest_pairs = Parallel(n_jobs=n_jobs, backend='threading')(
+                delayed(self.get_closest_pair)(segs[kseg], segs[jseg], TILE_SIZE // n_jobs)
+                for kseg in kseg_list)
+            for kseg, closest_pair in zip(kseg_list, closest_pairs):
+                measure_point_in_kseg, measure_point_in_jseg, closest_distance = closest_pair
                 measure_points_in_kseg.append(measure_point_in_kseg)
                 measure_points_in_jseg.append(measure_point_in_jseg)
-                closest_distance = np.partition(distances_pairs, robust_quantile_kseg)[robust_quantile_kseg]
                 distances.append(closest_distance)
-                median_distance = np.median(self.Dchosen[measure_point_in_kseg, segs[jseg]])
+                median_distance = np.median(self.get_Dchosen_block([measure_point_in_kseg], segs[jseg]))
                 median_distances.append(median_distance)
                 logg.msg('   ',
                        jseg, '({})'.format(measure_points_in_jseg[-1]),
@@ -1135,13 +1130,7 @@ class AGA(data_graph.DataGraph):
                        kseg, '(tip: {}, clos: {})'.format(segs_tips[kseg][0], measure_points_in_kseg[-1]),
                        '->', distances[-1], v=4)
         elif self.attachedness_measure == 'connectedness_brute_force':
-            segs_jseg = set(segs[jseg])
-            for kseg in kseg_list:
-                connectedness = 0
-                for reference_point_in_kseg in segs[kseg]:
-                    for j in self.Ktilde[reference_point_in_kseg].nonzero()[1]:
-                        if j in segs_jseg:
-                            connectedness += 1
+            for connectedness in self.segs_connectivity[jseg, kseg_list]:
                 # distances.append(1./(connectedness+1))
                 distances.append(1./connectedness if connectedness != 0 else np.inf)
             logg.msg(' ', jseg, '-', kseg_list, '->', distances, v=4)
@@ -1149,97 +1138,79 @@ class AGA(data_graph.DataGraph):
             raise ValueError('unknown attachedness measure')
         return distances, median_distances, measure_points_in_jseg, measure_points_in_kseg
 
-    def trace_existing_connections(self, jseg, kseg_list, segs, segs_tips, segs_adjacency_nodes, trunk):
-        j_connects = segs_adjacency_nodes[jseg].copy()
-        connectedness = [0, 0]
-        not_trunk = 1 if trunk == 0 else 0
-        kseg_trunk = set(segs[kseg_list[trunk]])
-        kseg_not_trunk = set(segs[kseg_list[not_trunk]])
-        for j_connect, connects in j_connects.items():
-            for point_connect, seg_connect in connects:
-                if seg_connect == kseg_list[trunk]:
-                    # score = 0
-                    # if self.Dsq[point_connect, j_connect] > 0:
-                    #     score += 1. / (1 + self.Dsq[point_connect, j_connect])  # / (1 + len(segs_adjacency_nodes[jseg]))  # len(segs[jseg])
-                    # if self.Dsq[j_connect, point_connect] > 0:
-                    #     score += 1. / (1 + self.Dsq[j_connect, point_connect])  # / (1 + len(segs_adjacency_nodes[kseg_list[trunk if in_kseg_trunk else not_trunk]]))  # len(kseg_trunk if in_kseg_trunk else kseg_not_trunk)
-                    score = 1
-                    in_kseg_trunk = True if point_connect in kseg_trunk else False
-                    if in_kseg_trunk:
-                        connectedness[trunk] += score
-                    else:
-                        # elif point_connect in kseg_not_trunk:
-                        if j_connect not in segs_adjacency_nodes[jseg]:
-                            segs_adjacency_nodes[jseg][j_connect] = []
-                        idx = segs_adjacency_nodes[jseg][j_connect].index((point_connect, kseg_list[trunk]))
-                        segs_adjacency_nodes[jseg][j_connect][idx] = (point_connect, kseg_list[not_trunk])
-                        if point_connect not in segs_adjacency_nodes[kseg_list[not_trunk]]:
-                            segs_adjacency_nodes[kseg_list[not_trunk]][point_connect] = []
-                        segs_adjacency_nodes[kseg_list[not_trunk]][point_connect].append((j_connect, jseg))
-                        # clean up the dictionary for trunk
-                        idx = segs_adjacency_nodes[kseg_list[trunk]][point_connect].index((j_connect, jseg))
-                        segs_adjacency_nodes[kseg_list[trunk]][point_connect].pop(idx)
-                        if len(segs_adjacency_nodes[kseg_list[trunk]][point_connect]) == 0:
-                            del segs_adjacency_nodes[kseg_list[trunk]][point_connect]
-                        connectedness[not_trunk] += score
-        distances = [1/c if c > 0 else np.inf for c in connectedness]
-        # distances = [1/(1+c) for c in connectedness]
-        logg.msg('    ', jseg, '-', kseg_list, '->', distances, v=5)
-        return distances
-
-    def establish_new_connections(self, kseg_list, segs, segs_adjacency_nodes):
-        kseg_loop_idx = 0 if len(segs[kseg_list[0]]) < len(segs[kseg_list[1]]) else 1
-        kseg_loop = kseg_list[kseg_loop_idx]
-        kseg_test = kseg_list[0 if kseg_loop_idx == 1 else 1]
-        seg_loop = segs[kseg_loop]
-        seg_test = set(segs[kseg_test])
-        connections = 0
-        for p in seg_loop:
-            p_neighbors = set(self.Ktilde[p].nonzero()[1])
-            for q in p_neighbors:
-                if q in seg_test:
-                    if p not in segs_adjacency_nodes[kseg_loop]:
-                        segs_adjacency_nodes[kseg_loop][p] = []
-                    segs_adjacency_nodes[kseg_loop][p].append((q, kseg_test))
-                    if q not in segs_adjacency_nodes[kseg_test]:
-                        segs_adjacency_nodes[kseg_test][q] = []
-                    segs_adjacency_nodes[kseg_test][q].append((p, kseg_loop))
-        # treat this in a different loop so we can normalize with surface of segment
-        for p, q_list in segs_adjacency_nodes[kseg_loop].items():
-            q_list = [q for q, jseg in q_list if jseg == kseg_test]
-            for q in q_list:
-                # score = 0
-                # if self.Dsq[p, q] > 0: score += 1. / (1 + self.Dsq[p, q])  # / (1 + len(segs_adjacency_nodes[kseg_test]))  # len(seg_test)
-                # if self.Dsq[q, p] > 0: score += 1. / (1 + self.Dsq[q, p])  # / (1 + len(segs_adjacency_nodes[kseg_loop]))  # len(seg_loop)
-                score = 1
-                connections += score
-        # distance = 1/(1+connections)
-        distance = 1/connections if connections > 0 else np.inf
-        logg.msg('    ', kseg_list[0], '-', kseg_list[1], '->', distance, v=5)
-        return distance
+    def get_Dchosen_block(self, rows, cols):
+        """Block `Dchosen[np.ix_(rows, cols)]` without caching rows."""
+        if isinstance(self.Dchosen, data_graph.OnFlySymMatrix):
+            return self.get_Ddiff_block(rows, cols)
+        return self.Dchosen[np.ix_(rows, cols)]
+
+    def get_closest_pair(self, seg_rows, seg_cols, tile_size):
+        """Closest pair of points in `Dchosen` between two segments.
+
+        The distances are evaluated in tiles of at most `tile_size` entries;
+        if `seg_cols` has more points, the tiles are parts of single rows.
+        Among equally close pairs, the first in the order of `seg_rows` and
+        `seg_cols` is chosen.
+
+        Returns
+        -------
+        point_row, point_col, distance
+        """
+        n_cols = max(1, min(tile_size, len(seg_cols)))
+        n_rows = max(1, tile_size // n_cols)
+        closest_pair, closest_distance = (0, 0), np.inf
+        for start in range(0, len(seg_rows), n_rows):
+            rows = seg_rows[start:start+n_rows]
+            for start_cols in range(0, len(seg_cols), n_cols):
+                cols = seg_cols[start_cols:start_cols+n_cols]
+                tile = self.get_Dchosen_block(rows, cols)
+                i, j = np.unravel_index(np.argmin(tile), tile.shape)
+                if tile[i, j] < closest_distance:
+                    closest_pair, closest_distance = (rows[i], cols[j]), tile[i, j]
+        return closest_pair[0], closest_pair[1], closest_distance
+
+    def update_segs_connectivity(self, segs, kseg_list):
+        """Update the number of edges between segments after a split.
+
+        The full matrix is `SᵀAS`, where `A` is the binarized adjacency matrix
+        of the data graph and `S` the sparse indicator matrix of the segments.
+        As `A` is symmetric, only the rows of `S` and `A` that belong to the
+        segments in `kseg_list`, which partition the split segment, are used.
+        """
+        for kseg in kseg_list:
+            self.segs_labels[segs[kseg]] = kseg
+        points = np.concatenate([segs[kseg] for kseg in kseg_list])
+        n_points, n_segs = len(self.segs_labels), len(segs)
+        S = sp.sparse.csr_matrix(
+            (np.ones(n_points), (np.arange(n_points), self.segs_labels)),
+            shape=(n_points, n_segs))
+        counts = S[points].T.dot(self.connectivity_graph[points]).dot(S)
+        counts = counts.toarray()[kseg_list]
+        segs_connectivity = np.zeros((n_segs, n_segs))
+        n_segs_old = self.segs_connectivity.shape[0]
+        segs_connectivity[:n_segs_old, :n_segs_old] = self.segs_connectivity
+        segs_connectivity[kseg_list] = counts
+        segs_connectivity[:, kseg_list] = counts.T
+        self.segs_connectivity = segs_connectivity
 
     def adjust_adjacency(self, iseg, n_add, segs, segs_tips, segs_adjacency,
-                         segs_adjacency_nodes, segs_distances, trunk):
+                         segs_distances):
         prev_connecting_segments = segs_adjacency[iseg].copy()
         segs_adjacency += [[] for i in range(n_add)]
-        segs_adjacency_nodes += [{} for i in range(n_add)]
         kseg_list = list(range(len(segs) - n_add, len(segs))) + [iseg]
-        trunk = len(kseg_list) - 1
+        self.update_segs_connectivity(segs, kseg_list)
         if self.attachedness_measure == 'connectedness':
-            jseg_list = [jseg for jseg in range(len(segs)) if jseg not in kseg_list]
-            for jseg in jseg_list:
-                distances = self.trace_existing_connections(jseg, kseg_list, segs, segs_tips, segs_adjacency_nodes, trunk=trunk)
-                segs_distances[jseg, kseg_list] = distances
-                segs_distances[kseg_list, jseg] = distances
-            distance = self.establish_new_connections(kseg_list, segs, segs_adjacency_nodes)
-            segs_distances[kseg_list[0], kseg_list[1]] = distance
-            segs_distances[kseg_list[1], kseg_list[0]] = distance
+            with np.errstate(divide='ignore'):
+                distances = 1 / self.segs_connectivity[kseg_list]
+            segs_distances[kseg_list] = distances
+            segs_distances[:, kseg_list] = distances.T
+            segs_distances[kseg_list, kseg_list] = 0
         # treat existing connections
         # logg.info('... treat existing connections')
         for jseg in prev_connecting_segments:
             median_distances = []
             if self.attachedness_measure != 'connectedness':
-                result = self.compute_attachedness(jseg, kseg_list, segs, segs_tips, segs_adjacency_nodes)
+                result = self.compute_attachedness(jseg, kseg_list, segs, segs_tips)
                 distances, median_distances, measure_points_in_jseg, measure_points_in_kseg = result
                 segs_distances[jseg, kseg_list] = distances
                 segs_distances[kseg_list, jseg] = distances
@@ -1275,7 +1246,7 @@ class AGA(data_graph.DataGraph):
             jseg_list = [jseg for jseg in range(len(segs))
                          if jseg != kseg and jseg not in segs_adjacency[kseg]]  # prev_connecting_segments]  # if it's a cluster split, this is allowed?
             if self.attachedness_measure != 'connectedness':
-                result = self.compute_attachedness(kseg, jseg_list, segs, segs_tips, segs_adjacency_nodes)
+                result = self.compute_attachedness(kseg, jseg_list, segs, segs_tips)
                 distances, median_distances, measure_points_in_kseg, measure_points_in_jseg = result
                 segs_distances[kseg, jseg_list] = distances
                 segs_distances[jseg_list, kseg] = distances
@@ -1497,7 +1468,7 @@ class AGA(data_graph.DataGraph):
         # where they become correlated
         # at the point where this happens, we define a branching point
         if True:
-            imax = self.kendall_tau_split(Dseg[tips[1]][idcs],
+            imax = kendall_tau_split(Dseg[tips[1]][idcs],
                                           Dseg[tips[2]][idcs])
         if False:
             # if we were in euclidian space, the following should work
@@ -1526,136 +1497,3 @@ class AGA(data_graph.DataGraph):
         # ssegs.append(idcs[ibranch:][dist1 <= dist2])
         # ssegs.append(idcs[ibranch:][dist1 > dist2])
         # return ssegs
-
-    def kendall_tau_split(self, a, b):
-        """Return splitting index that maximizes correlation in the sequences.
-
-        Compute difference in Kendall tau for all splitted sequences.
-
-        For each splitting index i, compute the difference of the two
-        correlation measures kendalltau(a[:i], b[:i]) and
-        kendalltau(a[i:], b[i:]).
-
-        Returns the splitting index that maximizes
-            kendalltau(a[:i], b[:i]) - kendalltau(a[i:], b[i:])
-
-        Parameters
-        ----------
-        a, b : np.ndarray
-            One dimensional sequences.
-
-        Returns
-        -------
-        i : int
-            Splitting index according to above description.
-        """
-        if a.size != b.size:
-            raise ValueError('a and b need to have the same size')
-        if a.ndim != b.ndim != 1:
-            raise ValueError('a and b need to be one-dimensional arrays')
-        import scipy as sp
-        min_length = 5
-        n = a.size
-        idx_range = np.arange(min_length, a.size-min_length-1, dtype=int)
-        corr_coeff = np.zeros(idx_range.size)
-        pos_old = sp.stats.kendalltau(a[:min_length], b[:min_length])[0]
-        neg_old = sp.stats.kendalltau(a[min_length:], b[min_length:])[0]
-        for ii, i in enumerate(idx_range):
-            if True:
-                # compute differences in concordance when adding a[i] and b[i]
-                # to the first subsequence, and removing these elements from
-                # the second subsequence
-                diff_pos, diff_neg = self._kendall_tau_diff(a, b, i)
-                pos = pos_old + self._kendall_tau_add(i, diff_pos, pos_old)
-                neg = neg_old + self._kendall_tau_subtract(n-i, diff_neg, neg_old)
-                pos_old = pos
-                neg_old = neg
-            if False:
-                # computation using sp.stats.kendalltau, takes much longer!
-                # just for debugging purposes
-                pos = sp.stats.kendalltau(a[:i+1], b[:i+1])[0]
-                neg = sp.stats.kendalltau(a[i+1:], b[i+1:])[0]
-            if False:
-                # the following is much slower than using sp.stats.kendalltau,
-                # it is only good for debugging because it allows to compute the
-                # tau-a version, which does not account for ties, whereas
-                # sp.stats.kendalltau computes tau-b version, which accounts for
-                # ties
-                pos = sp.stats.mstats.kendalltau(a[:i], b[:i], use_ties=False)[0]
-                neg = sp.stats.mstats.kendalltau(a[i:], b[i:], use_ties=False)[0]
-            corr_coeff[ii] = pos - neg
-        iimax = np.argmax(corr_coeff)
-        imax = min_length + iimax
-        corr_coeff_max = corr_coeff[iimax]
-        if corr_coeff_max < 0.3:
-            logg.msg('... is root itself, never obtain significant correlation', v=4)
-        return imax
-
-    def _kendall_tau_add(self, len_old, diff_pos, tau_old):
-        """Compute Kendall tau delta.
-
-        The new sequence has length len_old + 1.
-
-        Parameters
-        ----------
-        len_old : int
-            The length of the old sequence, used to compute tau_old.
-        diff_pos : int
-            Difference between concordant and non-concordant pairs.
-        tau_old : float
-            Kendall rank correlation of the old sequence.
-        """
-        return 2./(len_old+1)*(float(diff_pos)/len_old-tau_old)
-
-    def _kendall_tau_subtract(self, len_old, diff_neg, tau_old):
-        """Compute Kendall tau delta.
-
-        The new sequence has length len_old - 1.
-
-        Parameters
-        ----------
-        len_old : int
-            The length of the old sequence, used to compute tau_old.
-        diff_neg : int
-            Difference between concordant and non-concordant pairs.
-        tau_old : float
-            Kendall rank correlation of the old sequence.
-        """
-        return 2./(len_old-2)*(-float(diff_neg)/(len_old-1)+tau_old)
-
-    def _kendall_tau_diff(self, a, b, i):
-        """Compute difference in concordance of pairs in split sequences.
-
-        Consider splitting a and b at index i.
-
-        Parameters
-        ----------
-        a, b : np.ndarray
-
-        Returns
-        -------
-        diff_pos, diff_neg : int, int
-            Difference between concordant and non-concordant pairs for both
-            subsequences.
-        """
-        # compute ordering relation of the single points a[i] and b[i]
-        # with all previous points of the sequences a and b, respectively
-        a_pos = np.zeros(a[:i].size, dtype=int)
-        a_pos[a[:i] > a[i]] = 1
-        a_pos[a[:i] < a[i]] = -1
-        b_pos = np.zeros(b[:i].size, dtype=int)
-        b_pos[b[:i] > b[i]] = 1
-        b_pos[b[:i] < b[i]] = -1
-        diff_pos = np.dot(a_pos, b_pos).astype(float)
-
-        # compute ordering relation of the single points a[i] and b[i]
-        # with all later points of the sequences
-        a_neg = np.zeros(a[i:].size, dtype=int)
-        a_neg[a[i:] > a[i]] = 1
-        a_neg[a[i:] < a[i]] = -1
-        b_neg = np.zeros(b[i:].size, dtype=int)
-        b_neg[b[i:] > b[i]] = 1
-        b_neg[b[i:] < b[i]] = -1
-        diff_neg = np.dot(a_neg, b_neg)
-
-        return diff_pos, diff_neg
@@ -1,8 +1,10 @@
 from ..tools import dpt
 from .. import settings
+from .. import utils
 from .. import logging as logg
 
 
+@utils.check_float_dtype
 def diffmap(adata, n_comps=15, n_neighbors=None, knn=True, n_pcs=50, sigma=0,
             n_jobs=None, flavor='haghverdi16', copy=False):
     """Diffusion Maps [Coifman05]_ [Haghverdi15]_ [Wolf17]_.
@@ -7,10 +7,12 @@ import scipy as sp
 import networkx as nx
 from natsort import natsorted
 from .. import settings
+from .. import utils
 from .. import logging as logg
 from ..data_structs import data_graph
 
 
+@utils.check_float_dtype
 def dpt(adata, n_branchings=0, n_neighbors=None, knn=True, n_pcs=50, n_dcs=10,
         min_group_size=0.01, recompute_graph=False, recompute_pca=False,
         allow_kendall_tau_shift=True, flavor='haghverdi16', n_jobs=None,
@@ -760,7 +762,7 @@ class DPT(data_graph.DataGraph):
         # where they become correlated
         # at the point where this happens, we define a branching point
         if True:
-            imax = self.kendall_tau_split(Dseg[tips[1]][idcs],
+            imax = kendall_tau_split(Dseg[tips[1]][idcs],
                                           Dseg[tips[2]][idcs])
         if False:
             # if we were in euclidian space, the following should work
@@ -787,135 +789,148 @@ class DPT(data_graph.DataGraph):
             ibranch = imax + 1
         return idcs[:ibranch]
 
-    def kendall_tau_split(self, a, b):
-        """Return splitting index that maximizes correlation in the sequences.
 
-        Compute difference in Kendall tau for all splitted sequences.
+def kendall_tau_split(a, b, min_length=5):
+    """Return splitting index that maximizes correlation in the sequences.
 
-        For each splitting index i, compute the difference of the two
-        correlation measures kendalltau(a[:i], b[:i]) and
-        kendalltau(a[i:], b[i:]).
+    Compute difference in Kendall tau for all splitted sequences.
 
-        Returns the splitting index that maximizes
-            kendalltau(a[:i], b[:i]) - kendalltau(a[i:], b[i:])
+    For each splitting index i, compute the difference of the two
+    correlation measures kendalltau(a[:i], b[:i]) and
+    kendalltau(a[i:], b[i:]).
 
-        Parameters
-        ----------
-        a, b : np.ndarray
-            One dimensional sequences.
+    Returns the splitting index that maximizes
+        kendalltau(a[:i], b[:i]) - kendalltau(a[i:], b[i:])
 
-        Returns
-        -------
-        i : int
-            Splitting index according to above description.
-        """
-        if a.size != b.size:
-            raise ValueError('a and b need to have the same size')
-        if a.ndim != b.ndim != 1:
-            raise ValueError('a and b need to be one-dimensional arrays')
-        import scipy as sp
-        min_length = 5
-        n = a.size
-        idx_range = np.arange(min_length, a.size-min_length-1, dtype=int)
-        corr_coeff = np.zeros(idx_range.size)
-        pos_old = sp.stats.kendalltau(a[:min_length], b[:min_length])[0]
-        neg_old = sp.stats.kendalltau(a[min_length:], b[min_length:])[0]
-        for ii, i in enumerate(idx_range):
-            if True:
-                # compute differences in concordance when adding a[i] and b[i]
-                # to the first subsequence, and removing these elements from
-                # the second subsequence
-                diff_pos, diff_neg = self._kendall_tau_diff(a, b, i)
-                pos = pos_old + self._kendall_tau_add(i, diff_pos, pos_old)
-                neg = neg_old + self._kendall_tau_subtract(n-i, diff_neg, neg_old)
-                pos_old = pos
-                neg_old = neg
-            if False:
-                # computation using sp.stats.kendalltau, takes much longer!
-                # just for debugging purposes
-                pos = sp.stats.kendalltau(a[:i+1], b[:i+1])[0]
-                neg = sp.stats.kendalltau(a[i+1:], b[i+1:])[0]
-            if False:
-                # the following is much slower than using sp.stats.kendalltau,
-                # it is only good for debugging because it allows to compute the
-                # tau-a version, which does not account for ties, whereas
-                # sp.stats.kendalltau computes tau-b version, which accounts for
-                # ties
-                pos = sp.stats.mstats.kendalltau(a[:i], b[:i], use_ties=False)[0]
-                neg = sp.stats.mstats.kendalltau(a[i:], b[i:], use_ties=False)[0]
-            corr_coeff[ii] = pos - neg
-        iimax = np.argmax(corr_coeff)
-        imax = min_length + iimax
-        corr_coeff_max = corr_coeff[iimax]
-        if corr_coeff_max < 0.3:
-            logg.m('    is root itself, never obtain significant correlation', v=4)
-        return imax
-
-    def _kendall_tau_add(self, len_old, diff_pos, tau_old):
-        """Compute Kendall tau delta.
-
-        The new sequence has length len_old + 1.
+    The changes in concordance when moving a single element from the second
+    to the first subsequence are computed for all splitting indices at once
+    in O(n log² n), see `_get_concordance_with_previous`.
 
-        Parameters
-        ----------
-        len_old : int
-            The length of the old sequence, used to compute tau_old.
-        diff_pos : int
-            Difference between concordant and non-concordant pairs.
-        tau_old : float
-            Kendall rank correlation of the old sequence.
-        """
-        return 2./(len_old+1)*(float(diff_pos)/len_old-tau_old)
+    Parameters
+    ----------
+    a, b : np.ndarray
+        One dimensional sequences.
+    min_length : int, optional (default: 5)
+        Minimal length of the subsequences.
 
-    def _kendall_tau_subtract(self, len_old, diff_neg, tau_old):
-        """Compute Kendall tau delta.
+    Returns
+    -------
+    i : int
+        Splitting index according to above description.
+    """
+    if a.size != b.size:
+        raise ValueError('a and b need to have the same size')
+    if a.ndim != b.ndim != 1:
+        raise ValueError('a and b need to be one-dimensional arrays')
+    n = a.size
+    idx_range = np.arange(min_length, a.size-min_length-1, dtype=int)
+    corr_coeff = np.zeros(idx_range.size)
+    # differences in concordance when adding a[i] and b[i] to the first
+    # subsequence, and removing these elements from the second subsequence
+    diffs_pos = _get_concordance_with_previous(a, b)
+    diffs_neg = _get_concordance_with_previous(a[::-1], b[::-1])[::-1]
+    pos_old = sp.stats.kendalltau(a[:min_length], b[:min_length])[0]
+    neg_old = sp.stats.kendalltau(a[min_length:], b[min_length:])[0]
+    for ii, i in enumerate(idx_range):
+        pos = pos_old + _kendall_tau_add(i, diffs_pos[i], pos_old)
+        neg = neg_old + _kendall_tau_subtract(n-i, diffs_neg[i], neg_old)
+        pos_old = pos
+        neg_old = neg
+        corr_coeff[ii] = pos - neg
+    iimax = np.argmax(corr_coeff)
+    imax = min_length + iimax
+    corr_coeff_max = corr_coeff[iimax]
+    if corr_coeff_max < 0.3:
+        logg.m('    is root itself, never obtain significant correlation', v=4)
+    return imax
+
+
+def _kendall_tau_add(len_old, diff_pos, tau_old):
+    """Compute Kendall tau delta.
+
+    The new sequence has length len_old + 1.
 
-        The new sequence has length len_old - 1.
+    Parameters
+    ----------
+    len_old : int
+        The length of the old sequence, used to compute tau_old.
+    diff_pos : int
+        Difference between concordant and non-concordant pairs.
+    tau_old : float
+        Kendall rank correlation of the old sequence.
+    """
+    return 2./(len_old+1)*(float(diff_pos)/len_old-tau_old)
 
-        Parameters
-        ----------
-        len_old : int
-            The length of the old sequence, used to compute tau_old.
-        diff_neg : int
-            Difference between concordant and non-concordant pairs.
-        tau_old : float
-            Kendall rank correlation of the old sequence.
-        """
-        return 2./(len_old-2)*(-float(diff_neg)/(len_old-1)+tau_old)
 
-    def _kendall_tau_diff(self, a, b, i):
-        """Compute difference in concordance of pairs in split sequences.
+def _kendall_tau_subtract(len_old, diff_neg, tau_old):
+    """Compute Kendall tau delta.
 
-        Consider splitting a and b at index i.
+    The new sequence has length len_old - 1.
 
-        Parameters
-        ----------
-        a, b : np.ndarray
+    Parameters
+    ----------
+    len_old : int
+        The length of the old sequence, used to compute tau_old.
+    diff_neg : int
+        Difference between concordant and non-concordant pairs.
+    tau_old : float
+        Kendall rank correlation of the old sequence.
+    """
+    return 2./(len_old-2)*(-float(diff_neg)/(len_old-1)+tau_old)
+
+
+def _get_concordance_with_previous(a, b):
+    """Difference between concordant and discordant pairs of each element
+    with all previous elements.
+
+    Returns, for each i, the sum over j < i of
+    sign(a[j] - a[i]) * sign(b[j] - b[i]).
+
+    As in a Fenwick tree, the previous elements of i are the union of dyadic
+    blocks of positions. For each size of blocks, the left halves of the
+    blocks are compared with the right halves at once: comparisons in `a`
+    are resolved bit by bit of the ranks of `a`, as in a wavelet tree,
+    comparisons in `b` by binary search in the sorted ranks of `b`. This
+    takes O(n log² n) in vectorized operations.
+
+    Parameters
+    ----------
+    a, b : np.ndarray
+        One dimensional sequences of the same length.
+
+    Returns
+    -------
+    diffs : np.ndarray
+        Integer array of the length of `a`.
+    """
+    n = a.size
+    diffs = np.zeros(n, dtype=np.int64)
+    if n < 2: return diffs
+    a_ranks = np.unique(a, return_inverse=True)[1].ravel().astype(np.int64)
+    b_ranks = np.unique(b, return_inverse=True)[1].ravel().astype(np.int64)
+    n_b = b_ranks.max() + 2
+    n_bits_a = max(1, int(a_ranks.max()).bit_length())
+    positions = np.arange(n)
+    for level in range((n - 1).bit_length()):
+        halves = positions >> level
+        is_right = (halves & 1).astype(bool)
+        blocks = halves >> 1
+        left, right = ~is_right, is_right
+        for bit in range(n_bits_a):
+            prefixes = a_ranks >> (bit + 1)
+            bits = (a_ranks >> bit) & 1
+            n_prefixes = (a_ranks.max() >> (bit + 1)) + 1
+            groups = (blocks * n_prefixes + prefixes) * 2 + bits
+            keys = np.sort(groups[left] * n_b + b_ranks[left])
+            # elements of the left half that share the prefix but differ in
+            # this bit of the rank in `a`
+            starts = (groups[right] ^ 1) * n_b
+            n_less = (np.searchsorted(keys, starts + b_ranks[right])
+                      - np.searchsorted(keys, starts))
+            n_greater = (np.searchsorted(keys, starts + n_b)
+                         - np.searchsorted(keys, starts + b_ranks[right], side='right'))
+            # a[j] < a[i] if the bit of i is set, otherwise a[j] > a[i]
+            signs = 2 * bits[right] - 1
+            diffs[right] += signs * (n_less - n_greater)
+    return diffs
 
-        Returns
-        -------
-        diff_pos, diff_neg : int, int
-            Difference between concordant and non-concordant pairs for both
-            subsequences.
-        """
-        # compute ordering relation of the single points a[i] and b[i]
-        # with all previous points of the sequences a and b, respectively
-        a_pos = np.zeros(a[:i].size, dtype=int)
-        a_pos[a[:i] > a[i]] = 1
-        a_pos[a[:i] < a[i]] = -1
-        b_pos = np.zeros(b[:i].size, dtype=int)
-        b_pos[b[:i] > b[i]] = 1
-        b_pos[b[:i] < b[i]] = -1
-        diff_pos = np.dot(a_pos, b_pos).astype(float)
-
-        # compute ordering relation of the single points a[i] and b[i]
-        # with all later points of the sequences
-        a_neg = np.zeros(a[i:].size, dtype=int)
-        a_neg[a[i:] > a[i]] = 1
-        a_neg[a[i:] < a[i]] = -1
-        b_neg = np.zeros(b[i:].size, dtype=int)
-        b_neg[b[i:] > b[i]] = 1
-        b_neg[b[i:] < b[i]] = -1
-        diff_neg = np.dot(a_neg, b_neg)
-
-        return diff_pos, diff_neg
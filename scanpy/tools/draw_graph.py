@@ -15,12 +15,14 @@ from .. import logging as logg
 from ..data_structs.data_graph import add_or_update_graph_in_adata
 
 
+@utils.check_float_dtype
 def draw_graph(adata,
                layout='fr',
                root=None,
                n_neighbors=None,
                n_pcs=None,
                random_state=0,
+               init_pos=None,
                recompute_pca=False,
                recompute_distances=False,
                recompute_graph=False,
@@ -38,6 +40,13 @@ def draw_graph(adata,
     default, the Fruchterman & Reingold [Fruchterman91]_ algorithm is used; many
     other layouts are available. Uses the igraph implementation [Csardi06]_.
 
+    Layout 'fa' is an in-tree ForceAtlas2 [Jacomy14]_ with Barnes-Hut
+    approximation of repulsion [Barnes86]_ that does not need igraph. Its cost
+    per iteration is O(n log n) instead of O(n²), it uses `n_jobs` threads and
+    stops early once the layout has converged. This makes it suitable for
+    hundreds of thousands of cells, in particular when initialized with
+    `init_pos`. Edge weights are rescaled to have mean 1.
+
     Parameters
     ----------
     adata : :class:`~scanpy.api.AnnData`
@@ -48,7 +57,8 @@ def draw_graph(adata,
         are 'fr' (Fruchterman Reingold), 'grid_fr' (Grid Fruchterman Reingold,
         faster than 'fr'), 'kk' (Kamadi Kawai', slower than 'fr'), 'lgl' (Large
         Graph, very fast), 'drl' (Distributed Recursive Layout, pretty fast) and
-        'rt' (Reingold Tilford tree layout).
+        'rt' (Reingold Tilford tree layout). In addition, 'fa' (ForceAtlas2,
+        in-tree, see above).
     n_neighbors : `int` or `None` (default: `None`)
         Number of nearest neighbors in graph.
     n_pcs : `int` or `None` (default: `None`)
@@ -56,9 +66,18 @@ def draw_graph(adata,
     random_state : `int` or `None`, optional (default: 0)
         For layouts with random initialization like 'fr', change this to use
         different intial states for the optimization. If `None`, no seed is set.
+    init_pos : {'X_pca', 'X_diffmap', 'coarse'}, `np.ndarray` or `None`, optional (default: `None`)
+        Initial positions for the layouts 'fa', 'fr', 'drl', 'kk' and
+        'grid_fr'. Either the first two components of a representation in
+        `adata.obsm`, 'coarse' for the positions of the clusters of
+        `multilevel` modularity optimization laid out as a graph, or an array
+        of shape `n_obs × 2`. Random if `None`.
     **kwargs : further parameters
         Parameters of chosen igraph algorithm. See, e.g.,
         http://igraph.org/python/doc/igraph.Graph-class.html#layout_fruchterman_reingold.
+        For 'fa', parameters of the ForceAtlas2 algorithm, e.g., `max_iter`
+        (default: 500), `scaling_ratio` (default: 2), `gravity` (default: 1)
+        and `theta` (default: 1.2).
     n_jobs : `int` or `None` (default: `sc.settings.n_jobs`)
         Number of jobs.
     copy : `bool` (default: `False`)
@@ -73,7 +92,7 @@ def draw_graph(adata,
     """
     logg.info('drawing single-cell graph using layout "{}"'.format(layout),
               r=True)
-    avail_layouts = {'fr', 'drl', 'kk', 'grid_fr', 'lgl', 'rt', 'rt_circular'}
+    avail_layouts = {'fr', 'drl', 'kk', 'grid_fr', 'lgl', 'rt', 'rt_circular', 'fa'}
     if layout not in avail_layouts:
         raise ValueError('Provide a valid layout, one of {}.'.format(avail_layouts))
     adata = adata.copy() if copy else adata
@@ -86,25 +105,74 @@ def draw_graph(adata,
         recompute_graph=recompute_graph,
         n_jobs=n_jobs)
     adjacency = adata.uns['data_graph_norm_weights']
-    g = utils.get_igraph_from_adjacency(adjacency)
-    if layout in {'fr', 'drl', 'kk', 'grid_fr'}:
+    if init_pos is not None:
+        init_coords = _get_init_coords(adata, init_pos, adjacency, random_state)
+    elif layout == 'fa':
+        init_coords = None
+    else:
         np.random.seed(random_state)
-        init_coords = np.random.random((adjacency.shape[0], 2)).tolist()
-        ig_layout = g.layout(layout,  # weights='weight',
-                             seed=init_coords, **kwargs)
-    elif 'rt' in layout:
-        if root is not None: root = [root]
-        ig_layout = g.layout(layout, root=root, **kwargs)
+        init_coords = np.random.random((adjacency.shape[0], 2))
+    if layout == 'fa':
+        from ._force_atlas2 import force_atlas2
+        n_jobs = settings.n_jobs if n_jobs is None else n_jobs
+        # the normalized weights are small, rescale them relative to repulsion
+        coords = force_atlas2(adjacency / adjacency.data.mean(),
+                              init_coords=init_coords,
+                              n_jobs=n_jobs, random_state=random_state, **kwargs)
     else:
-        ig_layout = g.layout(layout, **kwargs)
+        g = utils.get_igraph_from_adjacency(adjacency)
+        if layout in {'fr', 'drl', 'kk', 'grid_fr'}:
+            ig_layout = g.layout(layout,  # weights='weight',
+                                 seed=init_coords.tolist(), **kwargs)
+        elif 'rt' in layout:
+            if root is not None: root = [root]
+            ig_layout = g.layout(layout, root=root, **kwargs)
+        else:
+            ig_layout = g.layout(layout, **kwargs)
+        coords = ig_layout.coords
     adata.uns['draw_graph_params'] = np.array(
         (layout, random_state,),
         dtype=[('layout', 'U20'), ('random_state', int)])
     obs_key = 'X_draw_graph_' + layout
-    adata.obsm[obs_key] = np.array(ig_layout.coords)
+    adata.obsm[obs_key] = np.array(coords, dtype=settings.float_dtype)
     logg.info('    finished', time=True, end=' ' if settings.verbosity > 2 else '\n')
     logg.hint('added\n'
               '    \'{}\', graph_drawing coordinates (adata.obs)\n'
               '    \'draw_graph_params\', the parameters (adata.uns)'
               .format(obs_key))
     return adata if copy else None
+
+
+def _get_init_coords(adata, init_pos, adjacency, random_state):
+    """Initial positions, scaled to the typical size of a ForceAtlas2 layout."""
+    n_obs = adjacency.shape[0]
+    if isinstance(init_pos, str) and init_pos == 'coarse':
+        from scipy.sparse import csr_matrix
+        from ._multilevel import multilevel
+        from ._force_atlas2 import force_atlas2
+        labels = multilevel(adjacency, random_state=random_state)
+        n_clusters = labels.max() + 1
+        membership = csr_matrix((np.ones(n_obs), (np.arange(n_obs), labels)),
+                                shape=(n_obs, n_clusters))
+        coarse_adjacency = membership.T.dot(adjacency).dot(membership)
+        coarse_coords = force_atlas2(coarse_adjacency, random_state=random_state)
+        # spread the cells of a cluster around its position
+        sizes = np.bincount(labels)
+        jitter = np.random.RandomState(random_state).randn(n_obs, 2)
+        # a single cluster has no spread
+        radii = 0.05 * max(coarse_coords.std(), 1) * np.sqrt(sizes / sizes.max())
+        coords = coarse_coords[labels] + radii[labels, None] * jitter
+    elif isinstance(init_pos, str):
+        if init_pos not in adata.obsm_keys():
+            raise ValueError('Did not find \'{}\' in adata.obsm, compute it first '
+                             'or use \'coarse\'.'.format(init_pos))
+        coords = adata.obsm[init_pos][:, :2]
+    else:
+        coords = init_pos
+    coords = np.array(coords, dtype=np.float64)
+    if coords.shape != (n_obs, 2):
+        raise ValueError('`init_pos` needs to have shape {}, not {}.'
+                         .format((n_obs, 2), coords.shape))
+    coords -= coords.mean(axis=0)
+    std = coords.std()
+    return coords / std * np.sqrt(n_obs) * 10 if std > 0 else coords
@@ -10,15 +10,19 @@ from .. import utils
 from .. import settings
 from .. import logging as logg
 from ..data_structs.data_graph import add_or_update_graph_in_adata
+from ._multilevel import multilevel
 
 
+@utils.check_float_dtype
 def louvain(
         adata,
         n_neighbors=None,
         resolution=None,
+        resolutions=None,
         n_pcs=50,
         random_state=0,
         restrict_to=None,
+        restrict_each=False,
         key_added=None,
         flavor='vtraag',
         directed=True,
@@ -32,7 +36,8 @@ def louvain(
 
     Cluster cells using the Louvain algorithm [Blondel08]_ in the implementation
     of [Traag17]_. The Louvain algorithm has been proposed for single-cell
-    analysis by [Levine15]_.
+    analysis by [Levine15]_. With `flavor='multilevel'`, a refinement step
+    similar to the one of [Traag18]_ ensures connected clusters.
 
     Parameters
     ----------
@@ -41,9 +46,16 @@ def louvain(
     n_neighbors : `int`, optional (default: 30)
         Number of neighbors to use for construction of knn graph.
     resolution : `float` or `None`, optional (default: 1)
-        For the default flavor ('vtraag'), you can provide a resolution (higher
+        For the flavors 'vtraag' and 'multilevel', you can provide a resolution (higher
         resolution means finding more and smaller clusters), which defaults to
         1.0.
+    resolutions : list of `float` or `None`, optional (default: `None`)
+        Sweep these resolutions instead of using `resolution`. The graph is
+        built once and the partitions are computed in parallel processes
+        (`n_jobs`) that share its edge arrays. Stores the labels of each
+        resolution and, as `key_added`, the most stable labels, namely,
+        those with the highest mean adjusted Rand index (ARI) with the other
+        labelings. Only for flavors 'vtraag' and 'multilevel'.
     n_pcs : int, optional (default: 50)
         Number of PCs to use for computation of data point graph.
     random_state : int, optional (default: 0)
@@ -53,9 +65,16 @@ def louvain(
     restrict_to : tuple, optional (default: None)
         Restrict the clustering to the categories within the key for sample
         annotation, tuple needs to contain (obs key, list of categories).
-    flavor : {'vtraag', 'igraph'}
+    restrict_each : `bool`, optional (default: `False`)
+        Cluster the cells of each category of `restrict_to` separately
+        instead of jointly. The categories are clustered in parallel processes
+        (`n_jobs`), e.g., to sub-cluster many clusters at once.
+    flavor : {'vtraag', 'igraph', 'multilevel'}
         Choose between to packages for computing the clustering. 'vtraag' is
-        much more powerful.
+        much more powerful. 'multilevel' uses the in-tree multilevel
+        modularity optimization on the sparse adjacency matrix, which needs
+        no additional package, scales to millions of cells and guarantees
+        connected clusters. It treats the graph as undirected.
     copy : `bool` (default: False)
         Copy adata or modify it inplace.
 
@@ -66,6 +85,12 @@ def louvain(
     louvain_groups : `pd.Series` (``adata.obs``, dtype `category`)
         Array of dim (number of samples) that stores the subgroup id ('0',
         '1', ...) for each cell.
+    louvain_groups_{resolution} : `pd.Series` (``adata.obs``, dtype `category`)
+        If `resolutions` is passed, the subgroup ids for each resolution.
+    louvain_groups_resolutions, louvain_groups_ari, louvain_groups_stability : `np.ndarray` (``adata.uns``)
+        If `resolutions` is passed, the resolutions, the matrix of pairwise
+        ARIs of their labelings and the mean ARI of each labeling with the
+        other labelings.
     """
     logg.info('running Louvain clustering', r=True)
     adata = adata.copy() if copy else adata
@@ -85,36 +110,60 @@ def louvain(
             raise ValueError('You need to use strings to label categories, '
                              'e.g. \'1\' instead of 1.')
         restrict_indices = adata.obs[restrict_key].isin(restrict_categories).values
-        adjacency = adjacency[restrict_indices, :]
-        adjacency = adjacency[:, restrict_indices]
-    if flavor in {'vtraag', 'igraph'}:
+        if not restrict_each:
+            adjacency = utils.get_induced_subgraph(adjacency, restrict_indices)
+    elif restrict_each:
+        raise ValueError('`restrict_each` requires `restrict_to`.')
+    if restrict_each:
+        if resolutions is not None or flavor == 'taynaud':
+            raise ValueError('`restrict_each` cannot be combined with `resolutions` '
+                             'or flavor "taynaud".')
+        from joblib import Parallel, delayed
+        group_index = utils.GroupIndex.from_adata(adata, restrict_key, restrict_categories)
+        logg.info('    clustering {} categories separately'.format(group_index.n_groups))
+        n_jobs = settings.n_jobs if n_jobs is None else n_jobs
+        groups_list = Parallel(n_jobs=min(n_jobs, group_index.n_groups))(
+            delayed(_get_partition_of_subgraph)(
+                utils.get_induced_subgraph(adjacency, group_index.indices(igroup)),
+                flavor, directed, resolution, random_state)
+            for igroup in range(group_index.n_groups))
+        # sub-clusters are numbered from 1 within each category
+        groups = np.zeros(adata.n_obs, dtype=int)
+        for igroup, groups_category in enumerate(groups_list):
+            groups[group_index.indices(igroup)] = groups_category + 1
+    elif resolutions is not None:
+        if flavor not in {'vtraag', 'multilevel'}:
+            raise ValueError('`resolutions` requires flavor "vtraag" or "multilevel".')
+        from joblib import Parallel, delayed
+        if not directed: logg.m('    using the undirected graph', v=4)
+        logg.info('    sweeping {} resolutions'.format(len(resolutions)))
+        n_jobs = settings.n_jobs if n_jobs is None else n_jobs
+        # the edge arrays are memory-mapped into the worker processes
+        if flavor == 'multilevel':
+            tasks = (delayed(multilevel)(adjacency, resolution, random_state)
+                     for resolution in resolutions)
+        else:
+            edges = utils.get_edges_from_adjacency(adjacency, directed=directed)
+            tasks = (delayed(_get_partition_from_edges)(
+                adjacency.shape[0], edges, directed, resolution, random_state)
+                     for resolution in resolutions)
+        groups_list = Parallel(n_jobs=min(n_jobs, len(resolutions)))(tasks)
+        ari = _get_adjusted_rand_indices(groups_list)
+        stability = ((ari.sum(axis=1) - 1) / (len(resolutions) - 1)
+                     if len(resolutions) > 1 else np.ones(1))
+        groups = groups_list[np.argmax(stability)]
+        resolution = resolutions[np.argmax(stability)]
+    elif flavor in {'vtraag', 'igraph'}:
         if flavor == 'igraph' and resolution is not None:
             logg.warn('`resolution` parameter has no effect for flavor "igraph"')
         if directed and flavor == 'igraph':
             directed = False
         if not directed: logg.m('    using the undirected graph', v=4)
         g = utils.get_igraph_from_adjacency(adjacency, directed=directed)
-        if flavor == 'vtraag':
-            import louvain
-            if resolution is None: resolution = 1
-            try:
-                logg.info('    using the "louvain" package of Traag (2017)')
-                louvain.set_rng_seed(random_state)
-                part = louvain.find_partition(g, louvain.RBConfigurationVertexPartition,
-                                              resolution_parameter=resolution)
-                # adata.uns['louvain_quality'] = part.quality()
-            except AttributeError:
-                logg.warn('Did not find package louvain>=0.6, '
-                          'the clustering result will therefore not '
-                          'be 100% reproducible, '
-                          'but still meaningful. '
-                          'If you want 100% reproducible results, '
-                          'update via "pip install louvain --upgrade".')
-                part = louvain.find_partition(g, method='RBConfiguration',
-                                              resolution_parameter=resolution)
-        elif flavor == 'igraph':
-            part = g.community_multilevel()
-        groups = np.array(part.membership)
+        groups = _get_partition(g, flavor, resolution, random_state)
+    elif flavor == 'multilevel':
+        groups = multilevel(adjacency, 1 if resolution is None else resolution,
+                            random_state)
     elif flavor == 'taynaud':
         # this is deprecated
         import networkx as nx
@@ -124,28 +173,131 @@ def louvain(
         groups = np.zeros(len(partition), dtype=int)
         for k, v in partition.items(): groups[k] = v
     else:
-        raise ValueError('`flavor` needs to be "vtraag" or "igraph" or "taynaud".')
-    unique_groups = np.unique(groups)
-    n_clusters = len(unique_groups)
+        raise ValueError('`flavor` needs to be "vtraag", "igraph", "multilevel" or "taynaud".')
     if restrict_to is None:
-        groups = groups.astype('U')
         key_added = 'louvain_groups' if key_added is None else key_added
-        adata.obs[key_added] = pd.Categorical(
-            values=groups,
-            categories=natsorted(unique_groups.astype('U')))
+        restrict_key = None
     else:
         key_added = restrict_key + '_R' if key_added is None else key_added
-        groups += 1
-        adata.obs[key_added] = adata.obs[restrict_key].astype('U')
-        adata.obs[key_added] += ','
-        adata.obs[key_added].iloc[restrict_indices] += groups.astype('U')
-        adata.obs[key_added].iloc[~restrict_indices] += '0'
-        adata.obs[key_added] = adata.obs[key_added].astype(
-            'category', categories=natsorted(adata.obs[key_added].unique()))
+    if restrict_to is not None and not restrict_each:
+        groups = _expand_groups(groups, restrict_indices)
+        if resolutions is not None:
+            groups_list = [_expand_groups(g, restrict_indices) for g in groups_list]
+    n_clusters = len(np.unique(groups))
+    _add_groups(adata, groups, key_added, restrict_key)
+    if resolutions is not None:
+        for groups_resolution, resolution_ in zip(groups_list, resolutions):
+            _add_groups(adata, groups_resolution, '{}_{}'.format(key_added, resolution_),
+                        restrict_key)
+        adata.uns[key_added + '_resolutions'] = np.array(resolutions, dtype=float)
+        adata.uns[key_added + '_ari'] = ari
+        adata.uns[key_added + '_stability'] = stability
     adata.uns['louvain_params'] = np.array((resolution, random_state,),
                                            dtype=[('resolution', float), ('random_state', int)])
     logg.info('    finished', time=True, end=' ' if settings.verbosity > 2 else '\n')
     logg.hint('found {} clusters and added\n'
               '    \'{}\', the cluster labels (adata.obs, dtype=category)'
               .format(n_clusters, key_added))
+    if resolutions is not None:
+        logg.hint('    \'{0}_{{resolution}}\', the labels of each resolution (adata.obs)\n'
+                  '    \'{0}_ari\', \'{0}_stability\', pairwise ARIs and their means (adata.uns)'
+                  .format(key_added))
     return adata if copy else None
+
+
+def _get_partition(g, flavor, resolution, random_state):
+    """Cluster labels of the vertices of the igraph graph `g`."""
+    if flavor == 'vtraag':
+        import louvain
+        if resolution is None: resolution = 1
+        try:
+            logg.info('    using the "louvain" package of Traag (2017)')
+            louvain.set_rng_seed(random_state)
+            part = louvain.find_partition(g, louvain.RBConfigurationVertexPartition,
+                                          resolution_parameter=resolution)
+            # adata.uns['louvain_quality'] = part.quality()
+        except AttributeError:
+            logg.warn('Did not find package louvain>=0.6, '
+                      'the clustering result will therefore not '
+                      'be 100% reproducible, '
+                      'but still meaningful. '
+                      'If you want 100% reproducible results, '
+                      'update via "pip install louvain --upgrade".')
+            part = louvain.find_partition(g, method='RBConfiguration',
+                                          resolution_parameter=resolution)
+    else:
+        part = g.community_multilevel()
+    return np.array(part.membership)
+
+
+def _get_partition_from_edges(n_vertices, edges, directed, resolution, random_state):
+    """Build the graph from edge arrays and cluster it, runs in a worker process."""
+    g = utils.get_igraph_from_edges(n_vertices, *edges, directed=directed)
+    return _get_partition(g, 'vtraag', resolution, random_state)
+
+
+def _get_partition_of_subgraph(adjacency, flavor, directed, resolution, random_state):
+    """Cluster labels of a restricted adjacency matrix, runs in a worker process."""
+    if flavor == 'multilevel':
+        return multilevel(adjacency, 1 if resolution is None else resolution, random_state)
+    if flavor == 'igraph':
+        directed = False
+    edges = utils.get_edges_from_adjacency(adjacency, directed=directed)
+    g = utils.get_igraph_from_edges(adjacency.shape[0], *edges, directed=directed)
+    return _get_partition(g, flavor, resolution, random_state)
+
+
+def _expand_groups(groups, restrict_indices):
+    """Labels of all cells, numbered from 1 for the restricted cells and 0 else."""
+    groups_all = np.zeros(len(restrict_indices), dtype=int)
+    groups_all[restrict_indices] = groups + 1
+    return groups_all
+
+
+def _add_groups(adata, groups, key_added, restrict_key=None):
+    """Add cluster labels as categorical annotation to `adata.obs`.
+
+    With `restrict_key`, labels are 'category,group' and computed from the
+    codes of `adata.obs[restrict_key]` and `groups` without building strings
+    for each cell.
+    """
+    if restrict_key is None:
+        adata.obs[key_added] = pd.Categorical(
+            values=groups.astype('U'),
+            categories=natsorted(np.unique(groups).astype('U')))
+        return
+    parents = pd.Categorical(adata.obs[restrict_key])
+    n_groups = groups.max() + 1
+    combined, codes = np.unique(parents.codes.astype(np.int64) * n_groups + groups,
+                                return_inverse=True)
+    names = ['{},{}'.format(parents.categories[c // n_groups], c % n_groups)
+             for c in combined]
+    order = natsorted(range(len(names)), key=lambda i: names[i])
+    ranks = np.empty(len(names), dtype=int)
+    ranks[order] = np.arange(len(names))
+    adata.obs[key_added] = pd.Categorical.from_codes(
+        ranks[codes], categories=[names[i] for i in order])
+
+
+def _get_adjusted_rand_indices(labelings):
+    """Matrix of adjusted Rand indices between all pairs of labelings.
+
+    Each index is computed from a contingency table obtained by a single
+    `np.bincount` over the observations.
+    """
+    codes = [np.unique(labels, return_inverse=True)[1] for labels in labelings]
+    n_obs = len(codes[0])
+    def comb2(n):
+        return (n * (n - 1) / 2).sum()
+    sums = [comb2(np.bincount(c).astype(np.float64)) for c in codes]
+    ari = np.ones((len(codes), len(codes)))
+    for i in range(len(codes)):
+        for j in range(i + 1, len(codes)):
+            n_j = codes[j].max() + 1
+            contingency = np.bincount(codes[i] * n_j + codes[j]).astype(np.float64)
+            index = comb2(contingency)
+            expected = sums[i] * sums[j] / comb2(np.array([n_obs], dtype=np.float64))
+            maximum = (sums[i] + sums[j]) / 2
+            ari[i, j] = ari[j, i] = (
+                1. if maximum == expected else (index - expected) / (maximum - expected))
+    return ari
@@ -4,8 +4,6 @@
 """
 
 import numpy as np
-import pandas as pd
-from math import sqrt, floor
 from scipy.sparse import issparse
 
 from .. import utils
@@ -14,6 +12,7 @@ from .. import logging as logg
 from ..preprocessing import simple
 
 
+@utils.check_float_dtype
 def rank_genes_groups(
         adata,
         group_by,
@@ -25,7 +24,9 @@ def rank_genes_groups(
         only_positive=True,
         copy=False,
         test_type='t-test_overestim_var',
-        correction_factors=None):
+        correction_factors=None,
+        n_jobs=None,
+        block_size=10000000):
     """Rank genes according to differential expression [Wolf17]_.
 
     Rank genes by differential expression. By default, a t-test-like ranking is
@@ -45,7 +46,9 @@ def rank_genes_groups(
         groups.
     reference : `str`, optional (default: `'rest'`)
         If `'rest'`, compare each group to the union of the rest of the group.  If
-        a group identifier, compare with respect to this group.
+        a group identifier, compare with respect to this group. If
+        `'pairwise'`, compare each group with each other group, computing the
+        group statistics, or ranks for 'wilcoxon', only once.
     n_genes : `int`, optional (default: 100)
         The number of genes that appear in the returned tables.
     test_type : {'t-test_overestim_var', 't-test', 'wilcoxon', , 't-test_double_overestim_var',
@@ -60,6 +63,17 @@ def rank_genes_groups(
     correction_factors: [a,b], optional (default: None)
         Only for the test-type 't-test_correction_factors'. Then, a determines correction factor for group variance,
         b determines correction factor for variance of the comparison group
+    n_jobs : `int` or `None`, optional (default: `None`)
+        Number of processes for ranking blocks of genes with 'wilcoxon'
+        (default: `sc.settings.n_jobs`).
+    block_size : `int`, optional (default: 10000000)
+        Maximal number of entries of the data matrix, nonzeros for sparse
+        data, that are held in memory at once. The t-test statistics are
+        accumulated over blocks of rows and 'wilcoxon' ranks blocks of genes.
+        This bounds the peak memory for backed `AnnData`, which is processed
+        without loading the data matrix. For backed CSR data, each block of
+        genes requires a pass over the file.
+
     Returns
     -------
     rank_genes_groups_gene_scores : structured `np.ndarray` (adata.uns)
@@ -67,6 +81,14 @@ def rank_genes_groups(
         for each gene for each group.
     rank_genes_groups_gene_names : structured `np.ndarray` (adata.uns)
         Structured array to be indexed by group id for storing the gene names.
+        For `reference='pairwise'`, both structured arrays are indexed by
+        pair ids `'{group}_vs_{reference}'`.
+    rank_genes_groups_pairwise_scores : `np.ndarray` (adata.uns)
+        Only for `reference='pairwise'`. Array of shape `n_vars` × `n_pairs`
+        with the scores of all genes for all ordered pairs of groups.
+    rank_genes_groups_pairwise_pairs : structured `np.ndarray` (adata.uns)
+        Only for `reference='pairwise'`. The group and the reference of each
+        pair, with fields 'group' and 'reference'.
     """
     logg.info('rank differentially expressed genes', r=True)
     adata = adata.copy() if copy else adata
@@ -80,15 +102,16 @@ def rank_genes_groups(
     groups_order = groups
     if isinstance(groups_order, list) and isinstance(groups_order[0], int):
         groups_order = [str(n) for n in groups_order]
-    if reference != 'rest' and reference not in set(groups_order):
+    if (reference not in {'rest', 'pairwise'} and groups_order != 'all'
+        and reference not in set(groups_order)):
         groups_order += [reference]
-    if (reference != 'rest'
+    if (reference not in {'rest', 'pairwise'}
         and reference not in set(adata.obs[group_by].cat.categories)):
         raise ValueError('reference = {} needs to be one of group_by = {}.'
                          .format(reference,
                                  adata.obs[group_by].cat.categories.tolist()))
-    groups_order, groups_masks = utils.select_groups(
-        adata, groups_order, group_by)
+    group_index = utils.GroupIndex.from_adata(adata, group_by, groups_order)
+    groups_order = group_index.names
     adata.uns['rank_genes_groups_params'] = np.array(
         (group_by, reference, test_type, use_raw),
         dtype=[('group_by', 'U50'), ('reference', 'U50'), ('test_type', 'U50'), ('use_raw', np.bool_)])
@@ -99,6 +122,10 @@ def rank_genes_groups(
     if adata.raw is not None and use_raw:
         adata_comp = adata.raw
     X = adata_comp.X
+    # X is read from disk in blocks if adata is backed
+    isbacked = not (isinstance(X, np.ndarray) or issparse(X))
+    if isbacked and compute_distribution:
+        raise ValueError('`compute_distribution` does not support backed `AnnData`.')
 
     # for clarity, rename variable
     n_genes_user = n_genes
@@ -107,16 +134,15 @@ def rank_genes_groups(
         n_genes_user = X.shape[1]
     # in the following, n_genes is simply another name for the total number of genes
     n_genes = X.shape[1]
+    chunk_size = max(block_size // max(n_genes, 1), 1)
 
     rankings_gene_zscores = []
     rankings_gene_names = []
-    n_groups = groups_masks.shape[0]
-    ns = np.zeros(n_groups, dtype=int)
-    for imask, mask in enumerate(groups_masks):
-        ns[imask] = np.where(mask)[0].size
+    n_groups = group_index.n_groups
+    ns = group_index.sizes
     logg.info('    consider \'{}\':'.format(group_by), groups_order,
               'with sample numbers', ns)
-    if reference != 'rest':
+    if reference not in {'rest', 'pairwise'}:
         ireference = np.where(groups_order == reference)[0][0]
     reference_indices = np.arange(adata_comp.n_vars, dtype=int)
 
@@ -135,39 +161,62 @@ def rank_genes_groups(
         if correction_factors[0]<0 or correction_factors[1]<0:
             raise ValueError('Correction factors need to be positive numbers!')
 
-    if test_type in {'t-test', 't-test_overestim_var', 't-test_double_overestim_var',
-                   't-test_correction_factors'}:
-        # loop over all masks and compute means, variances and sample numbers
-        means = np.zeros((n_groups, n_genes))
-        vars = np.zeros((n_groups, n_genes))
-        for imask, mask in enumerate(groups_masks):
-            means[imask], vars[imask] = simple._get_mean_var(X[mask])
+    if reference == 'pairwise':
+        pairs = [(i, j) for i in range(n_groups) for j in range(n_groups) if i != j]
+        igroups, ireferences = np.array(pairs, dtype=int).reshape(-1, 2).T
+        if test_type == 'wilcoxon':
+            n_jobs = settings.n_jobs if n_jobs is None else n_jobs
+            U, ties = _get_pairwise_u(X, group_index.codes, n_groups, n_jobs=n_jobs,
+                                      max_nnz_block=block_size, chunk_size=chunk_size)
+            n_a, n_b = ns[igroups], ns[ireferences]
+            # the rank sum of the group in the union of both groups
+            rank_sums = U[:, igroups, ireferences] + n_a * (n_a + 1) / 2
+            scores = _get_wilcoxon_zscores(
+                rank_sums, ties[:, igroups, ireferences], n_a, n_b)
+        else:
+            _, sums, sums_sq = _get_groups_sums(X, group_index, chunk_size)
+            means, vars = _get_mean_var_from_sums(ns[:, None], sums[:-1], sums_sq[:-1])
+            ns_group, ns_rest = _get_t_test_ns(
+                test_type, ns[igroups], ns[ireferences], correction_factors)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                denominator = np.sqrt(vars[igroups] / ns_group[:, None]
+                                      + vars[ireferences] / ns_rest[:, None])
+                scores = ((means[igroups] - means[ireferences]) / denominator).T
+            scores[~np.isfinite(scores)] = 0
+        scores = scores if only_positive else np.abs(scores)
+        # top genes of all pairs at once
+        partition = np.argpartition(scores, -n_genes_user, axis=0)[-n_genes_user:]
+        partial_indices = np.argsort(
+            np.take_along_axis(scores, partition, axis=0), axis=0)[::-1]
+        global_indices = np.take_along_axis(partition, partial_indices, axis=0)
+        rankings_gene_zscores = list(np.take_along_axis(scores, global_indices, axis=0).T)
+        rankings_gene_names = [adata_comp.var_names[indices] for indices in global_indices.T]
+        groups_order_save = ['{}_vs_{}'.format(groups_order[i], groups_order[j])
+                             for i, j in pairs]
+        adata.uns['rank_genes_groups_pairwise_scores'] = scores.astype(
+            settings.float_dtype, copy=False)
+        adata.uns['rank_genes_groups_pairwise_pairs'] = np.rec.fromarrays(
+            [groups_order[igroups], groups_order[ireferences]],
+            dtype=[('group', 'U50'), ('reference', 'U50')])
+    elif test_type in {'t-test', 't-test_overestim_var', 't-test_double_overestim_var',
+                       't-test_correction_factors'}:
+        # means, variances and sample numbers of all groups and of all
+        # observations in a single pass over X
+        ns_all, sums, sums_sq = _get_groups_sums(X, group_index, chunk_size)
+        means, vars = _get_mean_var_from_sums(ns[:, None], sums[:-1], sums_sq[:-1])
         # test each either against the union of all other groups or against a
         # specific group
         for igroup in range(n_groups):
             if reference == 'rest':
-                mask_rest = ~groups_masks[igroup]
+                n_rest = ns_all - ns[igroup]
+                mean_rest, var_rest = _get_mean_var_from_sums(
+                    n_rest, sums[-1] - sums[igroup], sums_sq[-1] - sums_sq[igroup])
             else:
                 if igroup == ireference: continue
-                else: mask_rest = groups_masks[ireference]
-            mean_rest, var_rest = simple._get_mean_var(X[mask_rest])
-            if test_type == 't-test':
-                ns_rest = np.where(mask_rest)[0].size
-            elif test_type == 't-test_correction_factors':
-                # The tendency is as follows: For the comparison group (rest), overesimate variance --> smaller ns_rest
-                ns_rest = np.where(mask_rest)[0].size/correction_factors[1]
-            else:  # hack for overestimating the variance
-                ns_rest = ns[igroup]
-
-            if test_type in {'t-test', 't-test_overestim_var'}:
-                ns_group=ns[igroup]
-            elif test_type == 't-test_correction_factors':
-                # We underestimate group variance by increasing denominator, i.e. ns_group
-                ns_group=ns[igroup]*correction_factors[0]
-            else :
-                # We do the opposite of t-test_overestim_var
-                ns_group=np.where(mask_rest)[0].size
-
+                n_rest = ns[ireference]
+                mean_rest, var_rest = means[ireference], vars[ireference]
+            ns_group, ns_rest = _get_t_test_ns(
+                test_type, ns[igroup], n_rest, correction_factors)
             denominator = np.sqrt(vars[igroup]/ns_group + var_rest/ns_rest)
             denominator[np.flatnonzero(denominator == 0)] = np.nan
             zscores = (means[igroup] - mean_rest) / denominator
@@ -179,149 +228,78 @@ def rank_genes_groups(
             rankings_gene_zscores.append(zscores[global_indices])
             rankings_gene_names.append(adata_comp.var_names[global_indices])
             if compute_distribution:
-                mask = groups_masks[igroup]
+                mask = group_index.mask(igroup)
                 for gene_counter in range(n_genes_user):
                     gene_idx = global_indices[gene_counter]
                     X_col = X[mask, gene_idx]
                     if issparse(X): X_col = X_col.toarray()[:, 0]
                     identifier = _build_identifier(group_by, groups_order[igroup],
                                                    gene_counter, adata_comp.var_names[gene_idx])
-                    full_col = np.empty(adata.n_obs)
+                    full_col = np.empty(adata.n_obs, dtype=settings.float_dtype)
                     full_col[:] = np.nan
                     full_col[mask] = (X_col - mean_rest[gene_idx]) / denominator[gene_idx]
                     adata.obs[identifier] = full_col
     elif test_type == 'wilcoxon':
         # Wilcoxon-rank-sum test is usually more powerful in detecting marker genes
-        # Limit maximal RAM that is required by the calculation. Currently set fixed to roughly 100 MByte
-        CONST_MAX_SIZE = 10000000
-        ns_rest = np.zeros(n_groups, dtype=int)
-        # initialize space for z-scores
-        zscores = np.zeros(n_genes)
-        # First loop: Loop over all genes
+        n_jobs = settings.n_jobs if n_jobs is None else n_jobs
         if reference != 'rest':
-            for imask, mask in enumerate(groups_masks):
-                if imask == ireference: continue
-                else: mask_rest = groups_masks[ireference]
-                ns_rest[imask] = np.where(mask_rest)[0].size
-                if ns_rest[imask] <= 25 or ns[imask] <= 25:
-                    logg.hint('Few observations in a group for '
-                              'normal approximation (<=25). Lower test accuracy.')
-                n_active = ns[imask]
-                m_active = ns_rest[imask]
-                # Now calculate gene expression ranking in chunkes:
-                chunk = []
-                # Calculate chunk frames
-                n_genes_max_chunk = floor(CONST_MAX_SIZE / (n_active + m_active))
-                if n_genes_max_chunk < n_genes - 1:
-                    chunk_index = n_genes_max_chunk
-                    while chunk_index < n_genes - 1:
-                        chunk.append(chunk_index)
-                        chunk_index = chunk_index + n_genes_max_chunk
-                    chunk.append(n_genes - 1)
-                else:
-                    chunk.append(n_genes - 1)
-                left = 0
-                # Calculate rank sums for each chunk for the current mask
-                for chunk_index, right in enumerate(chunk):
-                    # Check if issparse is true: AnnData objects are currently sparse.csr or ndarray.
-                    if issparse(X):
-                        df1 = pd.DataFrame(data=X[mask, left:right].todense())
-                        df2 = pd.DataFrame(data=X[mask_rest, left:right].todense(),
-                                           index=np.arange(start=n_active, stop=n_active + m_active))
-                    else:
-                        df1 = pd.DataFrame(data=X[mask, left:right])
-                        df2 = pd.DataFrame(data=X[mask_rest, left:right],
-                                           index=np.arange(start=n_active, stop=n_active + m_active))
-                    df1 = df1.append(df2)
-                    ranks = df1.rank()
-                    # sum up adjusted_ranks to calculate W_m,n
-                    zscores[left:right] = np.sum(ranks.loc[0:n_active, :])
-                    left = right + 1
-                zscores = (zscores - (n_active * (n_active + m_active + 1) / 2)) / sqrt(
-                    (n_active * m_active * (n_active + m_active + 1) / 12))
-                zscores = zscores if only_positive else np.abs(zscores)
-                zscores[np.isnan(zscores)] = 0
-                partition = np.argpartition(zscores, -n_genes_user)[-n_genes_user:]
-                partial_indices = np.argsort(zscores[partition])[::-1]
-                global_indices = reference_indices[partition][partial_indices]
-                rankings_gene_zscores.append(zscores[global_indices])
-                rankings_gene_names.append(adata_comp.var_names[global_indices])
-                if compute_distribution:
-                    # Add calculation of means, var: (Unnecessary for wilcoxon if compute distribution=False)
-                    mean, vars = simple._get_mean_var(X[mask])
-                    mean_rest, var_rest = simple._get_mean_var(X[mask_rest])
-                    denominator = np.sqrt(vars / ns[imask] + var_rest / ns_rest[imask])
-                    denominator[np.flatnonzero(denominator == 0)] = np.nan
-                    for gene_counter in range(n_genes_user):
-                        gene_idx = global_indices[gene_counter]
-                        X_col = X[mask, gene_idx]
-                        if issparse(X): X_col = X_col.toarray()[:, 0]
-                        identifier = _build_identifier(group_by, groups_order[imask],
-                                                       gene_counter, adata_comp.var_names[gene_idx])
-                        full_col = np.empty(adata.n_obs)
-                        full_col[:] = np.nan
-                        full_col[mask] = (X_col - mean_rest[gene_idx]) / denominator[gene_idx]
-                        adata.obs[identifier] = full_col
-
-        # If no reference group exists, ranking needs only to be done once (full mask)
+            n_cells_all = ns + ns[ireference]
+            ns_rest = np.full(n_groups, ns[ireference])
         else:
-            zscores = np.zeros((n_groups, n_genes))
-            chunk = []
-            n_cells = X.shape[0]
-            n_genes_max_chunk = floor(CONST_MAX_SIZE / n_cells)
-            if n_genes_max_chunk < n_genes - 1:
-                chunk_index = n_genes_max_chunk
-                while chunk_index < n_genes - 1:
-                    chunk.append(chunk_index)
-                    chunk_index = chunk_index + n_genes_max_chunk
-                chunk.append(n_genes - 1)
+            # all observations are ranked only once
+            rank_sums, ties = _get_rank_sums(X, group_index.codes, n_groups, n_jobs=n_jobs,
+                                             max_nnz_block=block_size, chunk_size=chunk_size)
+            n_cells_all = np.full(n_groups, X.shape[0])
+            ns_rest = X.shape[0] - ns
+        for imask in range(n_groups):
+            if reference != 'rest':
+                if imask == ireference: continue
+                # rank the observations of the group and the reference
+                mask_both = np.isin(group_index.codes, [imask, ireference])
+                rank_sums_group, ties_group = _get_rank_sums(
+                    X, (group_index.codes[mask_both] == imask).astype(int) - 1, 1,
+                    n_jobs=n_jobs, max_nnz_block=block_size, chunk_size=chunk_size,
+                    obs_mask=mask_both)
+                rank_sums_group = rank_sums_group[0]
             else:
-                chunk.append(n_genes - 1)
-            left = 0
-            for chunk_index, right in enumerate(chunk):
-                # Check if issparse is true
-                if issparse(X):
-                    df1 = pd.DataFrame(data=X[:, left:right].todense())
-                else:
-                    df1 = pd.DataFrame(data=X[:, left:right])
-                ranks = df1.rank()
-                # sum up adjusted_ranks to calculate W_m,n
-                for imask, mask in enumerate(groups_masks):
-                    zscores[imask, left:right] = np.sum(ranks.loc[mask, :])
-                left = right + 1
-
-            for imask, mask in enumerate(groups_masks):
-                zscores[imask, :] = (zscores[imask, :] - (ns[imask] * (n_cells + 1) / 2)) / sqrt(
-                    (ns[imask] * (n_cells - ns[imask]) * (n_cells + 1) / 12))
-                zscores = zscores if only_positive else np.abs(zscores)
-                zscores[np.isnan(zscores)] = 0
-                partition = np.argpartition(zscores[imask, :], -n_genes_user)[-n_genes_user:]
-                partial_indices = np.argsort(zscores[imask, partition])[::-1]
-                global_indices = reference_indices[partition][partial_indices]
-                rankings_gene_zscores.append(zscores[imask, global_indices])
-                rankings_gene_names.append(adata_comp.var_names[global_indices])
-                if compute_distribution:
-                    mean, vars = simple._get_mean_var(X[mask])
-                    mean_rest, var_rest = simple._get_mean_var(X[~mask])
-                    denominator = np.sqrt(vars / ns[imask] + var_rest / (n_cells-ns[imask]))
-                    denominator[np.flatnonzero(denominator == 0)] = np.nan
-                    for gene_counter in range(n_genes_user):
-                        gene_idx = global_indices[gene_counter]
-                        X_col = X[mask, gene_idx]
-                        if issparse(X): X_col = X_col.toarray()[:, 0]
-                        identifier = _build_identifier(group_by, groups_order[imask],
-                                                       gene_counter, adata_comp.var_names[gene_idx])
-                        full_col = np.empty(adata.n_obs)
-                        full_col[:] = np.nan
-                        full_col[mask] = (X_col - mean_rest[gene_idx]) / denominator[gene_idx]
-                        adata.obs[identifier] = full_col
-
-    groups_order_save = [str(g) for g in groups_order]
-    if reference != 'rest':
+                rank_sums_group, ties_group = rank_sums[imask], ties
+            if ns_rest[imask] <= 25 or ns[imask] <= 25:
+                logg.hint('Few observations in a group for '
+                          'normal approximation (<=25). Lower test accuracy.')
+            zscores = _get_wilcoxon_zscores(
+                rank_sums_group, ties_group, ns[imask], ns_rest[imask])
+            zscores = zscores if only_positive else np.abs(zscores)
+            partition = np.argpartition(zscores, -n_genes_user)[-n_genes_user:]
+            partial_indices = np.argsort(zscores[partition])[::-1]
+            global_indices = reference_indices[partition][partial_indices]
+            rankings_gene_zscores.append(zscores[global_indices])
+            rankings_gene_names.append(adata_comp.var_names[global_indices])
+            if compute_distribution:
+                mask = group_index.mask(imask)
+                mask_rest = ~mask if reference == 'rest' else group_index.mask(ireference)
+                # Add calculation of means, var: (Unnecessary for wilcoxon if compute distribution=False)
+                mean, vars = simple._get_mean_var(X[mask])
+                mean_rest, var_rest = simple._get_mean_var(X[mask_rest])
+                denominator = np.sqrt(vars / ns[imask] + var_rest / ns_rest[imask])
+                denominator[np.flatnonzero(denominator == 0)] = np.nan
+                for gene_counter in range(n_genes_user):
+                    gene_idx = global_indices[gene_counter]
+                    X_col = X[mask, gene_idx]
+                    if issparse(X): X_col = X_col.toarray()[:, 0]
+                    identifier = _build_identifier(group_by, groups_order[imask],
+                                                   gene_counter, adata_comp.var_names[gene_idx])
+                    full_col = np.empty(adata.n_obs, dtype=settings.float_dtype)
+                    full_col[:] = np.nan
+                    full_col[mask] = (X_col - mean_rest[gene_idx]) / denominator[gene_idx]
+                    adata.obs[identifier] = full_col
+
+    if reference == 'rest':
+        groups_order_save = [str(g) for g in groups_order]
+    elif reference != 'pairwise':
         groups_order_save = [g for g in groups_order if g != reference]
     adata.uns['rank_genes_groups_gene_scores'] = np.rec.fromarrays(
         [n for n in rankings_gene_zscores],
-        dtype=[(rn, 'float32') for rn in groups_order_save])
+        dtype=[(rn, settings.float_dtype) for rn in groups_order_save])
     adata.uns['rank_genes_groups_gene_names'] = np.rec.fromarrays(
         [n for n in rankings_gene_names],
         dtype=[(rn, 'U50') for rn in groups_order_save])
@@ -332,6 +310,298 @@ def rank_genes_groups(
     return adata if copy else None
 
 
+def _get_groups_sums(X, group_index, chunk_size=10000):
+    """Sums and sums of squares per group and over all observations.
+
+    Computed as products of the sparse group indicator matrix of the
+    `utils.GroupIndex` `group_index` with blocks of
+    `chunk_size` rows of `X`, hence, memory scales with the number of groups
+    times the number of genes instead of with copies of `X`.
+
+    Returns
+    -------
+    n_obs : `int`
+        Number of all observations.
+    sums, sums_sq : `np.ndarray`
+        Arrays of shape `n_groups + 1` × `n_vars`, the last row holds the
+        statistics of all observations.
+    """
+    n_groups = group_index.n_groups
+    n_obs, n_vars = X.shape
+    indicator = group_index.indicator(total=True).tocsc()
+    sums = np.zeros((n_groups + 1, n_vars))
+    sums_sq = np.zeros((n_groups + 1, n_vars))
+    for start in range(0, n_obs, chunk_size):
+        stop = min(start + chunk_size, n_obs)
+        block = utils.read_row_block(X, start, stop).astype(np.float64)
+        block_sq = block.multiply(block) if issparse(block) else block**2
+        indicator_block = indicator[:, start:stop]
+        for result, values in [(sums, block), (sums_sq, block_sq)]:
+            product = indicator_block.dot(values)
+            result += product.toarray() if issparse(product) else product
+    return n_obs, sums, sums_sq
+
+
+def _get_mean_var_from_sums(n, sums, sums_sq):
+    """Means and unbiased variances as in `simple._get_mean_var`."""
+    mean = sums / n
+    mean_sq = sums_sq / n
+    var = (mean_sq - mean**2) * (n / (n - 1))
+    return mean, var
+
+
+def _get_rank_sums(X, codes, n_groups, n_jobs=1, max_nnz_block=10000000,
+                   chunk_size=10000, obs_mask=None):
+    """Wilcoxon rank sums of groups of observations for all genes.
+
+    Ranks all observations of `X` per gene, averaging the ranks of ties. As
+    all zeros of a gene share one tied rank, which is computed in closed form,
+    only the nonzeros are sorted. Genes are processed in blocks of at most
+    `max_nnz_block` nonzeros, in parallel processes if `n_jobs > 1`.
+
+    Parameters
+    ----------
+    X : `np.ndarray`, `sp.spmatrix`
+        Data matrix of shape `n_obs` × `n_vars`, possibly backed.
+    codes : `np.ndarray`
+        Group index for each observation, observations with negative codes
+        are ranked, but do not belong to any group.
+    n_groups : `int`
+        Number of groups.
+    obs_mask : `np.ndarray` or `None`, optional (default: `None`)
+        Only rank these observations, `codes` refers to them.
+
+    Returns
+    -------
+    rank_sums : `np.ndarray`
+        Array of shape `n_groups` × `n_vars`.
+    ties : `np.ndarray`
+        Sum of `t**3 - t` over all groups of `t` tied values for each gene,
+        as needed for the tie correction of the variance.
+    """
+    n_ns = np.bincount(codes[codes >= 0], minlength=n_groups)
+    blocks, results = _map_gene_blocks(
+        X, _get_rank_sums_block, (codes, n_groups, n_ns), n_jobs, max_nnz_block,
+        chunk_size, obs_mask)
+    rank_sums = np.zeros((n_groups, X.shape[1]))
+    ties = np.zeros(X.shape[1])
+    for (left, right), (rank_sums_block, ties_block) in zip(blocks, results):
+        rank_sums[:, left:right] = rank_sums_block
+        ties[left:right] = ties_block
+    return rank_sums, ties
+
+
+def _get_pairwise_u(X, codes, n_groups, n_jobs=1, max_nnz_block=10000000,
+                    chunk_size=10000):
+    """Mann-Whitney U statistics of all pairs of groups for all genes.
+
+    Sorts the values of each gene once and counts, for each run of tied
+    values, the observations of each group in it and in all lower runs. The
+    U statistic of group `a` versus group `b` is then the sum over runs of the
+    count of `a` times the count of `b` below the run, plus half the count of
+    `b` in the run.
+
+    Returns
+    -------
+    U : `np.ndarray`
+        Array of shape `n_vars` × `n_groups` × `n_groups`, `U[:, a, b]` is the
+        statistic of group `a` versus group `b`.
+    ties : `np.ndarray`
+        Array of the same shape with the tie terms of the union of both groups.
+    """
+    n_ns = np.bincount(codes[codes >= 0], minlength=n_groups)
+    # the counts per run and group are dense, bound their size
+    blocks, results = _map_gene_blocks(
+        X, _get_pairwise_u_block, (codes, n_groups, n_ns), n_jobs,
+        max(max_nnz_block // max(n_groups, 1), 1), chunk_size)
+    U = np.concatenate([U_block for U_block, _ in results])
+    ties = np.concatenate([ties_block for _, ties_block in results])
+    return U, ties
+
+
+def _map_gene_blocks(X, func, args, n_jobs, max_nnz_block, chunk_size=10000,
+                     obs_mask=None):
+    """Apply `func` to CSC blocks of genes with at most `max_nnz_block` nonzeros.
+
+    Backed data is read one block of genes at a time, see
+    `utils.read_col_block`. With `n_jobs > 1`, blocks are read lazily while
+    the previous ones are processed in parallel processes.
+    """
+    from scipy.sparse import csc_matrix
+    from joblib import Parallel, delayed
+    n_vars = X.shape[1]
+    isbacked = not (isinstance(X, np.ndarray) or issparse(X))
+    if isbacked:
+        nnz_per_gene = _get_nnz_per_gene(X, chunk_size)
+    elif issparse(X):
+        X = X.tocsc()
+        nnz_per_gene = np.diff(X.indptr)
+    else:
+        nnz_per_gene = np.full(n_vars, X.shape[0])
+    nnz_cumsum = np.concatenate([[0], np.cumsum(nnz_per_gene)])
+    blocks = []
+    left = 0
+    while left < n_vars:
+        right = np.searchsorted(nnz_cumsum, nnz_cumsum[left] + max_nnz_block, side='right') - 1
+        right = min(max(right, left + 1), n_vars)
+        blocks.append((left, right))
+        left = right
+
+    def get_block(left, right):
+        if isbacked:
+            block = utils.read_col_block(X, left, right, chunk_size)
+        elif issparse(X):
+            block = X[:, left:right]
+        else:
+            block = csc_matrix(X[:, left:right])
+        return block if obs_mask is None else block[obs_mask].tocsc()
+
+    if n_jobs > 1 and len(blocks) > 1:
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(func)(get_block(l, r), *args) for l, r in blocks)
+    else:
+        results = [func(get_block(l, r), *args) for l, r in blocks]
+    return blocks, results
+
+
+def _get_nnz_per_gene(X, chunk_size):
+    """Number of stored entries per column of a backed data matrix."""
+    group = getattr(X, 'h5py_group', None)
+    if group is None:
+        return np.full(X.shape[1], X.shape[0])
+    indptr = group['indptr'][...]
+    if X.format_str == 'csc':
+        return np.diff(indptr)
+    nnz_per_gene = np.zeros(X.shape[1], dtype=int)
+    for start in range(0, X.shape[0], chunk_size):
+        stop = min(start + chunk_size, X.shape[0])
+        indices = group['indices'][indptr[start]:indptr[stop]]
+        nnz_per_gene += np.bincount(indices, minlength=X.shape[1])
+    return nnz_per_gene
+
+
+def _sort_block(X):
+    """Nonzeros of a CSC block sorted by gene and value, and their runs of ties."""
+    X.eliminate_zeros()
+    values = X.data.astype(np.float64)
+    genes = np.repeat(np.arange(X.shape[1]), np.diff(X.indptr))
+    order = np.lexsort((values, genes))
+    values, genes, obs = values[order], genes[order], X.indices[order]
+    new_run = np.ones(len(values), dtype=bool)
+    new_run[1:] = (values[1:] != values[:-1]) | (genes[1:] != genes[:-1])
+    return values, genes, obs, new_run
+
+
+def _rank_block(X):
+    """Average ranks of the nonzeros of a CSC block, with all zeros tied.
+
+    Returns the genes, observations and ranks of the nonzeros, as well as the
+    rank of the zeros and the tie terms of each gene.
+    """
+    n_obs, n_vars = X.shape
+    values, genes, obs, new_run = _sort_block(X)
+    # zeros are inserted after the negative and before the positive values
+    nnz = np.bincount(genes, minlength=n_vars)
+    n_zeros = n_obs - nnz
+    n_negative = np.bincount(genes[values < 0], minlength=n_vars)
+    rank_zeros = n_negative + (n_zeros + 1) / 2
+    # average rank of runs of tied nonzero values
+    starts_gene = np.concatenate([[0], np.cumsum(nnz)[:-1]])
+    run_starts = np.flatnonzero(new_run)
+    run_lengths = np.diff(np.append(run_starts, len(values)))
+    run_ids = np.cumsum(new_run) - 1
+    position = run_starts - starts_gene[genes[run_starts]]
+    ranks = (position + (run_lengths + 1) / 2)[run_ids]
+    ranks += np.where(values > 0, n_zeros[genes], 0)
+    ties = np.bincount(genes[run_starts], weights=run_lengths**3 - run_lengths,
+                       minlength=n_vars).astype(np.float64)
+    ties += n_zeros.astype(np.float64)**3 - n_zeros
+    return genes, obs, ranks, rank_zeros, ties
+
+
+def _get_rank_sums_block(X, codes, n_groups, ns):
+    """Rank sums and tie terms for the genes of a CSC block."""
+    n_vars = X.shape[1]
+    genes, obs, ranks, rank_zeros, ties = _rank_block(X)
+    # rank sums of the nonzeros and the zeros of each group
+    obs_codes = codes[obs]
+    in_group = obs_codes >= 0
+    index = obs_codes[in_group] * n_vars + genes[in_group]
+    rank_sums = np.bincount(index, weights=ranks[in_group],
+                            minlength=n_groups * n_vars).reshape(n_groups, n_vars)
+    rank_sums = rank_sums.astype(np.float64)
+    nnz_groups = np.bincount(index, minlength=n_groups * n_vars).reshape(n_groups, n_vars)
+    rank_sums += (ns[:, None] - nnz_groups) * rank_zeros
+    return rank_sums, ties
+
+
+def _get_pairwise_u_block(X, codes, n_groups, ns):
+    """U statistics and tie terms of all pairs of groups for a CSC block."""
+    from scipy.sparse import coo_matrix, csr_matrix
+    n_vars = X.shape[1]
+    values, genes, obs, new_run = _sort_block(X)
+    run_ids = np.cumsum(new_run) - 1
+    obs_codes = codes[obs]
+    in_group = obs_codes >= 0
+    # counts of each group in each run, the zeros of each gene form one run
+    counts = coo_matrix(
+        (np.ones(in_group.sum()), (run_ids[in_group], obs_codes[in_group])),
+        shape=(new_run.sum(), n_groups)).toarray()
+    nnz_groups = np.bincount(obs_codes[in_group] * n_vars + genes[in_group],
+                             minlength=n_groups * n_vars).reshape(n_groups, n_vars)
+    counts = np.vstack([counts, (ns[:, None] - nnz_groups).T])
+    run_genes = np.concatenate([genes[new_run], np.arange(n_vars)])
+    run_values = np.concatenate([values[new_run], np.zeros(n_vars)])
+    order = np.lexsort((run_values, run_genes))
+    counts, run_genes = counts[order], run_genes[order]
+    # counts of each group in the lower runs of the same gene
+    cumsum = np.cumsum(counts, axis=0)
+    starts = np.searchsorted(run_genes, np.arange(n_vars))
+    offsets = np.vstack([np.zeros(n_groups), cumsum])[starts]
+    below = cumsum - counts - offsets[run_genes]
+    # sum over the runs of each gene for each group a and all groups b
+    runs, groups = np.nonzero(counts)
+    weights = counts[runs, groups]
+    rows = run_genes[runs] * n_groups + groups
+    shape = (n_vars * n_groups, len(counts))
+    U = csr_matrix((weights, (rows, runs)), shape=shape).dot(below + counts / 2)
+    U = U.reshape(n_vars, n_groups, n_groups)
+    # sum over runs of (t_a + t_b)**3 - (t_a + t_b) for the counts t_a, t_b
+    cross = csr_matrix((weights**2, (rows, runs)), shape=shape).dot(counts)
+    cross = cross.reshape(n_vars, n_groups, n_groups)
+    cubes = np.diagonal(cross, axis1=1, axis2=2)
+    ties = (cubes[:, :, None] + cubes[:, None, :]
+            + 3 * cross + 3 * cross.transpose(0, 2, 1)
+            - ns[:, None] - ns[None, :])
+    return U, ties
+
+
+def _get_t_test_ns(test_type, n_group, n_rest, correction_factors=None):
+    """Sample numbers that scale the variances of the group and the rest."""
+    if test_type == 't-test':
+        return n_group, n_rest
+    elif test_type == 't-test_correction_factors':
+        # We underestimate group variance by increasing denominator, i.e. ns_group
+        # For the comparison group (rest), overesimate variance --> smaller ns_rest
+        return n_group * correction_factors[0], n_rest / correction_factors[1]
+    elif test_type == 't-test_overestim_var':
+        # hack for overestimating the variance
+        return n_group, n_group
+    else:
+        # We do the opposite of t-test_overestim_var
+        return n_rest, n_group
+
+
+def _get_wilcoxon_zscores(rank_sums, ties, n_group, n_rest):
+    """Normal approximation of the rank-sum statistic with tie correction."""
+    n = n_group + n_rest
+    with np.errstate(divide='ignore', invalid='ignore'):
+        std = np.sqrt(n_group * n_rest / 12 * ((n + 1) - ties / (n * (n - 1))))
+        zscores = (rank_sums - n_group * (n + 1) / 2) / std
+    zscores[np.isnan(zscores) | np.isinf(zscores)] = 0
+    return zscores
+
+
 def _build_identifier(group_by, name, gene_counter, gene_name):
     return 'rank_genes_{}_{}_{}_{}'.format(
         group_by, name, gene_counter, gene_name)
@@ -5,9 +5,11 @@ import numpy as np
 import pandas as pd
 import scipy.sparse
 from .. import settings
+from .. import utils
 from .. import logging as logg
 
 
+@utils.check_float_dtype
 def score_genes(
         adata,
         gene_list,
@@ -41,7 +43,7 @@ def score_genes(
         Number of expression level bins for sampling.
     score_name : `str`, optional (default: `'score'`)
         Name of the field to be added in `.obs`.
-    random_state : `int`, optional (default: 0)
+    random_state : `int` or `None`, optional (default: 0)
         The random seed for sampling.
     copy : `bool`, optional (default: `False`)
         Copy `adata` or modify it inplace.
@@ -57,53 +59,123 @@ def score_genes(
     """
     logg.info('computing score \'{}\''.format(score_name), r=True)
     adata = adata.copy() if copy else adata
+    _score_genes_batch(adata, {score_name: gene_list}, ctrl_size, gene_pool,
+                       n_bins, random_state)
+    logg.info('    finished', time=True, end=' ' if settings.verbosity > 2 else '\n')
+    logg.hint('added\n'
+              '    \'{}\', score of gene set (adata.obs)'.format(score_name))
+    return adata if copy else None
+
+
+@utils.check_float_dtype
+def score_genes_batch(
+        adata,
+        gene_lists,
+        ctrl_size=50,
+        gene_pool=None,
+        n_bins=25,
+        random_state=0,
+        copy=False):
+    """Score many sets of genes at once [Satija15]_.
+
+    Computes the same scores as calling :func:`~scanpy.api.score_genes` for
+    each set of genes, but computes the average expression of the
+    `gene_pool` and its bins only once and obtains all scores from a single
+    product of the data matrix with a sparse weight matrix of shape
+    `n_vars` × `len(gene_lists)`. The data matrix is never densified.
+
+    Parameters
+    ----------
+    adata : :class:`~scanpy.api.AnnData`
+        The annotated data matrix.
+    gene_lists : `dict`
+        Maps the names of the fields to be added in `.obs` to lists of gene
+        names used for score calculation.
+    ctrl_size : `int`, optional (default: 50)
+        Number of reference genes to be sampled per bin.
+    gene_pool : `list` or `None`, optional (default: `None`)
+        Genes for sampling the reference set. Default is all genes.
+    n_bins : `int`, optional (default: 25)
+        Number of expression level bins for sampling.
+    random_state : `int` or `None`, optional (default: 0)
+        The random seed for sampling. The sets of genes are sampled in order
+        from a single random state, hence the first one reproduces
+        :func:`~scanpy.api.score_genes` with the same `random_state`.
+    copy : `bool`, optional (default: `False`)
+        Copy `adata` or modify it inplace.
 
-    if random_state:
-        np.random.seed(random_state)
+    Returns
+    -------
+    Depending on `copy`, returns or updates `adata` with a field in `.obs`
+    for each key of `gene_lists`.
+    """
+    logg.info('computing {} scores'.format(len(gene_lists)), r=True)
+    adata = adata.copy() if copy else adata
+    _score_genes_batch(adata, gene_lists, ctrl_size, gene_pool, n_bins, random_state)
+    logg.info('    finished', time=True, end=' ' if settings.verbosity > 2 else '\n')
+    logg.hint('added\n'
+              '    {}, scores of gene sets (adata.obs)'
+              .format(', '.join('\'{}\''.format(name) for name in gene_lists)))
+    return adata if copy else None
 
-    gene_list = set([x for x in gene_list if x in adata.var_names])
 
+def _score_genes_batch(adata, gene_lists, ctrl_size, gene_pool, n_bins, random_state):
+    """Add a score to `adata.obs` for each item of the dict `gene_lists`."""
+    X = adata.X
     if not gene_pool:
         gene_pool = list(adata.var_names)
     else:
         gene_pool = [x for x in gene_pool if x in adata.var_names]
+    pool_indices = adata.var_names.get_indexer(gene_pool)
 
     # Trying here to match the Seurat approach in scoring cells.
     # Basically we need to compare genes against random genes in a matched
     # interval of expression.
-
-    # TODO: this densifies the whole data matrix for `gene_pool`
-    if scipy.sparse.issparse(adata.X):
-        obs_avg = pd.Series(
-            np.nanmean(
-                adata[:, gene_pool].X.toarray(), axis=0), index=gene_pool)  # average expression of genes
+    if scipy.sparse.issparse(X):
+        avg = np.asarray(X[:, pool_indices].mean(axis=0, dtype=np.float64)).ravel()
     else:
-        obs_avg = pd.Series(
-            np.nanmean(adata[:, gene_pool].X, axis=0), index=gene_pool)  # average expression of genes
-
+        avg = np.nanmean(X[:, pool_indices], axis=0)
+    obs_avg = pd.Series(avg, index=gene_pool)  # average expression of genes
     n_items = int(np.round(len(obs_avg) / (n_bins - 1)))
     obs_cut = obs_avg.rank(method='min') // n_items
-    control_genes = set()
-
-    # now pick `ctrl_size` genes from every cut
-    for cut in np.unique(obs_cut.loc[gene_list]):
-        r_genes = np.array(obs_cut[obs_cut == cut].index)
-        np.random.shuffle(r_genes)
-        control_genes.update(set(r_genes[:ctrl_size]))  # uses full r_genes if ctrl_size > len(r_genes)
-
-    # To index, we need a list - indexing implies an order.
-    control_genes = list(control_genes - gene_list)
-    gene_list = list(gene_list)
-
-    score = np.mean(adata[:, gene_list].X, axis=1) - np.mean(adata[:, control_genes].X, axis=1)
-    adata.obs[score_name] = pd.Series(np.array(score).ravel(), index=adata.obs_names)
-
-    logg.info('    finished', time=True, end=' ' if settings.verbosity > 2 else '\n')
-    logg.hint('added\n'
-              '    \'{}\', score of gene set (adata.obs)'.format(score_name))
-    return adata if copy else None
+    cut_genes = {cut: np.array(genes.index)
+                 for cut, genes in obs_cut.groupby(obs_cut)}
+
+    # the global random state remains untouched
+    random_state_list = np.random.RandomState(random_state)
+    rows, cols, weights = [], [], []
+    for icol, (score_name, gene_list) in enumerate(gene_lists.items()):
+        gene_list = set([x for x in gene_list if x in adata.var_names])
+        if len(gene_list) == 0:
+            raise ValueError('No gene of the list for \'{}\' is in `adata.var_names`.'
+                             .format(score_name))
+        control_genes = set()
+        # now pick `ctrl_size` genes from every cut
+        for cut in np.unique(obs_cut.loc[gene_list]):
+            r_genes = cut_genes[cut].copy()
+            random_state_list.shuffle(r_genes)
+            control_genes.update(set(r_genes[:ctrl_size]))  # uses full r_genes if ctrl_size > len(r_genes)
+        # To index, we need a list - indexing implies an order.
+        control_genes = list(control_genes - gene_list)
+        gene_list = list(gene_list)
+        for genes, sign in [(gene_list, 1), (control_genes, -1)]:
+            rows.append(adata.var_names.get_indexer(genes))
+            cols.append(np.full(len(genes), icol))
+            weights.append(np.full(len(genes), sign / max(len(genes), 1)))
+
+    dtype = np.result_type(X.dtype, np.float32)
+    W = scipy.sparse.csc_matrix(
+        (np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(adata.n_vars, len(gene_lists)), dtype=dtype)
+    if scipy.sparse.issparse(X):
+        scores = X.dot(W).toarray()
+    else:
+        scores = W.T.dot(X.T).T
+    for icol, score_name in enumerate(gene_lists):
+        adata.obs[score_name] = pd.Series(scores[:, icol], index=adata.obs_names)
 
 
+@utils.check_float_dtype
 def score_genes_cell_cycle(
         adata,
         s_genes,
@@ -127,7 +199,7 @@ def score_genes_cell_cycle(
     copy : `bool`, optional (default: `False`)
         Copy `adata` or modify it inplace.
     **kwargs : optional keyword arguments
-        Are passed to :func:`~scanpy.api.score_genes`. `ctrl_size` is not
+        Are passed to :func:`~scanpy.api.score_genes_batch`. `ctrl_size` is not
         possible, as it's set as `min(len(s_genes), len(g2m_genes))`.
 
     Returns
@@ -153,10 +225,9 @@ def score_genes_cell_cycle(
 
     adata = adata.copy() if copy else adata
     ctrl_size = min(len(s_genes), len(g2m_genes))
-    # add s-score
-    score_genes(adata, gene_list=s_genes, score_name='S_score', ctrl_size=ctrl_size, **kwargs)
-    # add g2m-score
-    score_genes(adata, gene_list=g2m_genes, score_name='G2M_score', ctrl_size=ctrl_size, **kwargs)
+    # add s-score and g2m-score
+    score_genes_batch(adata, {'S_score': s_genes, 'G2M_score': g2m_genes},
+                      ctrl_size=ctrl_size, **kwargs)
     scores = adata.obs[['S_score', 'G2M_score']]
 
     # default phase is S
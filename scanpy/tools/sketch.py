@@ -0,0 +1,189 @@
+"""Geometric Sketching
+
+Downsample to a set of cells that evenly covers the PCA representation.
+"""
+
+import numpy as np
+import pandas as pd
+from ..tools.pca import pca
+from .. import settings
+from .. import utils
+from .. import logging as logg
+
+
+def sketch(
+        adata,
+        n_obs,
+        n_pcs=50,
+        random_state=0,
+        max_iter=50,
+        recompute_pca=False):
+    """Geometric sketching [Hie19]_.
+
+    Covers the PCA representation with a grid of hypercubes whose side length
+    is chosen such that at least `n_obs` hypercubes are occupied. Cells are
+    then drawn evenly across occupied hypercubes: one cell from each of
+    `n_obs` randomly chosen hypercubes or, if there are fewer, round robin.
+    In contrast to uniform subsampling, this preserves rare populations and
+    makes it safe to run `louvain` or `aga` on the sketch; labels can be
+    projected back to all cells using `project_labels`.
+
+    The cost is O(n log n) per bisection step for the side length.
+
+    Parameters
+    ----------
+    adata : :class:`~scanpy.api.AnnData`
+        Annotated data matrix.
+    n_obs : `int`
+        Number of cells in the sketch.
+    n_pcs : `int`, optional (default: 50)
+        Number of principal components that span the covered space.
+    random_state : `int` or `None`, optional (default: 0)
+        Random seed for choosing hypercubes and cells within hypercubes.
+    max_iter : `int`, optional (default: 50)
+        Maximal number of bisection steps for the side length.
+    recompute_pca : `bool`, optional (default: `False`)
+        Recompute 'X_pca' even if it is present.
+
+    Returns
+    -------
+    obs_indices : `np.ndarray`
+        Sorted indices of the cells in the sketch, use ``adata[obs_indices]``
+        to obtain the sketched data.
+    """
+    logg.info('computing geometric sketch', r=True)
+    if n_obs > adata.n_obs or n_obs < 1:
+        raise ValueError('`n_obs` needs to be within [1, {}], not {}'
+                         .format(adata.n_obs, n_obs))
+    X = _get_X_pca(adata, n_pcs, random_state, recompute_pca)
+    X = X - X.min(axis=0)
+    # largest side length for which at least n_obs boxes are occupied
+    low, high = 0, X.max() * (1 + 1e-6) + 1e-12
+    boxes = np.arange(adata.n_obs)
+    for _ in range(max_iter):
+        unit = (low + high) / 2
+        boxes_unit = _box_indices(X, unit)
+        n_boxes = boxes_unit.max() + 1
+        if n_boxes >= n_obs:
+            low, boxes = unit, boxes_unit
+            if n_boxes == n_obs: break
+        else:
+            high = unit
+    n_boxes = boxes.max() + 1
+    logg.msg('    covered by {} boxes of side length {:.3g}'
+             .format(n_boxes, low), v=4)
+    random_state = np.random.RandomState(random_state)
+    keys = random_state.random_sample(adata.n_obs)
+    box_keys = random_state.random_sample(n_boxes)
+    # rank of each cell within its box in random order
+    order = np.lexsort((keys, boxes))
+    sorted_boxes = boxes[order]
+    rank = np.empty(adata.n_obs, dtype=int)
+    rank[order] = (np.arange(adata.n_obs)
+                   - np.searchsorted(sorted_boxes, sorted_boxes, side='left'))
+    # round robin over boxes in random order
+    selected = np.lexsort((box_keys[boxes], rank))[:n_obs]
+    logg.info('    finished', time=True, end=' ' if settings.verbosity > 2 else '\n')
+    logg.hint('sketched {} of {} cells from {} occupied boxes'
+              .format(n_obs, adata.n_obs, n_boxes))
+    return np.sort(selected)
+
+
+@utils.check_float_dtype
+def project_labels(
+        adata,
+        adata_sketch,
+        key,
+        n_neighbors=1,
+        n_pcs=50,
+        key_added=None,
+        n_jobs=None,
+        copy=False):
+    """Project labels from a sketch to all cells via nearest sketch neighbors.
+
+    Each cell obtains the label of its nearest neighbor among the cells in
+    `adata_sketch` or, for `n_neighbors > 1`, the most frequent label among
+    its nearest neighbors. Neighbors are searched in the PCA representation
+    of `adata`, hence, the result does not depend on whether the PCA has been
+    recomputed for the sketch.
+
+    Parameters
+    ----------
+    adata : :class:`~scanpy.api.AnnData`
+        Annotated data matrix.
+    adata_sketch : :class:`~scanpy.api.AnnData`
+        Sketch of `adata`, e.g., ``adata[sketch(adata, n_obs)]``, whose
+        observation names need to be present in `adata`.
+    key : `str`
+        Key for categorical labels in `adata_sketch.obs`, e.g.,
+        'louvain_groups'.
+    n_neighbors : `int`, optional (default: 1)
+        Number of nearest sketch neighbors that vote for the label.
+    n_pcs : `int`, optional (default: 50)
+        Number of principal components in which to search neighbors.
+    key_added : `str` or `None`, optional (default: `None`)
+        Key under which to add the labels, defaults to `key`.
+    n_jobs : `int` or `None`
+        Number of CPUs to use (default: `sc.settings.n_jobs`).
+    copy : `bool` (default: `False`)
+        Return a copy instead of writing to adata.
+
+    Returns
+    -------
+    Depending on `copy`, returns or updates `adata` with the following fields.
+
+    key_added : `pd.Series` (``adata.obs``, dtype `category`)
+        Labels projected from the sketch.
+    """
+    from sklearn.neighbors import NearestNeighbors
+    logg.info('projecting labels from sketch', r=True)
+    adata = adata.copy() if copy else adata
+    sketch_indices = adata.obs_names.get_indexer(adata_sketch.obs_names)
+    if (sketch_indices < 0).any():
+        raise ValueError('The observation names of `adata_sketch` need to be '
+                         'present in `adata`.')
+    labels = pd.Categorical(adata_sketch.obs[key])
+    X = _get_X_pca(adata, n_pcs, 0, False)
+    n_jobs = settings.n_jobs if n_jobs is None else n_jobs
+    nn = NearestNeighbors(n_neighbors=n_neighbors, n_jobs=n_jobs)
+    nn.fit(X[sketch_indices])
+    _, neighbors = nn.kneighbors(X)
+    codes = labels.codes[neighbors]
+    if n_neighbors > 1:
+        n_categories = len(labels.categories)
+        offsets = np.arange(adata.n_obs)[:, None] * (n_categories + 1)
+        # shift codes by one so that missing labels (-1) do not vote
+        votes = np.bincount((offsets + codes + 1).ravel(),
+                            minlength=adata.n_obs * (n_categories + 1))
+        votes = votes.reshape(adata.n_obs, n_categories + 1)[:, 1:]
+        codes = np.where(votes.max(axis=1) > 0, votes.argmax(axis=1), -1)
+    else:
+        codes = codes[:, 0]
+    key_added = key if key_added is None else key_added
+    adata.obs[key_added] = pd.Categorical.from_codes(codes, labels.categories)
+    if key + '_colors' in adata_sketch.uns:
+        adata.uns[key_added + '_colors'] = adata_sketch.uns[key + '_colors']
+    logg.info('    finished', time=True, end=' ' if settings.verbosity > 2 else '\n')
+    logg.hint('added\n'
+              '    \'{}\', labels projected from sketch (adata.obs)'
+              .format(key_added))
+    return adata if copy else None
+
+
+def _get_X_pca(adata, n_pcs, random_state, recompute_pca):
+    if ('X_pca' in adata.obsm_keys()
+        and adata.obsm['X_pca'].shape[1] >= n_pcs
+        and not recompute_pca):
+        logg.info('    using \'X_pca\' with n_pcs = {}'.format(n_pcs))
+    else:
+        n_pcs = min(n_pcs, min(adata.X.shape) - 1)
+        logg.info('    computing \'X_pca\' with n_pcs = {}'.format(n_pcs))
+        pca(adata, n_comps=n_pcs, random_state=random_state)
+    return adata.obsm['X_pca'][:, :n_pcs].astype(settings.float_dtype, copy=False)
+
+
+def _box_indices(X, unit):
+    """Index of the occupied hypercube of side length `unit` for each row."""
+    grid = np.floor(X / unit).astype(np.int64)
+    _, boxes = np.unique(grid, axis=0, return_inverse=True)
+    return boxes.ravel()
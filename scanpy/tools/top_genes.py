@@ -7,6 +7,7 @@ import numpy as np
 import pandas as pd
 from scipy.sparse import issparse
 from .. import utils
+from .. import settings
 from .. import logging as logg
 
 
@@ -15,6 +16,12 @@ def correlation_matrix(adata, name_list=None, groupby=None, group=None, n_genes=
 
         Calculate a correlation matrix for genes strored in sample annotation using rank_genes_groups.py
 
+        Pearson and Spearman correlation are computed from the sparse products
+        `XᵀX` with centering corrections, without densifying the data. For
+        Spearman, columns are replaced by their ranks with all zeros tied,
+        shifted such that zeros stay zero. With `data='Groups'`, correlation
+        matrices for all groups are computed in one pass over the data.
+
         Parameters
         ----------
         adata : :class:`~scanpy.api.AnnData`
@@ -28,146 +35,237 @@ def correlation_matrix(adata, name_list=None, groupby=None, group=None, n_genes=
         group : `int`, optional (default: None)
             Group index for which the correlation matrix for top_ranked genes should be calculated.
             Currently only int is supported, will change very soon
-        n_genes : `int`, optional (default: 20)
+        n_genes : `int` or `None`, optional (default: 20)
             For how many genes to calculate correlation matrix? If specified, cuts the name list
-            (in whatever order it is passed).
-        data : {'Complete', 'Group', 'Rest'}, optional (default: 'Complete')
+            (in whatever order it is passed). If `None`, use all genes of the name list.
+        data : {'Complete', 'Group', 'Rest', 'Groups'}, optional (default: 'Complete')
             At the moment, this is only relevant for the case that name_list is drawn from rank_gene_groups results.
             If specified, collects mask for the called group and then takes only those cells specified.
             If 'Complete', calculate correlation using full data
             If 'Group', calculate correlation within the selected group.
             If 'Rest', calculate corrlation for everything except the group
+            If 'Groups', calculate correlation within each group of `groupby`.
         method : {‘pearson’, ‘kendall’, ‘spearman’} optional (default: 'pearson')
             Which kind of correlation coefficient to use
             pearson : standard correlation coefficient
-            kendall : Kendall Tau correlation coefficient
+            kendall : Kendall Tau correlation coefficient, densifies the data
             spearman : Spearman rank correlation
         annotation_key: String, optional (default: None)
             Allows to define the name of the anndata entry where results are stored.
-
-
-
+            For `data='Groups'`, the group name is appended.
     """
 
     # TODO: At the moment, only works for int identifiers
 
     ### If no genes are passed, selects ranked genes from sample annotation.
-    ### At the moment, only calculate one table (Think about what comes next)
     if name_list is None:
         name_list = list()
         for j, k in enumerate(adata.uns['rank_genes_groups_gene_names']):
-            if j >=n_genes:
+            if n_genes is not None and j >= n_genes:
                 break
             name_list.append(adata.uns['rank_genes_groups_gene_names'][j][group])
-    else:
-        if len(name_list)>n_genes:
-            name_list=name_list[0:n_genes]
-
-
-    # If special method (later) , truncate
-    adata_relevant = adata[:, name_list]
-    # This line just makes group_mask access easier. Nothing else but 'all' will stand here.
-    groups = 'all'
-    if data is 'Complete' or groupby is None:
-        if issparse(adata_relevant.X):
-            Data_array = adata_relevant.X.todense()
+    elif n_genes is not None and len(name_list) > n_genes:
+        name_list = name_list[0:n_genes]
+    if method not in {'pearson', 'kendall', 'spearman'}:
+        raise ValueError('`method` needs to be one of \'pearson\', \'kendall\' or \'spearman\'.')
+
+    indexer = adata.var_names.get_indexer(name_list)
+    if (indexer < 0).any():
+        raise KeyError('Genes {} are not in `adata.var_names`.'
+                       .format([name for name, i in zip(name_list, indexer) if i < 0]))
+    X = adata.X[:, indexer]
+    # a single group holds the selected cells, unless all groups are computed
+    group_index = utils.GroupIndex(np.zeros(adata.n_obs, dtype=int), [None])
+    if data != 'Complete' and groupby is not None:
+        groups_index = utils.GroupIndex.from_adata(adata, groupby)
+        if data == 'Group':
+            group_index = utils.GroupIndex(
+                np.where(groups_index.mask(group), 0, -1), [None])
+        elif data == 'Rest':
+            group_index = utils.GroupIndex(
+                np.where(groups_index.mask(group), -1, 0), [None])
+        elif data == 'Groups':
+            group_index = groups_index
         else:
-            Data_array = adata_relevant.X
+            raise ValueError('`data` needs to be one of \'Complete\', \'Group\', \'Rest\' or \'Groups\'.')
+    keys = list(group_index.names)
+    if method == 'kendall':
+        cor_tables = []
+        for igroup in range(group_index.n_groups):
+            X_group = X[group_index.indices(igroup)]
+            X_group = X_group.toarray() if issparse(X_group) else X_group
+            cor_tables.append(pd.DataFrame(X_group, columns=name_list).corr(method=method))
     else:
-        # get group_mask
-        groups_order, groups_masks = utils.select_groups(
-            adata, groups, groupby)
-        if data is 'Group':
-            if issparse(adata_relevant.X):
-                Data_array = adata_relevant.X[groups_masks[group], :].todense()
-            else:
-                Data_array = adata_relevant.X[groups_masks[group], :]
-        elif data is 'Rest':
-            if issparse(adata_relevant.X):
-                Data_array = adata_relevant.X[~groups_masks[group], :].todense()
+        cor_tables = [pd.DataFrame(corr, index=name_list, columns=name_list)
+                      for corr in _correlation_groups(X, group_index, method)]
+
+    for key, cor_table in zip(keys, cor_tables):
+        suffix = '' if key is None else str(key)
+        if annotation_key is None:
+            if groupby is None:
+                adata.uns['Correlation_matrix'] = cor_table
+            elif key is None:
+                adata.uns['Correlation_matrix'+groupby+str(group)]=cor_table
             else:
-                Data_array = adata_relevant.X[~groups_masks[group], :]
+                adata.uns['Correlation_matrix'+groupby+suffix]=cor_table
         else:
-            logg.error('data argument should be either <Complete> or <Group> or <Rest>' )
+            adata.uns[annotation_key + suffix] = cor_table
 
-    # Distinguish between sparse and non-sparse data
 
+def _correlation_groups(X, group_index, method='pearson'):
+    """Pearson or Spearman correlation matrices of the columns of `X` within groups.
 
-    DF_array = pd.DataFrame(Data_array, columns=name_list)
-    cor_table = DF_array.corr(method=method)
-    if annotation_key is None:
-        if groupby is None:
-            adata.uns['Correlation_matrix'] = cor_table
-        else:
-            adata.uns['Correlation_matrix'+groupby+str(group)]=cor_table
+    Rows are permuted by group once, hence all groups of the `utils.GroupIndex`
+    `group_index` are processed in one pass. Returns an array of shape
+    `n_groups` × `n_vars` × `n_vars`, with `nan` for constant columns.
+    """
+    from scipy.sparse import csr_matrix
+    n_vars = X.shape[1]
+    n_groups = group_index.n_groups
+    X = csr_matrix(X, dtype=np.float64)[group_index.order]
+    corrs = np.full((n_groups, n_vars, n_vars), np.nan)
+    for igroup in range(n_groups):
+        X_group = X[group_index.slice(igroup)]
+        n = X_group.shape[0]
+        if n < 2: continue
+        if method == 'spearman':
+            X_group = _rank_columns(X_group)
+        sums = np.asarray(X_group.sum(axis=0)).ravel()
+        cov = X_group.T.dot(X_group).toarray() - np.outer(sums, sums) / n
+        std = np.sqrt(np.maximum(np.diag(cov), 0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = cov / np.outer(std, std)
+        corrs[igroup] = np.clip(corr, -1, 1)
+    return corrs
+
+
+def _rank_columns(X):
+    """Average ranks of the columns of a sparse matrix with all zeros tied.
+
+    Ranks are shifted by the rank of the zeros, so that zeros stay zero and
+    the result is as sparse as `X`. This does not change correlations.
+    """
+    from scipy.sparse import csc_matrix
+    from .rank_genes_groups import _rank_block
+    X = csc_matrix(X, dtype=np.float64, copy=True)
+    genes, obs, ranks, rank_zeros, _ = _rank_block(X)
+    return csc_matrix((ranks - rank_zeros[genes], (obs, genes)), shape=X.shape)
+
+
+def ROC_AUC_analysis(adata, groupby, group=None, n_genes=100, n_jobs=None):
+    """Calculate ROC AUC of all genes for all groups.
+
+    The AUC of a gene for a group versus the rest is the normalized
+    Mann-Whitney U statistic, `U / (n_group * n_rest)`. It is computed for all
+    genes and groups from the rank sums of a single ranking pass over the
+    genes, which keeps sparse data sparse. Full ROC curves are only computed
+    for the top ranked genes of `group`, if passed.
+
+    Parameters
+    ----------
+    adata : :class:`~scanpy.api.AnnData`
+        Annotated data matrix.
+    groupby : `str`
+        The key of the sample grouping to consider.
+    group : `str`, `int` or `None`, optional (default: `None`)
+        Group name or index for which ROC curves of the top ranked genes
+        should be calculated. If `None`, only the AUC matrix is calculated.
+    n_genes : `int`, optional (default: 100)
+        For how many genes to calculate ROC curves. Genes are taken from the
+        results of `rank_genes_groups` if present, otherwise genes are ranked
+        by AUC.
+    n_jobs : `int` or `None`, optional (default: `None`)
+        Number of CPUs to use for ranking (default: `sc.settings.n_jobs`).
+
+    Returns
+    -------
+    auc : `pd.DataFrame`
+        AUC of shape `n_groups` × `n_vars`, also stored as
+        ``adata.uns['ROC_AUC' + groupby]``. If `group` is passed, the ROC
+        curves and AUCs of its top ranked genes are stored as dicts in
+        ``adata.uns['ROCfpr' + groupby + str(group)]``, 'ROCtpr',
+        'ROCthresholds' and 'ROC_AUC' respectively.
+    """
+    from .rank_genes_groups import _get_rank_sums
+    group_index = utils.GroupIndex.from_adata(adata, groupby)
+    groups_order = group_index.names
+    n_jobs = settings.n_jobs if n_jobs is None else n_jobs
+    rank_sums, _ = _get_rank_sums(adata.X, group_index.codes, group_index.n_groups,
+                                  n_jobs=n_jobs)
+    n_group = group_index.sizes[:, None]
+    n_rest = adata.n_obs - n_group
+    with np.errstate(divide='ignore', invalid='ignore'):
+        auc = (rank_sums - n_group * (n_group + 1) / 2) / (n_group * n_rest)
+    auc = pd.DataFrame(auc, index=groups_order, columns=adata.var_names)
+    adata.uns['ROC_AUC' + groupby] = auc
+    if group is None:
+        return auc
+
+    from sklearn import metrics
+    imask = group if isinstance(group, (int, np.integer)) else list(groups_order).index(group)
+    if 'rank_genes_groups_gene_names' in adata.uns:
+        gene_names = adata.uns['rank_genes_groups_gene_names']
+        field = gene_names.dtype.names[group] if isinstance(group, (int, np.integer)) else group
+        name_list = list(gene_names[field][:n_genes])
     else:
-        adata.uns[annotation_key] = cor_table
-
-
+        name_list = list(auc.columns[np.argsort(-auc.values[imask])[:n_genes]])
+    X = adata[:, name_list].X
+    X = X.toarray() if issparse(X) else np.asarray(X).reshape(adata.n_obs, -1)
+    fpr, tpr, thresholds, roc_auc = {}, {}, {}, {}
+    for i, name in enumerate(name_list):
+        fpr[name], tpr[name], thresholds[name] = metrics.roc_curve(
+            group_index.mask(imask), X[:, i], drop_intermediate=False)
+        roc_auc[name] = auc.values[imask, adata.var_names.get_loc(name)]
+    adata.uns['ROCfpr' + groupby + str(group)] = fpr
+    adata.uns['ROCtpr' + groupby + str(group)] = tpr
+    adata.uns['ROCthresholds' + groupby + str(group)] = thresholds
+    adata.uns['ROC_AUC' + groupby + str(group)] = roc_auc
+    return auc
 
+def _get_tail_stats(X, group_index):
+    """Expression rate and mean and variance of the nonzeros of all genes.
 
-from sklearn import metrics
-def ROC_AUC_analysis(adata,groupby,group=None, n_genes=100):
-    """Calculate correlation matrix.
+    Computed for each group of the `utils.GroupIndex` `group_index` and the
+    rest of each group in one pass over the nonzeros of `X`, which may be
+    CSR, CSC or dense.
 
-            Calculate a correlation matrix for genes strored in sample annotation using rank_genes_groups.py
-
-            Parameters
-            ----------
-            adata : :class:`~scanpy.api.AnnData`
-                Annotated data matrix.
-            groupby : `str`
-                The key of the sample grouping to consider.
-            group : `str`, int, optional (default: None)
-                Group name or index for which the correlation matrix for top_ranked genes should be calculated.
-                If no parameter is passed, ROC/AUC is calculated for all groups
-            n_genes : `int`, optional (default: 100)
-                For how many genes to calculate ROC and AUC. If no parameter is passed, calculation is done for
-                all stored top ranked genes.
-
-        """
-    if group is None:
-        pass
-        # TODO: Loop over all groups instead of just taking one.
-
-    # Assume group takes an int value for one group for the moment.
-    name_list = list()
-    for j, k in enumerate(adata.uns['rank_genes_groups_gene_names']):
-        if j >= n_genes:
-            break
-        name_list.append(adata.uns['rank_genes_groups_gene_names'][j][group])
-
-
-    # TODO: For the moment, see that everything works for comparison against the rest. Resolve issues later.
-    groups = 'all'
-    groups_order, groups_masks = utils.select_groups(
-        adata, groups, groupby)
-
-    # Use usual convention, better for looping later.
-    imask = group
-    mask = groups_masks[group]
-
-    # TODO: Allow for sample weighting requires better mask access... later
-
-    # We store calculated data in dict, access it via dict to dict. Check if this is the best way.
-    fpr={}
-    tpr={}
-    thresholds={}
-    roc_auc={}
-    y_true=mask
-    for i, j in enumerate(name_list):
-        vec=adata[:,[j]].X
-        if issparse(vec):
-            y_score = vec.todense()
-        else:
-            y_score = vec
+    Returns
+    -------
+    rates, means, variances : `np.ndarray`
+        Arrays of shape 2 × `n_groups` × `n_vars`, the first index selects
+        groups (0) or their rest (1). Means and variances of genes without
+        nonzeros are `nan`.
+    """
+    n_obs, n_vars = X.shape
+    if issparse(X):
+        X = X if X.format in {'csr', 'csc'} else X.tocsr()
+        major = np.repeat(np.arange(len(X.indptr) - 1), np.diff(X.indptr))
+        obs, genes = (major, X.indices) if X.format == 'csr' else (X.indices, major)
+        data = X.data
+    else:
+        obs, genes = np.nonzero(X)
+        data = X[obs, genes]
+    is_nonzero = data != 0
+    obs, genes = obs[is_nonzero], genes[is_nonzero]
+    data = np.asarray(data[is_nonzero], dtype=np.float64)
+    n_groups = group_index.n_groups
+    # observations in no group are collected in an additional group
+    obs_codes = group_index.codes[obs]
+    index = np.where(obs_codes >= 0, obs_codes, n_groups) * n_vars + genes
+    size = (n_groups + 1) * n_vars
+    nnz, sums, sums_sq = [
+        np.bincount(index, weights=weights, minlength=size).reshape(n_groups + 1, n_vars)
+        for weights in [None, data, data**2]]
+    nnz, sums, sums_sq = [np.stack([x[:-1], x.sum(axis=0) - x[:-1]])
+                          for x in [nnz, sums, sums_sq]]
+    n_group = group_index.sizes
+    n_cells = np.stack([n_group, n_obs - n_group])[:, :, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rates = nnz / n_cells
+        means = sums / nnz
+        variances = np.maximum(sums_sq / nnz - means**2, 0)
+    return rates, means, variances
 
-        fpr[name_list[i]], tpr[name_list[i]], thresholds[name_list[i]] = metrics.roc_curve(y_true, y_score, pos_label=None, sample_weight=None, drop_intermediate=False)
-        roc_auc[name_list[i]]=metrics.auc(fpr[name_list[i]],tpr[name_list[i]])
-    adata.uns['ROCfpr' +groupby+ str(group)] = fpr
-    adata.uns['ROCtpr' +groupby+ str(group)] = tpr
-    adata.uns['ROCthresholds' +groupby+ str(group)] = thresholds
-    adata.uns['ROC_AUC' + groupby + str(group)] = roc_auc
 
 def subsampled_estimates(mask, mask_rest=None, precision=0.01, probability=0.99):
     ## Simple method that can be called by rank_gene_group. It uses masks that have been passed to the function and
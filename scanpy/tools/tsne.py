@@ -1,9 +1,13 @@
 import numpy as np
+from scipy.sparse import csr_matrix, coo_matrix
 from ..tools.pca import pca
+from ..preprocessing.simple import _materialize_scaled
 from .. import settings
+from .. import utils
 from .. import logging as logg
 
 
+@utils.check_float_dtype
 def tsne(
         adata,
         n_pcs=50,
@@ -12,6 +16,7 @@ def tsne(
         learning_rate=1000,
         random_state=0,
         use_fast_tsne=True,
+        use_data_graph=False,
         recompute_pca=False,
         n_jobs=None,
         copy=False):
@@ -24,6 +29,12 @@ def tsne(
     <https://github.com/DmitryUlyanov/Multicore-TSNE>`__ by [Ulyanov16]_, which
     will be automatically detected by Scanpy.
 
+    If a data graph is stored in `adata`, e.g., from `louvain` or
+    `draw_graph`, the perplexity-calibrated affinities are computed from its
+    kNN distances and passed to the optimizer of *scikit-learn* directly.
+    This skips the neighbor search of the t-SNE implementations, also when
+    rerunning with different optimization parameters.
+
     Parameters
     ----------
     adata : :class:`~scanpy.api.AnnData`
@@ -55,7 +66,14 @@ def tsne(
         Change this to use different intial states for the optimization. If `None`,
         the initial state is not reproducible.
     use_fast_tsne : `bool`, optional (default: `True`)
-        Use the MulticoreTSNE package by D. Ulyanov if it is installed.
+        Use the MulticoreTSNE package by D. Ulyanov if it is installed. Does
+        not apply if the affinities are computed from the data graph.
+    use_data_graph : `bool`, optional (default: `False`)
+        Compute the affinities from the distances of the data graph stored in
+        `adata.uns['data_graph_distance_local']`, which is computed if needed.
+        As each cell has only `n_neighbors - 1` neighbors in the graph,
+        `n_neighbors` should be at least `3 * perplexity + 1` as for the other
+        implementations.
     n_jobs : `int` or `None` (default: `sc.settings.n_jobs`)
         Number of jobs.
     copy : `bool` (default: `False`)
@@ -70,6 +88,29 @@ def tsne(
     """
     logg.info('computing tSNE', r=True)
     adata = adata.copy() if copy else adata
+    if use_data_graph and not _sklearn_optimizer_is_supported():
+        import sklearn
+        raise ValueError('`use_data_graph=True` is not supported for '
+                         'sklearn version {}.'.format(sklearn.__version__))
+    n_jobs = settings.n_jobs if n_jobs is None else n_jobs
+    if use_data_graph:
+        X_tsne = _tsne_from_data_graph(
+            adata, n_pcs, perplexity, early_exaggeration, learning_rate,
+            random_state, recompute_pca, n_jobs)
+    else:
+        X_tsne = _tsne_from_X(
+            adata, n_pcs, perplexity, early_exaggeration, learning_rate,
+            random_state, use_fast_tsne, recompute_pca, n_jobs)
+    # update AnnData instance
+    adata.obsm['X_tsne'] = X_tsne.astype(settings.float_dtype, copy=False)  # annotate samples with tSNE coordinates
+    logg.info('    finished', time=True, end=' ' if settings.verbosity > 2 else '\n')
+    logg.hint('added\n'
+              '    \'X_tsne\', tSNE coordinates (adata.obs)')
+    return adata if copy else None
+
+
+def _tsne_from_X(adata, n_pcs, perplexity, early_exaggeration, learning_rate,
+                 random_state, use_fast_tsne, recompute_pca, n_jobs):
     # preprocessing by PCA
     if (n_pcs > 0
         and 'X_pca' in adata.obsm_keys()
@@ -82,9 +123,10 @@ def tsne(
         if n_pcs > 0 and adata.X.shape[1] > n_pcs:
             logg.info('    computing \'X_pca\' with n_pcs = {}'.format(n_pcs))
             logg.hint('avoid this by setting n_pcs = 0')
-            X = pca(adata.X, random_state=random_state, n_comps=n_pcs)
-            adata.obsm['X_pca'] = X
+            pca(adata, random_state=random_state, n_comps=n_pcs)
+            X = adata.obsm['X_pca']
         else:
+            _materialize_scaled(adata)
             X = adata.X
             logg.info('    using data matrix X directly (no PCA)')
     # params for sklearn
@@ -94,7 +136,6 @@ def tsne(
                       'early_exaggeration': early_exaggeration,
                       'learning_rate': learning_rate,
                       }
-    n_jobs = settings.n_jobs if n_jobs is None else n_jobs
     # deal with different tSNE implementations
     multicore_failed = True
     if n_jobs >= 1 and use_fast_tsne:
@@ -117,9 +158,102 @@ def tsne(
         tsne = TSNE(**params_sklearn)
         logg.info('    using sklearn.manifold.TSNE with a fix by D. DeTomaso')
         X_tsne = tsne.fit_transform(X)
-    # update AnnData instance
-    adata.obsm['X_tsne'] = X_tsne  # annotate samples with tSNE coordinates
-    logg.info('    finished', time=True, end=' ' if settings.verbosity > 2 else '\n')
-    logg.hint('added\n'
-              '    \'X_tsne\', tSNE coordinates (adata.obs)')
-    return adata if copy else None
+    return X_tsne
+
+
+def _tsne_from_data_graph(adata, n_pcs, perplexity, early_exaggeration,
+                          learning_rate, random_state, recompute_pca, n_jobs):
+    from sklearn.manifold import TSNE
+    from ..data_structs.data_graph import add_or_update_graph_in_adata
+    graph = add_or_update_graph_in_adata(
+        adata, n_pcs=n_pcs, recompute_pca=recompute_pca, n_jobs=n_jobs)
+    distances = adata.uns['data_graph_distance_local']
+    if graph.k is not None and perplexity > (graph.k - 1) / 3:
+        logg.warn('The data graph has n_neighbors = {}, consider recomputing it '
+                  'with n_neighbors >= {} for perplexity = {}.'
+                  .format(graph.k, int(np.ceil(3 * perplexity + 1)), perplexity))
+    logg.info('    computing affinities from the data graph with perplexity = {}'
+              .format(perplexity))
+    P = _get_affinities(distances, perplexity)
+    tsne = TSNE(perplexity=perplexity,
+                random_state=random_state,
+                verbose=max(0, settings.verbosity-3),
+                early_exaggeration=early_exaggeration,
+                learning_rate=learning_rate)
+    # attributes that `fit` sets for `_tsne`, their names depend on the
+    # version of sklearn
+    tsne._learning_rate = tsne.learning_rate_ = learning_rate
+    max_iter = [getattr(tsne, key, None) for key in ['max_iter', 'n_iter', '_max_iter']]
+    tsne._max_iter = next((n for n in max_iter if isinstance(n, int)), 1000)
+    # random initialization as in sklearn.manifold.TSNE
+    X_embedded = 1e-4 * np.random.RandomState(random_state).randn(
+        P.shape[0], 2).astype(np.float32)
+    logg.info('    using the optimizer of sklearn.manifold.TSNE')
+    return tsne._tsne(P, degrees_of_freedom=1, n_samples=P.shape[0],
+                      X_embedded=X_embedded)
+
+
+def _sklearn_optimizer_is_supported():
+    """Whether `TSNE._tsne` has the signature of sklearn 0.19 to 1.x."""
+    import inspect
+    from sklearn.manifold import TSNE
+    parameters = inspect.signature(TSNE._tsne).parameters
+    return all(name in parameters for name in
+               ['P', 'degrees_of_freedom', 'n_samples', 'X_embedded'])
+
+
+def _get_affinities(distances, perplexity, tol=1e-5, max_iter=100):
+    """Symmetric t-SNE affinities from squared distances to the neighbors.
+
+    The precision of the Gaussian kernel of each row is found by a binary
+    search on the entropy, which is carried out for all rows at once.
+
+    Parameters
+    ----------
+    distances : `np.ndarray` or `sp.spmatrix`
+        Squared distances, only the stored off-diagonal entries are used.
+    perplexity : `float`
+        Perplexity of the conditional distributions.
+
+    Returns
+    -------
+    P : `sp.csr_matrix`
+        Joint probabilities, symmetric and summing to 1.
+    """
+    distances = coo_matrix(distances)
+    off_diagonal = distances.row != distances.col
+    distances = csr_matrix(
+        (distances.data[off_diagonal],
+         (distances.row[off_diagonal], distances.col[off_diagonal])),
+        shape=distances.shape)
+    n_obs = distances.shape[0]
+    rows = np.repeat(np.arange(n_obs), np.diff(distances.indptr))
+    d = distances.data.astype(np.float64)
+    desired_entropy = np.log(perplexity)
+    beta = np.ones(n_obs)
+    beta_min = np.full(n_obs, -np.inf)
+    beta_max = np.full(n_obs, np.inf)
+    for _ in range(max_iter):
+        p = np.exp(-d * beta[rows])
+        sum_p = np.bincount(rows, weights=p, minlength=n_obs)
+        sum_p[sum_p == 0] = 1e-8
+        entropy = (np.log(sum_p)
+                   + beta * np.bincount(rows, weights=d * p, minlength=n_obs) / sum_p)
+        diff = entropy - desired_entropy
+        if np.all(np.abs(diff) <= tol): break
+        # too large entropy: increase the precision
+        increase = diff > 0
+        beta_min[increase] = beta[increase]
+        beta_max[~increase] = beta[~increase]
+        beta = np.where(
+            increase,
+            np.where(np.isinf(beta_max), beta * 2, (beta + beta_max) / 2),
+            np.where(np.isinf(beta_min), beta / 2, (beta + beta_min) / 2))
+    p = np.exp(-d * beta[rows])
+    sum_p = np.bincount(rows, weights=p, minlength=n_obs)
+    sum_p[sum_p == 0] = 1e-8
+    P = csr_matrix((p / sum_p[rows], distances.indices, distances.indptr),
+                   shape=distances.shape)
+    P = P + P.T
+    P /= max(P.sum(), np.finfo(np.double).eps)
+    return P
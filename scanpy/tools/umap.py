@@ -1,17 +1,30 @@
+import numpy as np
+from scipy.sparse import coo_matrix, issparse
+from sklearn.utils import check_random_state
+from ..tools.pca import pca
+from ..preprocessing.simple import _materialize_scaled
+from ..data_structs.data_graph import get_sorted_neighbors_from_sparse_matrix
 from .. import settings
+from .. import utils
 from .. import logging as logg
 
 
+@utils.check_float_dtype
 def umap(
         adata,
         n_neighbors=15,
         n_components=2,
         min_dist=0.1,
+        spread=1.0,
         metric='euclidean',
         alpha=1.0,
         init='spectral',
         local_connectivity=1.0,
         random_state=None,
+        n_pcs=50,
+        use_data_graph=False,
+        recompute_pca=False,
+        recompute_graph=False,
         copy=False,
         umap_kwargs={}):
     """UMAP [McInnes18]_.
@@ -22,9 +35,13 @@ def umap(
     arguably preserves more of the global structure.  We use the implementation
     of `umap-learn <https://github.com/lmcinnes/umap>`_ [McInnes18]_.
 
-    *Note:* In contrast to other embeddings within Scanpy, UMAP does *not* use a
-    PCA-reduced version of the data. We might change this behavior in the
-    future.
+    As the other embeddings within Scanpy, UMAP uses the PCA representation of
+    the data. With `use_data_graph`, the kNN indices and distances of a data
+    graph stored in `adata`, e.g., from `louvain` or `draw_graph`, are used
+    instead of searching neighbors. The fuzzy simplicial set is stored in
+    `adata.uns['umap_graph']` and reused as long as the parameters that
+    determine it do not change. Hence, rerunning with other `min_dist`,
+    `spread`, `alpha` or `init` only reruns the optimization of the embedding.
 
     Parameters
     ----------
@@ -47,6 +64,10 @@ def umap(
         result on a more even dispersal of points. The value should be set
         relative to the ``spread`` value, which determines the scale at which
         embedded points will be spread out.
+    spread : `float`, optional (default: 1.0)
+        The effective scale of embedded points. In combination with
+        `min_dist` this determines how clustered/clumped the embedded points
+        are.
     metric : `string` or `function`, optional (default: 'euclidean')
         The metric to use to compute distances in high dimensional space.
         If a string is passed it must match a valid predefined metric. If
@@ -98,9 +119,22 @@ def umap(
         If RandomState instance, random_state is the random number generator;
         If None, the random number generator is the RandomState instance used
         by `np.random`.
+    n_pcs : `int`, optional (default: 50)
+        Number of principal components in preprocessing PCA. Set to 0 if you
+        do not want preprocessing with PCA.
+    use_data_graph : `bool`, optional (default: `False`)
+        Use the `n_neighbors - 1` nearest neighbors of each cell in the data
+        graph stored in `adata.uns['data_graph_distance_local']`, which needs
+        to have at least as many. The data graph has to be computed with
+        euclidean distances on the same representation, e.g., the same
+        `n_pcs`.
+    recompute_pca : `bool`, optional (default: `False`)
+        Recompute 'X_pca' even if it is present.
+    recompute_graph : `bool`, optional (default: `False`)
+        Recompute the fuzzy simplicial set even if it is stored in `adata`.
     umap_kwargs : `dict`, optional (default: `{}`)
-        Additional keyword arguments for UMAP class constructor from umap-learn
-        package.
+        Further parameters of umap-learn: 'gamma', 'negative_sample_rate',
+        'n_epochs', 'set_op_mix_ratio' and 'metric_kwds'.
 
     Returns
     -------
@@ -108,6 +142,8 @@ def umap(
 
     X_umap : `np.ndarray` (`adata.obs`, dtype `float`)
         UMAP coordinates of data.
+    umap_graph : `sp.csr_matrix` (`adata.uns`)
+        The fuzzy simplicial set, along with 'umap_graph_params'.
     """
     try:
         import umap
@@ -118,27 +154,128 @@ def umap(
 
     logg.info('computing UMAP', r=True)
     adata = adata.copy() if copy else adata
-
-    # params for umap-learn
-    params_umap = {'n_neighbors': n_neighbors,
-                   'n_components': n_components,
-                   'min_dist': min_dist,
-                   'metric': metric,
-                   'alpha': alpha,
-                   'init': init,
-                   'local_connectivity': local_connectivity,
-                   'random_state': random_state,
-                   'verbose': max(0, settings.verbosity-3),
-                   **umap_kwargs
-                   }
-
-    um = umap.UMAP(**params_umap)
-    X_umap = um.fit_transform(adata.X)
-
+    params = {'gamma': 1.0,
+              'negative_sample_rate': 5,
+              'n_epochs': None,
+              'set_op_mix_ratio': 1.0,
+              'metric_kwds': {}}
+    unknown = set(umap_kwargs) - set(params)
+    if unknown:
+        raise ValueError('Unknown `umap_kwargs` {}, only {} are supported.'
+                         .format(unknown, set(params)))
+    params.update(umap_kwargs)
+    random_state = check_random_state(random_state)
+    X = _get_X(adata, n_pcs, random_state, recompute_pca)
+    distances = adata.uns.get('data_graph_distance_local', None)
+    n_stored = (np.diff(distances.indptr).min() + 1
+                if distances is not None and issparse(distances) else 0)
+    if use_data_graph and n_stored < n_neighbors:
+        raise ValueError('The data graph needs to have at least '
+                         'n_neighbors = {}, recompute it with '
+                         '`n_neighbors` >= {}.'.format(n_neighbors, n_neighbors))
+    # the fingerprint detects a recomputed 'X_pca' or data graph
+    graph_params = np.array(
+        (n_neighbors, n_pcs, str(metric), local_connectivity,
+         params['set_op_mix_ratio'], use_data_graph,
+         _get_input_fingerprint(X, distances if use_data_graph else None)),
+        dtype=[('n_neighbors', int), ('n_pcs', int), ('metric', 'U40'),
+               ('local_connectivity', float), ('set_op_mix_ratio', float),
+               ('use_data_graph', bool), ('fingerprint', 'U40')])
+    if (not recompute_graph and not recompute_pca
+        and isinstance(metric, str) and not params['metric_kwds']
+        and 'umap_graph' in adata.uns
+        and 'umap_graph_params' in adata.uns
+        and adata.uns['umap_graph_params'].dtype == graph_params.dtype
+        and adata.uns['umap_graph_params'] == graph_params):
+        logg.info('    using stored fuzzy simplicial set')
+        graph = adata.uns['umap_graph']
+    else:
+        knn_indices, knn_dists = None, None
+        if use_data_graph:
+            logg.info('    using the {} nearest neighbors of the data graph'
+                      .format(n_neighbors - 1))
+            knn_indices, knn_dists = get_sorted_neighbors_from_sparse_matrix(
+                distances, n_neighbors)
+            # the data graph stores squared euclidean distances
+            knn_dists = np.sqrt(knn_dists)
+        graph = _get_fuzzy_simplicial_set(
+            X, n_neighbors, metric, params['metric_kwds'], local_connectivity,
+            params['set_op_mix_ratio'], random_state, knn_indices, knn_dists)
+        adata.uns['umap_graph'] = graph
+        adata.uns['umap_graph_params'] = graph_params
+    X_umap = _embed(X, graph, n_components, min_dist, spread, alpha, init,
+                    metric, params, random_state)
     # update AnnData instance
-    adata.obsm['X_umap'] = X_umap  # annotate samples with UMAP coordinates
+    adata.obsm['X_umap'] = X_umap.astype(settings.float_dtype, copy=False)  # annotate samples with UMAP coordinates
     logg.info('    finished', time=True, end=' ' if settings.verbosity > 2 else '\n')
     logg.hint('added\n'
-              '    \'X_umap\', UMAP coordinates (adata.obs)')
-
+              '    \'X_umap\', UMAP coordinates (adata.obs)\n'
+              '    \'umap_graph\', fuzzy simplicial set (adata.uns)')
     return adata if copy else None
+
+
+def _get_X(adata, n_pcs, random_state, recompute_pca):
+    if (n_pcs > 0
+        and 'X_pca' in adata.obsm_keys()
+        and adata.obsm['X_pca'].shape[1] >= n_pcs
+        and not recompute_pca):
+        logg.info('    using \'X_pca\' with n_pcs = {}'.format(n_pcs))
+        return adata.obsm['X_pca'][:, :n_pcs]
+    if n_pcs > 0 and adata.X.shape[1] > n_pcs:
+        logg.info('    computing \'X_pca\' with n_pcs = {}'.format(n_pcs))
+        logg.hint('avoid this by setting n_pcs = 0')
+        pca(adata, random_state=random_state, n_comps=n_pcs)
+        return adata.obsm['X_pca']
+    logg.info('    using data matrix X directly (no PCA)')
+    _materialize_scaled(adata)
+    return adata.X
+
+
+def _get_input_fingerprint(X, distances=None):
+    """Hash of the data and the data graph that determine the fuzzy simplicial set."""
+    from hashlib import sha1
+    if issparse(X):
+        fingerprint = sha1(utils._get_adjacency_fingerprint(X).encode())
+    else:
+        X = np.ascontiguousarray(X)
+        fingerprint = sha1(np.array(X.shape).tobytes())
+        fingerprint.update(X.view(np.uint8))
+    if distances is not None:
+        fingerprint.update(utils._get_adjacency_fingerprint(distances).encode())
+    return fingerprint.hexdigest()
+
+
+def _get_fuzzy_simplicial_set(X, n_neighbors, metric, metric_kwds,
+                              local_connectivity, set_op_mix_ratio,
+                              random_state, knn_indices, knn_dists):
+    from umap.umap_ import fuzzy_simplicial_set
+    graph = fuzzy_simplicial_set(
+        X, n_neighbors, random_state, metric, metric_kwds,
+        knn_indices=knn_indices, knn_dists=knn_dists,
+        set_op_mix_ratio=set_op_mix_ratio,
+        local_connectivity=local_connectivity,
+        verbose=max(0, settings.verbosity-3))
+    # newer versions of umap-learn also return sigmas and rhos
+    if isinstance(graph, tuple): graph = graph[0]
+    return graph.tocsr()
+
+
+def _embed(X, graph, n_components, min_dist, spread, alpha, init, metric,
+           params, random_state):
+    from inspect import signature
+    from umap.umap_ import find_ab_params, simplicial_set_embedding
+    a, b = find_ab_params(spread, min_dist)
+    n_epochs = params['n_epochs']
+    if n_epochs is None:
+        n_epochs = 500 if graph.shape[0] <= 10000 else 200
+    kwargs = {}
+    # newer versions of umap-learn
+    if 'densmap' in signature(simplicial_set_embedding).parameters:
+        kwargs.update(densmap=False, densmap_kwds={}, output_dens=False)
+    X_umap = simplicial_set_embedding(
+        X, coo_matrix(graph), n_components, alpha, a, b,
+        params['gamma'], params['negative_sample_rate'], n_epochs, init,
+        random_state, metric, params['metric_kwds'],
+        verbose=max(0, settings.verbosity-3), **kwargs)
+    if isinstance(X_umap, tuple): X_umap = X_umap[0]
+    return X_umap
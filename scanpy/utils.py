@@ -2,6 +2,7 @@
 """
 
 from collections import namedtuple
+from functools import wraps
 import numpy as np
 import pandas as pd
 from natsort import natsorted
@@ -38,31 +39,124 @@ def get_graph_tool_from_adjacency(adjacency, directed=None):
     return g
 
 
+_igraph_cache = {}
+
+
 def get_igraph_from_adjacency(adjacency, directed=None):
-    """Get igraph graph from adjacency matrix."""
-    import igraph as ig
-    sources, targets = adjacency.nonzero()
-    weights = adjacency[sources, targets]
-    if isinstance(weights, np.matrix):
-        weights = weights.A1
-    # if len(weights) > 0: weights = np.array(weights)
-    # else:
-    #     # hack for empty graph
-    #     sources, targets = np.ones(adjacency.shape).nonzero()
-    #     weights = np.array([1e-12 for i in range(len(sources))])  # dummy edges
-    # if adjacency.shape[0] < 20:
-    #     print(list(zip(sources, targets)), weights)
-    g = ig.Graph(directed=directed)
-    g.add_vertices(adjacency.shape[0])  # this adds adjacency.shap[0] vertices
-    g.add_edges(list(zip(sources, targets)))
-    g.es['weight'] = weights
+    """Get igraph graph from adjacency matrix.
+
+    Edges are read from the CSR arrays of `adjacency`. For undirected graphs,
+    each pair of symmetric entries yields a single edge whose weight is the
+    sum of both entries. If `settings.cache_igraph` is `True`, the graph of the
+    last adjacency matrix is cached by a fingerprint of its contents and
+    repeated calls for the same matrix return a copy of it. Free the cache
+    with `clear_igraph_cache()`.
+    """
+    adjacency = _get_csr(adjacency)
+    if settings.cache_igraph:
+        key = (_get_adjacency_fingerprint(adjacency), bool(directed))
+        if key in _igraph_cache:
+            logg.msg('    reusing cached igraph graph', v=4)
+            return _igraph_cache[key].copy()
+    sources, targets, weights = get_edges_from_adjacency(adjacency, directed)
+    g = get_igraph_from_edges(adjacency.shape[0], sources, targets, weights, directed)
     if g.vcount() != adjacency.shape[0]:
         logg.warn('The constructed graph has only {} nodes. '
                   'Your adjacency matrix contained redundant nodes.'
                   .format(g.vcount()))
+    clear_igraph_cache()
+    if settings.cache_igraph:
+        _igraph_cache[key] = g.copy()
+    return g
+
+
+def clear_igraph_cache():
+    """Free the graph cached by `get_igraph_from_adjacency`."""
+    _igraph_cache.clear()
+
+
+def get_igraph_from_edges(n_vertices, sources, targets, weights, directed=None):
+    """Get igraph graph from the arrays of `get_edges_from_adjacency`."""
+    import igraph as ig
+    g = ig.Graph(n=n_vertices,
+                 edges=np.column_stack([sources, targets]).tolist(),
+                 directed=bool(directed))
+    g.es['weight'] = weights
     return g
 
 
+def get_edges_from_adjacency(adjacency, directed=None):
+    """Sources, targets and weights of the edges of an adjacency matrix.
+
+    For undirected graphs, only edges with `source <= target` are returned,
+    the weight of such an edge sums the two symmetric entries of
+    `adjacency`.
+    """
+    from scipy.sparse import triu
+    adjacency = _get_csr(adjacency)
+    if not directed:
+        adjacency = triu(adjacency, k=1) + triu(adjacency.T, k=0)
+        adjacency = adjacency.tocsr()
+    sources = np.repeat(np.arange(adjacency.shape[0]), np.diff(adjacency.indptr))
+    nonzero = adjacency.data != 0
+    return sources[nonzero], adjacency.indices[nonzero], adjacency.data[nonzero]
+
+
+def get_induced_subgraph(adjacency, indices):
+    """Adjacency matrix of the subgraph induced by the nodes `indices`.
+
+    Extracts rows and columns in a single pass over the entries of the
+    selected rows, column indices are mapped through an int32 lookup table.
+
+    Parameters
+    ----------
+    adjacency : `sp.spmatrix` or `np.ndarray`
+        Adjacency matrix of the graph.
+    indices : `np.ndarray`
+        Indices or boolean mask of the nodes of the subgraph.
+
+    Returns
+    -------
+    CSR adjacency matrix whose nodes are ordered as `indices`.
+    """
+    from scipy.sparse import csr_matrix
+    adjacency = _get_csr(adjacency)
+    indices = np.asarray(indices)
+    if indices.dtype == bool:
+        indices = np.flatnonzero(indices)
+    n_nodes = len(indices)
+    lookup = np.full(adjacency.shape[1], -1, dtype=np.int32)
+    lookup[indices] = np.arange(n_nodes, dtype=np.int32)
+    starts = adjacency.indptr[indices]
+    lengths = adjacency.indptr[indices + 1] - starts
+    # positions of the entries of the selected rows in indices and data
+    positions = (np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+                 + np.arange(lengths.sum()))
+    cols = lookup[adjacency.indices[positions]]
+    keep = cols >= 0
+    rows = np.repeat(np.arange(n_nodes), lengths)[keep]
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n_nodes))])
+    return csr_matrix((adjacency.data[positions[keep]], cols[keep], indptr),
+                      shape=(n_nodes, n_nodes))
+
+
+def _get_csr(adjacency):
+    from scipy.sparse import csr_matrix, isspmatrix_csr
+    if isspmatrix_csr(adjacency):
+        return adjacency
+    return csr_matrix(adjacency)
+
+
+def _get_adjacency_fingerprint(adjacency):
+    """Hash of the shape and the CSR arrays of `adjacency`."""
+    from hashlib import sha1
+    adjacency = _get_csr(adjacency)
+    fingerprint = sha1(np.array(adjacency.shape).tobytes())
+    for array in [adjacency.indptr, adjacency.indices, adjacency.data]:
+        fingerprint.update(np.ascontiguousarray(array).view(np.uint8))
+    return fingerprint.hexdigest()
+
+
 def compute_association_matrix_of_groups(adata, prediction, reference,
                                          normalization='prediction',
                                          threshold=0.01, max_n_names=2):
@@ -350,42 +444,238 @@ def default_tool_argparser(description, example_parameters):
 
 def select_groups(adata, groups_order_subset='all', key='groups'):
     """Get subset of groups in adata.obs[key].
+
+    Returns the names of the groups and dense boolean masks, see
+    :class:`GroupIndex` for a compact representation.
     """
-    groups_order = adata.obs[key].cat.categories
     if key + '_masks' in adata.uns:
         groups_masks = adata.uns[key + '_masks']
-    else:
-        groups_masks = np.zeros((len(adata.obs[key].cat.categories),
-                                 adata.obs[key].values.size), dtype=bool)
-        for iname, name in enumerate(adata.obs[key].cat.categories):
-            # if the name is not found, fallback to index retrieval
-            if adata.obs[key].cat.categories[iname] in adata.obs[key].values:
-                mask = adata.obs[key].cat.categories[iname] == adata.obs[key].values
-            else:
-                mask = str(iname) == adata.obs[key].values
-            groups_masks[iname] = mask
-    groups_ids = list(range(len(groups_order)))
-    if groups_order_subset != 'all':
-        groups_ids = []
-        for name in groups_order_subset:
-            groups_ids.append(
-                np.where(adata.obs[key].cat.categories.values == name)[0][0])
-        if len(groups_ids) == 0:
+        group_index = GroupIndex.from_adata(adata, key, groups_order_subset)
+        if groups_order_subset != 'all':
+            ids = adata.obs[key].cat.categories.get_indexer(group_index.names)
+            groups_masks = groups_masks[ids]
+        return group_index.names, groups_masks
+    group_index = GroupIndex.from_adata(adata, key, groups_order_subset)
+    return group_index.names, group_index.masks
+
+
+class GroupIndex:
+    """Membership of observations in groups, built from categorical codes.
+
+    Stores the group index of each observation, a stable permutation that
+    sorts observations by group and the offsets of the groups within this
+    permutation. The observations of a group are a contiguous slice of the
+    permutation, hence, group operations do not need to scan boolean masks.
+    Observations that belong to no group have negative codes and are sorted
+    last.
+
+    Parameters
+    ----------
+    codes : `np.ndarray`
+        Group index of each observation, negative for no group.
+    names : array-like
+        Names of the groups.
+    """
+
+    def __init__(self, codes, names):
+        self.codes = np.asarray(codes, dtype=int)
+        self.names = np.asarray(names)
+        sort_codes = np.where(self.codes < 0, self.n_groups, self.codes)
+        self.order = np.argsort(sort_codes, kind='mergesort')
+        self.offsets = np.searchsorted(sort_codes[self.order], np.arange(self.n_groups + 1))
+
+    @classmethod
+    def from_adata(cls, adata, key, groups='all'):
+        """Index of the groups in the categorical annotation `adata.obs[key]`.
+
+        If `groups` is a list of group names, or indices as strings, only
+        these groups are indexed, in this order.
+        """
+        values = pd.Categorical(adata.obs[key])
+        categories, codes = values.categories, values.codes
+        if isinstance(groups, str) and groups == 'all':
+            return cls(codes, categories.values)
+        ids = []
+        for name in groups:
+            if name in categories:
+                ids.append(categories.get_loc(name))
             # fallback to index retrieval
-            groups_ids = np.where(
-                np.in1d(np.arange(len(adata.obs[key].cat.categories)).astype(str),
-                                          np.array(groups_order_subset)))[0]
-        if len(groups_ids) == 0:
-            logg.m(np.array(groups_order_subset),
-                   'invalid! specify valid groups_order (or indices) one of',
-                   adata.obs[key].cat.categories)
-            from sys import exit
-            exit(0)
-        groups_masks = groups_masks[groups_ids]
-        groups_order_subset = adata.obs[key].cat.categories[groups_ids].values
+            elif str(name).isdigit() and int(name) < len(categories):
+                ids.append(int(name))
+            else:
+                raise ValueError('{} is invalid! specify valid groups_order (or indices) one of {}'
+                                 .format(name, categories.tolist()))
+        remap = np.full(len(categories), -1)
+        remap[ids] = np.arange(len(ids))
+        codes = np.where(codes >= 0, remap[codes], -1)
+        return cls(codes, categories.values[ids])
+
+    @property
+    def n_groups(self):
+        return len(self.names)
+
+    @property
+    def sizes(self):
+        """Number of observations in each group."""
+        return np.diff(self.offsets)
+
+    def slice(self, igroup):
+        """Slice of group `igroup` in `order`."""
+        return slice(self.offsets[igroup], self.offsets[igroup + 1])
+
+    def indices(self, igroup):
+        """Sorted indices of the observations in group `igroup`."""
+        return self.order[self.slice(igroup)]
+
+    def mask(self, igroup):
+        """Boolean mask of the observations in group `igroup`."""
+        return self.codes == igroup
+
+    @property
+    def masks(self):
+        """Dense boolean masks of shape `n_groups` × `n_obs`."""
+        return self.codes[None, :] == np.arange(self.n_groups)[:, None]
+
+    def indicator(self, total=False):
+        """Sparse indicator matrix of shape `n_groups` × `n_obs`.
+
+        Products with data matrices aggregate observations per group. With
+        `total`, an additional last row holds all observations.
+        """
+        from scipy.sparse import csr_matrix
+        n_rows = self.n_groups + 1 if total else self.n_groups
+        indptr = self.offsets if not total else np.append(
+            self.offsets, self.offsets[-1] + len(self.codes))
+        indices = self.order[:self.offsets[-1]]
+        if total:
+            indices = np.concatenate([indices, np.arange(len(self.codes))])
+        return csr_matrix((np.ones(len(indices)), indices, indptr),
+                          shape=(n_rows, len(self.codes)))
+
+
+_float_dtype_upcasts = {}
+"""Fields with a higher precision than `settings.float_dtype`, per function."""
+
+
+def check_float_dtype(func):
+    """Record results of `func` with a higher precision than `settings.float_dtype`.
+
+    Decorates the functions of the `pp` and `tl` modules. After each call,
+    compares the floating point fields of the passed or returned `AnnData`
+    and returned arrays with the policy, ignoring fields whose precision did
+    not increase. Retrieve the records using `float_dtype_report`.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        data = args[0] if args else None
+        before = _float_fields(data)
+        result = func(*args, **kwargs)
+        itemsize = np.dtype(settings.float_dtype).itemsize
+        after = _float_fields(data if result is None else result)
+        for name, dtype in after.items():
+            if dtype.itemsize <= itemsize: continue
+            # arrays returned for an array are compared with the passed array
+            previous = before.get(name, before.get('result'))
+            if previous is not None and previous.itemsize >= dtype.itemsize:
+                continue
+            upcasts = _float_dtype_upcasts.setdefault(func.__name__, {})
+            if name not in upcasts:
+                logg.msg('    `{}` upcasts {} to {}'.format(func.__name__, name, dtype), v=4)
+            upcasts[name] = dtype.name
+        return result
+    return wrapper
+
+
+def _float_fields(data):
+    """Dtypes of the floating point fields of an `AnnData` or arrays."""
+    from anndata import AnnData
+    from scipy.sparse import issparse
+    fields = {}
+    if isinstance(data, AnnData):
+        if data.isbacked: return fields
+        candidates = [('X', data.X)]
+        candidates += [('obsm[{!r}]'.format(k), data.obsm[k]) for k in data.obsm_keys()]
+        candidates += [('varm[{!r}]'.format(k), data.varm[k]) for k in data.varm_keys()]
+        candidates += [('obs[{!r}]'.format(k), data.obs[k]) for k in data.obs_keys()]
+        candidates += [('var[{!r}]'.format(k), data.var[k]) for k in data.var_keys()]
+        candidates += [('uns[{!r}]'.format(k), v) for k, v in data.uns.items()]
+    elif isinstance(data, tuple):
+        candidates = [('result[{}]'.format(i), d) for i, d in enumerate(data)]
     else:
-        groups_order_subset = groups_order.values
-    return groups_order_subset, groups_masks
+        candidates = [('result', data)]
+    for name, value in candidates:
+        if isinstance(value, np.ndarray) or issparse(value) or isinstance(value, pd.Series):
+            dtype = value.dtype
+            if dtype.names is not None:
+                dtype = max((dtype[n] for n in dtype.names), key=lambda d: (d.kind == 'f', d.itemsize))
+            if dtype.kind == 'f': fields[name] = dtype
+    return fields
+
+
+def float_dtype_report(reset=False):
+    """Report functions that returned results with higher precision.
+
+    Lists the fields that functions of `pp` and `tl` computed with a higher
+    precision than `settings.float_dtype` since importing Scanpy.
+
+    Parameters
+    ----------
+    reset : `bool`, optional (default: `False`)
+        Clear the records after reporting.
+
+    Returns
+    -------
+    Dictionary that maps function names to dictionaries of field names and
+    dtypes.
+    """
+    report = {func: dict(fields) for func, fields in _float_dtype_upcasts.items()}
+    if reset: _float_dtype_upcasts.clear()
+    return report
+
+
+def read_row_block(X, start, stop):
+    """Read rows `start:stop` of a possibly backed data matrix into memory.
+
+    Works for arrays, sparse matrices and the dense and sparse datasets of
+    backed `AnnData` objects. Returns an array or a CSR matrix.
+    """
+    from scipy.sparse import csr_matrix, issparse
+    group = getattr(X, 'h5py_group', None)
+    if group is not None and X.format_str == 'csr':
+        # only read the slice of the sparse dataset that stores the rows
+        indptr = group['indptr'][start:stop+1]
+        data = group['data'][indptr[0]:indptr[-1]]
+        indices = group['indices'][indptr[0]:indptr[-1]]
+        return csr_matrix((data, indices, indptr - indptr[0]),
+                          shape=(stop - start, X.shape[1]))
+    if group is not None:
+        return X.value[start:stop].tocsr()
+    block = X[start:stop]
+    return block.tocsr() if issparse(block) else np.asarray(block)
+
+
+def read_col_block(X, start, stop, chunk_size=10000):
+    """Read columns `start:stop` of a possibly backed data matrix into memory.
+
+    Returns a CSC matrix. Backed CSC data is sliced directly, backed CSR data
+    is read in blocks of `chunk_size` rows, so that only the requested columns
+    are held in memory.
+    """
+    from scipy.sparse import csc_matrix, issparse, vstack
+    group = getattr(X, 'h5py_group', None)
+    if group is not None and X.format_str == 'csc':
+        indptr = group['indptr'][start:stop+1]
+        data = group['data'][indptr[0]:indptr[-1]]
+        indices = group['indices'][indptr[0]:indptr[-1]]
+        return csc_matrix((data, indices, indptr - indptr[0]),
+                          shape=(X.shape[0], stop - start))
+    if group is not None:
+        n_obs = X.shape[0]
+        blocks = [read_row_block(X, i, min(i + chunk_size, n_obs))[:, start:stop]
+                  for i in range(0, n_obs, chunk_size)]
+        return vstack(blocks, format='csc')
+    block = X[:, start:stop]
+    return block.tocsc() if issparse(block) else csc_matrix(np.asarray(block))
 
 
 def pretty_dict_string(d, indent=0):